@@ -0,0 +1,223 @@
+import fnmatch
+import gzip
+import io
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+INDEX_SUFFIX = ".index.json"
+
+
+class _NonClosing:
+    # tarfile calls close() on the stream it wrote to; the archive codecs
+    # finish their own frame on close() but must leave the target open.
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def close(self):
+        pass
+
+
+class ParallelGzipWriter:
+    # Compresses fixed-size blocks as independent gzip members on a thread
+    # pool (zlib releases the GIL). Concatenated members are still a valid
+    # .gz stream, so gunzip and gzip.GzipFile read the result unchanged.
+    def __init__(self, fileobj, level=6, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def _submit(self, block):
+        self.pending.append(
+            self.executor.submit(gzip.compress, bytes(block), self.level, mtime=0)
+        )
+        # Keep at most two blocks per thread in memory.
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.executor is None:
+            return
+        if self.buffer:
+            self._submit(self.buffer)
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.executor = None
+
+
+class StoreCodec:
+    name = "store"
+    extension = ".tar"
+    content_type = "application/x-tar"
+
+    def writer(self, fileobj):
+        return _NonClosing(fileobj)
+
+    def reader(self, fileobj):
+        return _NonClosing(fileobj)
+
+
+class GzipCodec:
+    name = "gzip"
+    extension = ".tar.gz"
+    content_type = "application/gzip"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def writer(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=self.level, mtime=0)
+
+    def reader(self, fileobj):
+        # GzipFile reads multi-member streams, unlike tarfile's "r|gz".
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+
+
+class ParallelGzipCodec(GzipCodec):
+    name = "pgzip"
+
+    def __init__(self, level=6, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+        super().__init__(level)
+        self.block_size = block_size
+        self.threads = threads
+
+    def writer(self, fileobj):
+        return ParallelGzipWriter(fileobj, self.level, self.block_size, self.threads)
+
+
+class ZstdCodec:
+    name = "zstd"
+    extension = ".tar.zst"
+    content_type = "application/zstd"
+
+    def __init__(self, level=3, threads=-1):
+        self.level = level
+        self.threads = threads
+
+    def writer(self, fileobj):
+        import zstandard
+
+        # threads=-1 uses one compression thread per logical CPU.
+        compressor = zstandard.ZstdCompressor(level=self.level, threads=self.threads)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def reader(self, fileobj):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True, closefd=False
+        )
+
+
+CODECS = {
+    "store": StoreCodec,
+    "gzip": GzipCodec,
+    "pgzip": ParallelGzipCodec,
+    "zstd": ZstdCodec,
+}
+
+
+def get_codec(codec="gzip"):
+    if not isinstance(codec, str):
+        return codec
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}', expected one of {sorted(CODECS)}")
+    return CODECS[codec]()
+
+
+def codec_for_name(object_name):
+    # Fallback for objects uploaded without codec metadata.
+    if object_name.endswith(".tar.zst"):
+        return get_codec("zstd")
+    if object_name.endswith(".tar"):
+        return get_codec("store")
+    return get_codec("gzip")
+
+
+def archive_name(short_name, codec="gzip"):
+    return f"{short_name}{get_codec(codec).extension}"
+
+
+def index_name(object_name):
+    return f"{object_name}{INDEX_SUFFIX}"
+
+
+def _members(path, arcname):
+    # The same members, in the same order, as tar.add(path, arcname).
+    yield path, arcname
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            yield from _members(os.path.join(path, name), f"{arcname}/{name}")
+
+
+def write_seekable(folder_path, fileobj, codec, chunk_size=DEFAULT_BLOCK_SIZE):
+    # A tar archive where every member (header, data and padding) is its own
+    # gzip member or zstd frame. Decompressed back to back it is a normal
+    # tar stream, so old readers still work; the returned index of
+    # compressed offsets lets new readers fetch and extract single members.
+    members = []
+    tar = tarfile.open(fileobj=io.BytesIO(), mode="w")  # Only builds the headers
+    offset = fileobj.tell()
+    for path, arcname in _members(folder_path, os.path.basename(os.path.normpath(folder_path))):
+        tarinfo = tar.gettarinfo(path, arcname)
+        writer = codec.writer(fileobj)
+        writer.write(tarinfo.tobuf(tarfile.PAX_FORMAT, tar.encoding, tar.errors))
+        if tarinfo.isreg():
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    writer.write(chunk)
+            padding = -tarinfo.size % tarfile.BLOCKSIZE
+            writer.write(tarfile.NUL * padding)
+        writer.close()
+        end = fileobj.tell()
+        members.append(
+            {
+                "name": arcname,
+                "type": "dir" if tarinfo.isdir() else "file",
+                "size": tarinfo.size,
+                "offset": offset,
+                "length": end - offset,
+            }
+        )
+        offset = end
+    # End-of-archive marker, so a full read ends cleanly.
+    writer = codec.writer(fileobj)
+    writer.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+    writer.close()
+    return {"format": "seekable-tar", "codec": codec.name, "members": members, "size": fileobj.tell()}
+
+
+def select_members(index, splits=None, files=None):
+    # Members of the given splits ('<root>/<split>/...') and/or matching the
+    # glob 'files', plus the files at the top of the dataset folder.
+    splits = [splits] if isinstance(splits, str) else list(splits or [])
+    patterns = [files] if isinstance(files, str) else list(files or [])
+    selected = []
+    for member in index["members"]:
+        parts = member["name"].split("/")
+        if len(parts) == 1 or (len(parts) == 2 and member["type"] == "file") or parts[1] in splits:
+            selected.append(member)
+        elif any(fnmatch.fnmatch(member["name"], pattern) for pattern in patterns):
+            selected.append(member)
+    return selected
@@ -1,16 +1,21 @@
 import shutil
-from pathlib import Path
 import os
+import sys
 from datasets import Dataset, DatasetDict, DatasetInfo
-from datasets import load_dataset
 from fire import Fire
 from numpy import dot
-from utils import DatasetMover
+from open_instruct import TRANSFORM
+from streaming import DEFAULT_BATCH_SIZE, DEFAULT_SHARD_ROWS, iter_tables, stream_build
+from batch_io import DEFAULT_PARTITIONS, DEFAULT_SHARD_BYTES, join_outputs, write_requests
+from metrics import stage
+from source_mirror import load_source
+from utils import DatasetMover, cached_build, get_output, publish_dataset
 import dotenv
 
 dotenv.load_dotenv()
 
 
+@cached_build()
 def split(
     dataset_name="VMware/open-instruct",
     train_size=0.9,
@@ -18,34 +23,55 @@ def split(
     val_size=0.05,
     short_name="open-instruct-inference",
     output_dir="dataset",
+    bucket_name="fine-tuning-research",
+    publish_mode="tarball",
+    limit=101,
+    streaming=False,
+    batch_size=DEFAULT_BATCH_SIZE,
+    shard_rows=DEFAULT_SHARD_ROWS,
+    use_cache=True,
 ):
-    print(f"Loading {dataset_name}")
-    dataset = load_dataset(dataset_name)
-    new_dataset = []
-    for row in dataset["train"]:
-        row["prompt"] = row["alpaca_prompt"].strip()
-        row["completion"] = row["response"].strip()
-        for to_delete in [
-            "alpaca_prompt",
-            "response",
-            "instruction",
-            "task_name",
-            "template_type",
-        ]:
-            row.pop(to_delete)
-        new_dataset.append(row)
-        if len(new_dataset) > 100:
-            break
-
-    # Create a Dataset from your list of dictionaries
-    new_dataset = Dataset.from_list(new_dataset)
-
-    # If you're creating a new dataset from scratch:
-    dataset_dict = DatasetDict(
-        {
-            "batch_inference": new_dataset  # Assign the new dataset as the train split
-        }
-    )
+    if streaming:
+        print(f"Streaming {dataset_name}")
+        source = {"train": load_source(dataset_name, split="train", streaming=True).take(limit)}
+        dataset_dict = stream_build(
+            source,
+            TRANSFORM,
+            os.path.join(output_dir, f"{short_name}-shards"),
+            {"train": {"batch_inference": 1.0}},
+            batch_size=batch_size,
+            shard_rows=shard_rows,
+        )
+    else:
+        print(f"Loading {dataset_name}")
+        with stage("load") as loaded:
+            dataset = load_source(dataset_name)
+            loaded.rows_out = sum(dataset.num_rows.values())
+        new_dataset = []
+        for row in dataset["train"]:
+            row["prompt"] = row["alpaca_prompt"].strip()
+            row["completion"] = row["response"].strip()
+            for to_delete in [
+                "alpaca_prompt",
+                "response",
+                "instruction",
+                "task_name",
+                "template_type",
+            ]:
+                row.pop(to_delete)
+            new_dataset.append(row)
+            if len(new_dataset) >= limit:
+                break
+
+        # Create a Dataset from your list of dictionaries
+        new_dataset = Dataset.from_list(new_dataset)
+
+        # If you're creating a new dataset from scratch:
+        dataset_dict = DatasetDict(
+            {
+                "batch_inference": new_dataset  # Assign the new dataset as the train split
+            }
+        )
 
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
@@ -60,35 +86,87 @@ def split(
     for split, dataset in dataset_dict.items():
         dataset.dataset_info = dataset_info
 
-    current_directory = Path(".")
-    shutil.rmtree(current_directory / output_dir, ignore_errors=True)
-    os.mkdir(current_directory / output_dir)
-    dataset_path = (current_directory / output_dir / short_name).as_posix()
-    dataset_dict.save_to_disk(dataset_path)
+    publish_dataset(
+        dataset_dict,
+        output_dir,
+        short_name,
+        bucket_name,
+        publish_mode=publish_mode,
+        version=dataset_info.version,
+    )
+
 
-    # Compress the folder
-    print(f"Compressing the folder {current_directory / output_dir/ short_name}")
-    folder_to_compress = (current_directory / output_dir / short_name).as_posix()
-    output_tar_file = f"{short_name}.tar.gz"
-    bucket_name = "fine-tuning-research"
-    print(f"Uploading {output_tar_file} to {bucket_name}")
-    dataset_mover = DatasetMover()
-    dataset_mover.upload(folder_to_compress, output_tar_file, bucket_name)
+def requests(
+    dataset_name="VMware/open-instruct",
+    short_name="open-instruct-inference",
+    output_dir="dataset",
+    bucket_name="fine-tuning-research",
+    limit=None,
+    max_shard_bytes=DEFAULT_SHARD_BYTES,
+    batch_size=DEFAULT_BATCH_SIZE,
+    shard_rows=DEFAULT_SHARD_ROWS,
+    upload=True,
+):
+    # Streams the source into JSONL request shards under
+    # '<short_name>/requests/' and the full rows under '<short_name>/inputs/'.
+    print(f"Streaming {dataset_name}")
+    source = load_source(dataset_name, split="train", streaming=True)
+    if limit:
+        source = source.take(limit)
+    tables = (TRANSFORM(table) for table in iter_tables(source, batch_size))
+    output_path = os.path.join(output_dir, f"{short_name}-requests")
+    request_files, input_files = write_requests(tables, output_path, max_shard_bytes, shard_rows)
+    if upload:
+        DatasetMover().transfers.upload_files(
+            (bucket_name, f"{short_name}/{os.path.relpath(path, output_path)}", path)
+            for path in request_files + input_files
+        )
+        print(f"Uploaded {len(request_files)} request shards to {bucket_name}/{short_name}/requests/")
 
 
-def get_output(
+def join(
     short_name="open-instruct-inference",
     output_dir="dataset",
+    bucket_name="fine-tuning-research",
+    partitions=DEFAULT_PARTITIONS,
+    shard_rows=DEFAULT_SHARD_ROWS,
+    publish=False,
+    publish_mode="tarball",
 ):
-    dataset_mover = DatasetMover()
-    current_directory = Path(".")
-    shutil.rmtree(current_directory / output_dir, ignore_errors=True)
-    os.mkdir(current_directory / output_dir)
-    dataset_path = (current_directory / output_dir / short_name).as_posix()
-    dataset_mover.download(
-        "fine-tuning-research", f"{short_name}-output.tar.gz", dataset_path
+    # Downloads the inputs and the '<short_name>/outputs/*.jsonl' shards
+    # written by the inference job, joins them by id and saves the result to
+    # '<output_dir>/<short_name>-output' (published as '<short_name>-output').
+    transfers = DatasetMover().transfers
+    work_path = os.path.join(output_dir, f"{short_name}-join")
+    files = {"inputs": [], "outputs": []}
+    batch = []
+    for folder, files_in_folder in files.items():
+        for item in transfers.client.list_objects(bucket_name, prefix=f"{short_name}/{folder}/", recursive=True):
+            path = os.path.join(work_path, os.path.relpath(item.object_name, short_name))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            batch.append((bucket_name, item.object_name, path))
+            files_in_folder.append(path)
+    transfers.download_files(batch)
+    output_files = sorted(path for path in files["outputs"] if path.endswith(".jsonl"))
+    dataset_dict = join_outputs(
+        sorted(files["inputs"]),
+        output_files,
+        os.path.join(output_dir, f"{short_name}-joined"),
+        partitions,
+        shard_rows,
     )
+    shutil.rmtree(work_path, ignore_errors=True)
+    if publish:
+        publish_dataset(dataset_dict, output_dir, f"{short_name}-output", bucket_name, publish_mode=publish_mode)
+    else:
+        dataset_dict.save_to_disk(os.path.join(output_dir, f"{short_name}-output"))
+
 
+COMMANDS = {"split": split, "get_output": get_output, "requests": requests, "join": join}
 
 if __name__ == "__main__":
-    Fire(get_output)
+    # Without a command, 'python batch_inference.py <args>' still runs get_output.
+    if len(sys.argv) > 1 and sys.argv[1] in [*COMMANDS, "--help", "-h"]:
+        Fire(COMMANDS)
+    else:
+        Fire(get_output)
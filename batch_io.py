@@ -0,0 +1,195 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pajson
+import pyarrow.parquet as pq
+from metrics import current, timed
+from streaming import DEFAULT_SHARD_ROWS, ShardWriter, load_shards
+
+# Batch inference requests go out as size-capped JSONL shards, one
+# {"id": ..., "prompt": ...} object per line. The full input rows are kept
+# as Parquet shards next to them, and the service's JSONL output shards are
+# joined back to them by id, one range of rows at a time.
+DEFAULT_SHARD_BYTES = 256 * 2**20
+DEFAULT_PARTITIONS = 64
+
+try:
+    import orjson
+
+    def _dumps(value):
+        return orjson.dumps(value)
+
+except ImportError:
+    import json
+
+    def _dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def request_ids(table, offset):
+    # Stable across reruns of the same source: the row's position plus a
+    # hash of its prompt, so a reordered source doesn't silently mismatch.
+    hashes = pd.util.hash_array(
+        table["prompt"].to_numpy(zero_copy_only=False), categorize=False
+    )
+    return pa.array(
+        [
+            f"{offset + position:012d}-{value:016x}"
+            for position, value in enumerate(hashes.tolist())
+        ],
+        pa.string(),
+    )
+
+
+class JsonlShardWriter:
+    def __init__(self, folder, max_bytes=DEFAULT_SHARD_BYTES, prefix="requests"):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.files = []
+        self.file = None
+        self.bytes_in_shard = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _open(self):
+        path = os.path.join(self.folder, f"{self.prefix}-{len(self.files):05d}.jsonl")
+        self.file = open(path, "wb")
+        self.files.append(path)
+        self.bytes_in_shard = 0
+
+    def write(self, records):
+        for record in records:
+            line = _dumps(record) + b"\n"
+            if self.file is None or (self.bytes_in_shard and self.bytes_in_shard + len(line) > self.max_bytes):
+                self.close()
+                self._open()
+            self.file.write(line)
+            self.bytes_in_shard += len(line)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+@timed("write_requests")
+def write_requests(tables, output_path, max_bytes=DEFAULT_SHARD_BYTES, shard_rows=DEFAULT_SHARD_ROWS):
+    # tables: transformed batches with a 'prompt' column. Writes
+    # requests/requests-*.jsonl and inputs/part-*.parquet under output_path.
+    shutil.rmtree(output_path, ignore_errors=True)
+    requests = JsonlShardWriter(os.path.join(output_path, "requests"), max_bytes)
+    inputs = ShardWriter(os.path.join(output_path, "inputs"), shard_rows)
+    rows = 0
+    for table in tables:
+        ids = request_ids(table, rows)
+        prompts = table["prompt"].to_pylist()
+        requests.write({"id": id_, "prompt": prompt} for id_, prompt in zip(ids.to_pylist(), prompts))
+        inputs.write(table.add_column(0, "id", ids))
+        rows += len(table)
+    requests.close()
+    inputs.close()
+    current().rows_out = rows
+    print(f"Wrote {rows} requests to {len(requests.files)} shards in {output_path}")
+    return requests.files, inputs.files
+
+
+def _row_index(ids):
+    # Ids start with the zero-padded row position, see request_ids.
+    return pc.cast(pc.utf8_slice_codeunits(ids, 0, 12), pa.int64()).to_numpy()
+
+
+class _Partitioner:
+    # Spreads rows over Parquet files by row position, 'span' rows per file,
+    # so joining the files in order keeps the input order.
+    def __init__(self, folder, span):
+        self.folder = folder
+        self.span = span
+        self.writers = {}
+        self.schema = None
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, partition):
+        return os.path.join(self.folder, f"{partition:05d}.parquet")
+
+    def write(self, table):
+        if self.schema is None:
+            self.schema = table.schema
+        elif table.schema != self.schema:
+            table = table.cast(self.schema)
+        picks = _row_index(table["id"]) // self.span
+        for partition in np.unique(picks):
+            if partition not in self.writers:
+                self.writers[partition] = pq.ParquetWriter(self.path(partition), self.schema)
+            self.writers[partition].write_table(table.filter(pa.array(picks == partition)))
+
+    def read(self, partition):
+        if partition not in self.writers:
+            return None
+        return pq.read_table(self.path(partition))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def _read_outputs(path):
+    # Output shards are size-capped, so one shard at a time fits in memory.
+    table = pajson.read_json(path)
+    if "id" not in table.column_names:
+        raise ValueError(f"Output shard '{path}' has no 'id' field")
+    return table.set_column(table.column_names.index("id"), "id", table["id"].cast(pa.string()))
+
+
+def _last_per_id(table):
+    # Retried requests can be answered twice, keep the latest answer.
+    ids = pc.dictionary_encode(table["id"]).combine_chunks().indices.to_numpy()
+    _, last = np.unique(ids[::-1], return_index=True)
+    return table.take(np.sort(len(ids) - 1 - last))
+
+
+@timed("join_outputs")
+def join_outputs(input_files, output_files, output_path, partitions=DEFAULT_PARTITIONS, shard_rows=DEFAULT_SHARD_ROWS):
+    # Partitions inputs and outputs by row position, then joins one partition
+    # at a time, so memory holds about 1/partitions of the data. Inputs
+    # without an output keep null output columns, output columns that clash
+    # with input columns get an '_output' suffix.
+    work_path = os.path.join(output_path, "partitions")
+    shutil.rmtree(output_path, ignore_errors=True)
+    total = sum(pq.ParquetFile(path).metadata.num_rows for path in input_files)
+    span = max(-(-total // partitions), 1)
+    left = _Partitioner(os.path.join(work_path, "inputs"), span)
+    right = _Partitioner(os.path.join(work_path, "outputs"), span)
+    for path in input_files:
+        for batch in pq.ParquetFile(path).iter_batches():
+            left.write(pa.Table.from_batches([batch]))
+    for path in output_files:
+        right.write(_read_outputs(path))
+    left.close()
+    right.close()
+    if right.schema is None:
+        raise ValueError("No outputs to join")
+
+    writer = ShardWriter(os.path.join(output_path, "joined"), shard_rows)
+    rows = 0
+    missing = 0
+    for partition in range(-(-total // span)):
+        inputs = left.read(partition)
+        if inputs is None:
+            continue
+        outputs = right.read(partition)
+        if outputs is None:
+            outputs = right.schema.empty_table()
+        outputs = _last_per_id(outputs)
+        answered = pc.is_in(inputs["id"], value_set=outputs["id"])
+        missing += len(inputs) - (pc.sum(answered).as_py() or 0)
+        joined = inputs.join(outputs, "id", join_type="left outer", right_suffix="_output")
+        writer.write(joined.sort_by("id"))
+        rows += len(joined)
+    writer.close()
+    shutil.rmtree(work_path, ignore_errors=True)
+    current().rows_out = rows
+    print(f"Joined {rows} inputs with outputs from {len(output_files)} shards, {missing} without an output")
+    return load_shards({"batch_inference": writer.files})
@@ -0,0 +1,589 @@
+import contextlib
+import csv
+import glob
+import importlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import Dataset, DatasetDict, load_dataset
+from fire import Fire
+from archive import archive_name, get_codec
+from splitter import train_val_test
+from utils import DatasetMover
+
+
+def _folder_size(folder_path):
+    total = 0
+    for root, _, files in os.walk(folder_path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def codecs(folder_path, names="store,gzip,pgzip,zstd", output=None):
+    # Compare archive codecs on a folder written by DatasetDict.save_to_disk.
+    if isinstance(names, str):
+        names = names.split(",")
+    raw_bytes = _folder_size(folder_path)
+    dataset_mover = DatasetMover()
+    results = []
+    for name in names:
+        codec = get_codec(name)
+        with tempfile.NamedTemporaryFile(suffix=codec.extension) as f:
+            start = time.perf_counter()
+            dataset_mover._write_archive(folder_path, f, codec)
+            compress_seconds = time.perf_counter() - start
+            f.flush()
+            archive_bytes = os.path.getsize(f.name)
+
+            f.seek(0)
+            start = time.perf_counter()
+            with tarfile.open(fileobj=codec.reader(f), mode="r|") as tar:
+                for member in tar:
+                    if member.isfile():
+                        extracted = tar.extractfile(member)
+                        while extracted.read(1 << 20):
+                            pass
+            decompress_seconds = time.perf_counter() - start
+
+        results.append(
+            {
+                "codec": name,
+                "raw_bytes": raw_bytes,
+                "archive_bytes": archive_bytes,
+                "ratio": raw_bytes / max(archive_bytes, 1),
+                "compress_seconds": compress_seconds,
+                "compress_mib_s": raw_bytes / 2**20 / max(compress_seconds, 1e-9),
+                "decompress_seconds": decompress_seconds,
+                "decompress_mib_s": raw_bytes / 2**20 / max(decompress_seconds, 1e-9),
+            }
+        )
+        print(
+            f"{name:>6}: ratio {results[-1]['ratio']:.2f}, "
+            f"compress {results[-1]['compress_mib_s']:.1f} MiB/s, "
+            f"decompress {results[-1]['decompress_mib_s']:.1f} MiB/s"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def _legacy_open_instruct(dataset):
+    new_dataset = []
+    for row in dataset:
+        row["prompt"] = row["alpaca_prompt"].strip()
+        row["completion"] = row["response"].strip()
+        for to_delete in [
+            "alpaca_prompt",
+            "response",
+            "instruction",
+            "task_name",
+            "template_type",
+        ]:
+            row.pop(to_delete)
+        new_dataset.append(row)
+    return Dataset.from_list(new_dataset)
+
+
+def _legacy_text_to_sql(dataset):
+    new_dataset = []
+    for row in dataset:
+        text = row["text"].strip()
+        text = text.replace("###", "\n###").strip()
+        SPLITTER = "### Response:"
+        row["prompt"] = text[: text.index(SPLITTER) + len(SPLITTER)]
+        row["completion"] = text[text.index(SPLITTER) + len(SPLITTER) :]
+        for to_delete in [
+            "instruction",
+            "input",
+            "response",
+            "text",
+        ]:
+            row.pop(to_delete)
+        new_dataset.append(row)
+    return Dataset.from_list(new_dataset)
+
+
+# The per-row loops the builders used before the Arrow pipelines.
+LEGACY_TRANSFORMS = {
+    "open_instruct": ("VMware/open-instruct", _legacy_open_instruct),
+    "text_to_sql": ("Clinton/Text-to-sql-v1", _legacy_text_to_sql),
+}
+
+
+def transforms(builder="open_instruct", dataset_name=None, num_proc=None, limit=None, check=True):
+    # Before/after throughput of a builder's transform on its full train split.
+    default_name, legacy = LEGACY_TRANSFORMS[builder]
+    source = load_dataset(dataset_name or default_name, split="train")
+    if limit:
+        source = source.select(range(limit))
+
+    start = time.perf_counter()
+    before = legacy(source)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    after = importlib.import_module(builder).TRANSFORM.apply(
+        source, num_proc=num_proc, load_from_cache_file=False
+    )
+    arrow_seconds = time.perf_counter() - start
+
+    result = {
+        "builder": builder,
+        "rows": len(source),
+        "legacy_seconds": legacy_seconds,
+        "legacy_rows_s": len(source) / max(legacy_seconds, 1e-9),
+        "arrow_seconds": arrow_seconds,
+        "arrow_rows_s": len(source) / max(arrow_seconds, 1e-9),
+        "speedup": legacy_seconds / max(arrow_seconds, 1e-9),
+    }
+    if check:
+        result["identical"] = all(
+            before[column] == after[column] for column in before.column_names
+        )
+    print(json.dumps(result, indent=2))
+
+
+def _legacy_mmlu_gen(mmlu_data, split):
+    # The csv.reader generator mmlu.py used before reading CSVs with pyarrow.
+    for filepath in glob.glob((Path(mmlu_data) / split / "*.csv").as_posix()):
+        with open(filepath, "r") as fr:
+            for row in csv.reader(fr):
+                prompt = f"{row[0]}\n"
+                choices = row[1:5]
+                for option, choice in zip(["A", "B", "C", "D"], choices):
+                    prompt += f"{option}. {choice}\n"
+                lookup = {"A": 0, "B": 1, "C": 2, "D": 3}
+                yield {"prompt": prompt, "completion": choices[lookup[row[5]]]}
+
+
+def mmlu(data_dir=None, num_workers=None, check=True):
+    import mmlu as mmlu_builder
+
+    mmlu_data = Path(data_dir) if data_dir else Path.home() / "data" / "mmlu"
+
+    start = time.perf_counter()
+    before = {
+        split: Dataset.from_generator(
+            _legacy_mmlu_gen,
+            gen_kwargs={"mmlu_data": mmlu_data.as_posix(), "split": split},
+            keep_in_memory=True,
+        )
+        for split in mmlu_builder.SPLITS
+    }
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    after = mmlu_builder.read_splits(mmlu_data, num_workers)
+    arrow_seconds = time.perf_counter() - start
+
+    rows = sum(len(table) for table in after.values())
+    result = {
+        "rows": rows,
+        "legacy_seconds": legacy_seconds,
+        "arrow_seconds": arrow_seconds,
+        "speedup": legacy_seconds / max(arrow_seconds, 1e-9),
+    }
+    if check:
+        result["identical"] = all(
+            before[split][column] == after[split][column].to_pylist()
+            for split in before
+            for column in ["prompt", "completion"]
+        )
+    print(json.dumps(result, indent=2))
+
+
+def _legacy_humset(source, sectors, pillars):
+    # The per-row render humset.py used before the multi-hot encoding, with a
+    # fixed label order instead of a set's.
+    rows = []
+    for row in source:
+        row_pillars = row["pillars_1d"] + row["pillars_2d"]
+        classes = {
+            "sectors": OrderedDict({k: k in row["sectors"] for k in sectors}),
+            "pillars": OrderedDict({k: k in row_pillars for k in pillars}),
+        }
+        rows.append(
+            {
+                "prompt": f"Classify the sectors and pillars for this excerpt:\n{row['excerpt'].strip()}\n\nClasses:",
+                "completion": f"\n{json.dumps(classes, indent=2)}",
+            }
+        )
+    return Dataset.from_list(rows)
+
+
+def humset(rows=100_000, num_proc=None, seed=0, check=True):
+    import humset as humset_builder
+
+    workdir = tempfile.mkdtemp(prefix="benchmark-humset-")
+    try:
+        for split, table in synthetic_humset(rows, seed).items():
+            pq.write_table(table, os.path.join(workdir, f"{split}.parquet"))
+        source = load_dataset(workdir)
+        start = time.perf_counter()
+        after, labels = humset_builder.build_splits(workdir, num_proc)
+        arrow_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        before = {
+            humset_builder.SPLITS[split]: _legacy_humset(dataset, labels["sectors"], labels["pillars"])
+            for split, dataset in source.items()
+        }
+        legacy_seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "rows": sum(len(split) for split in after.values()),
+        "legacy_seconds": legacy_seconds,
+        "arrow_seconds": arrow_seconds,
+        "speedup": legacy_seconds / max(arrow_seconds, 1e-9),
+    }
+    if check:
+        result["identical"] = all(
+            before[split][column] == after[split][column]
+            for split in before
+            for column in ["prompt", "completion"]
+        )
+    print(json.dumps(result, indent=2))
+
+
+# Synthetic corpora shaped like the real sources, so the pipeline benchmark
+# runs offline and at any size.
+WORDS = (
+    "the of and to in is for on that with as by this data model table query "
+    "select from where group order count sum average name value city year "
+    "water food health shelter protection education livelihoods displacement"
+).split()
+SECTORS = ["Agriculture", "Education", "Food Security", "Health", "Livelihoods", "Logistics", "Nutrition", "Protection", "Shelter", "WASH"]
+PILLARS = ["Context->Economy", "Context->Security & Stability", "Displacement->Type/Numbers/Movements", "Humanitarian Conditions->Living Standards", "Impact->Impact On People", "Casualties->Dead", "Covid-19->Cases", "Information And Communication->Knowledge And Info Gaps (Pop)"]
+
+
+def _sentences(rng, rows, min_words, max_words):
+    lengths = rng.integers(min_words, max_words, size=rows)
+    words = rng.choice(WORDS, size=lengths.sum())
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    return [" ".join(words[bounds[i] : bounds[i + 1]]) for i in range(rows)]
+
+
+def _labels(rng, rows, labels, max_labels):
+    counts = rng.integers(0, max_labels + 1, size=rows)
+    return [sorted(rng.choice(labels, size=count, replace=False).tolist()) for count in counts]
+
+
+def synthetic_open_instruct(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    instruction = _sentences(rng, rows, 5, 30)
+    response = _sentences(rng, rows, 10, 200)
+    return {
+        "train": pa.table(
+            {
+                "alpaca_prompt": [
+                    f"Below is an instruction that describes a task. Write a response that appropriately "
+                    f"completes the request.\n\n### Instruction:\n{text}\n\n### Response: "
+                    for text in instruction
+                ],
+                "response": [f" {text}\n" for text in response],
+                "instruction": instruction,
+                "task_name": rng.choice(["alpaca", "dolly", "flan", "oasst"], size=rows).tolist(),
+                "template_type": ["alpaca"] * rows,
+            }
+        )
+    }
+
+
+def synthetic_text_to_sql(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    instruction = _sentences(rng, rows, 5, 25)
+    context = _sentences(rng, rows, 5, 40)
+    response = [f"SELECT {text}" for text in _sentences(rng, rows, 5, 20)]
+    text = [
+        f" ### Instruction: {a} ### Input: CREATE TABLE t ({b}) ### Response: {c} "
+        for a, b, c in zip(instruction, context, response)
+    ]
+    return {
+        "train": pa.table(
+            {"instruction": instruction, "input": context, "response": response, "text": text}
+        )
+    }
+
+
+def synthetic_humset(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    tables = {}
+    for split, fraction in [("train", 0.8), ("validation", 0.1), ("test", 0.1)]:
+        count = max(1, int(rows * fraction))
+        tables[split] = pa.table(
+            {
+                "excerpt": [f" {text} " for text in _sentences(rng, count, 20, 150)],
+                "sectors": _labels(rng, count, SECTORS, 3),
+                "pillars_1d": _labels(rng, count, PILLARS[:4], 2),
+                "pillars_2d": _labels(rng, count, PILLARS[4:], 2),
+            }
+        )
+    return tables
+
+
+def write_synthetic_mmlu(folder, rows, seed=0, subjects=20):
+    # Headerless 6 column CSVs: question, A, B, C, D, answer.
+    rng = np.random.default_rng(seed)
+    for split in ["auxiliary_train", "dev", "val", "test"]:
+        os.makedirs(os.path.join(folder, split), exist_ok=True)
+        count = max(1, rows // subjects // 4)
+        for subject in range(subjects):
+            columns = [_sentences(rng, count, 5, 40)]
+            columns += [_sentences(rng, count, 1, 8) for _ in range(4)]
+            columns.append(rng.choice(["A", "B", "C", "D"], size=count).tolist())
+            with open(os.path.join(folder, split, f"subject{subject}_{split}.csv"), "w", newline="") as f:
+                csv.writer(f).writerows(zip(*columns))
+
+
+SYNTHETIC = {
+    "open_instruct": synthetic_open_instruct,
+    "text_to_sql": synthetic_text_to_sql,
+    "humset": synthetic_humset,
+}
+
+
+class _Stages:
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def time(self, name, **info):
+        start = time.perf_counter()
+        cpu = time.process_time()
+        yield info
+        self.stages[name] = {
+            "seconds": time.perf_counter() - start,
+            "cpu_seconds": time.process_time() - cpu,
+            **info,
+        }
+        print(f"{name:>14}: {self.stages[name]['seconds']:.3f}s")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def _s3_bucket(bucket_name):
+    # Use the S3 from the environment (e.g. a local MinIO), or else an
+    # in-process moto server if it's installed. None skips the S3 stages.
+    if "S3_ENDPOINT" not in os.environ:
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            print("No S3_ENDPOINT and moto isn't installed, skipping upload/download")
+            return None
+        port = _free_port()
+        ThreadedMotoServer(port=port, verbose=False).start()
+        os.environ.update(
+            S3_ENDPOINT=f"localhost:{port}",
+            S3_ACCESS_KEY_ID="benchmark",
+            S3_SECRET_ACCESS_KEY="benchmark",
+            S3_REGION="us-east-1",
+            S3_SECURE="false",
+        )
+    client = DatasetMover()._get_client()
+    if not client.bucket_exists(bucket_name):
+        client.make_bucket(bucket_name)
+    return bucket_name
+
+
+def _build(builder, stages, workdir, rows, seed, num_proc):
+    builder_module = importlib.import_module(builder)
+    source_path = os.path.join(workdir, "source")
+    if builder == "mmlu":
+        write_synthetic_mmlu(source_path, rows, seed)
+        with stages.time("read", rows_in=rows) as info:
+            tables = builder_module.read_splits(source_path)
+            info["rows_out"] = sum(len(table) for table in tables.values())
+        tables["train"] = tables.pop("auxiliary_train")
+        return DatasetDict({split: Dataset(table) for split, table in tables.items()})
+
+    os.makedirs(source_path)
+    for split, table in SYNTHETIC[builder](rows, seed).items():
+        pq.write_table(table, os.path.join(source_path, f"{split}.parquet"))
+    with stages.time("load", rows_in=rows) as info:
+        source = load_dataset(source_path)
+        info["rows_out"] = sum(len(split) for split in source.values())
+
+    if builder == "humset":
+        with stages.time("transform", rows_in=info["rows_out"]) as info:
+            splits, _ = builder_module.build_splits(source_path, num_proc)
+            info["rows_out"] = sum(len(split) for split in splits.values())
+        return DatasetDict(splits)
+
+    with stages.time("transform", rows_in=len(source["train"])) as info:
+        train = builder_module.TRANSFORM.apply(
+            source["train"], num_proc=num_proc, load_from_cache_file=False
+        )
+        info["rows_out"] = len(train)
+    with stages.time("split", rows_in=len(train)) as info:
+        splits = train_val_test(DatasetDict({"train": train}), 0.9, 0.05, 0.05, seed=seed)
+        info["rows_out"] = sum(len(split) for split in splits.values())
+    return splits
+
+
+def pipeline(
+    builders="open_instruct,text_to_sql,mmlu,humset",
+    rows=10_000,
+    output=None,
+    bucket_name="benchmark",
+    codec="gzip",
+    num_proc=None,
+    seed=0,
+    s3=True,
+):
+    # Times every stage of the builders on synthetic data, end to end.
+    if isinstance(builders, str):
+        builders = builders.split(",")
+    bucket = _s3_bucket(bucket_name) if s3 else None
+    dataset_mover = DatasetMover()
+    results = []
+    for builder in builders:
+        print(f"Benchmarking {builder} with {rows} rows")
+        stages = _Stages()
+        workdir = tempfile.mkdtemp(prefix=f"benchmark-{builder}-")
+        try:
+            splits = _build(builder, stages, workdir, rows, seed, num_proc)
+            dataset_path = os.path.join(workdir, builder)
+            with stages.time("save_to_disk") as info:
+                splits.save_to_disk(dataset_path)
+                info["bytes"] = _folder_size(dataset_path)
+            archive = os.path.join(workdir, archive_name(builder, codec))
+            with stages.time("compress") as info:
+                dataset_mover._compress_folder(dataset_path, archive, get_codec(codec))
+                info["bytes"] = os.path.getsize(archive)
+            if bucket:
+                object_name = os.path.basename(archive)
+                with stages.time("upload", bytes=os.path.getsize(archive)):
+                    dataset_mover._upload_to_s3(archive, bucket, object_name)
+                with stages.time("download", bytes=os.path.getsize(archive)):
+                    dataset_mover._download_from_s3(bucket, object_name, f"{archive}.download")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        results.append(
+            {
+                "builder": builder,
+                "rows": rows,
+                "total_seconds": sum(stage["seconds"] for stage in stages.stages.values()),
+                "stages": stages.stages,
+            }
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def compare(baseline, current, threshold=0.2, min_seconds=0.05):
+    # Flags stages that got more than 'threshold' slower than the baseline.
+    # Stages faster than 'min_seconds' in both runs are too noisy to judge.
+    with open(baseline) as f:
+        before = {result["builder"]: result for result in json.load(f)}
+    with open(current) as f:
+        after = {result["builder"]: result for result in json.load(f)}
+
+    regressions = []
+    for builder, result in after.items():
+        if builder not in before:
+            print(f"{builder}: not in the baseline")
+            continue
+        for stage, timing in result["stages"].items():
+            if stage not in before[builder]["stages"]:
+                continue
+            old = before[builder]["stages"][stage]["seconds"]
+            new = timing["seconds"]
+            change = new / max(old, 1e-9) - 1
+            regressed = change > threshold and max(old, new) >= min_seconds
+            print(
+                f"{builder:>14} {stage:>14}: {old:8.3f}s -> {new:8.3f}s "
+                f"({change:+.0%}){' REGRESSION' if regressed else ''}"
+            )
+            if regressed:
+                regressions.append({"builder": builder, "stage": stage, "baseline": old, "current": new})
+    if regressions:
+        print(f"{len(regressions)} stages regressed by more than {threshold:.0%}")
+        raise SystemExit(1)
+    print("No regressions")
+
+
+# Modules the transfer commands and '--help' must not import.
+HEAVY_MODULES = ["datasets", "pandas", "pyarrow", "numpy", "jinja2", "transformers", "tqdm"]
+STARTUP_COMMANDS = ["upload", "download", "publish", "fetch", "get_output"]
+
+
+def _startup(code):
+    # Seconds to run 'code' in a fresh interpreter next to cli.py, and the
+    # heavy top-level modules it imported, from -X importtime.
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    seconds = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(result.stderr.splitlines()[-1])
+    imported = {line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+    return seconds, sorted(module for module in HEAVY_MODULES if module in imported)
+
+
+def startup_checks():
+    # 'cli.py --help' and getting every transfer command ready to run. Fire's
+    # own per-command '--help' is left out, it imports IPython when installed.
+    checks = {"--help": "import cli; cli.main(['--help'])"}
+    for name in STARTUP_COMMANDS:
+        checks[name] = f"import cli, fire; cli.resolve({name!r})"
+    return checks
+
+
+def startup(budget=1.0, repeat=3):
+    # Fails when a startup check takes longer than 'budget' seconds, or pulls
+    # in a heavy module.
+    failures = []
+    for name, code in startup_checks().items():
+        seconds, heavy = min(_startup(code) for _ in range(repeat))
+        slow = seconds > budget
+        print(
+            f"cli.py {name:<12} {seconds:6.3f}s{' OVER BUDGET' if slow else ''}"
+            f"{' imports ' + ', '.join(heavy) if heavy else ''}"
+        )
+        if slow or heavy:
+            failures.append(name)
+    if failures:
+        print(f"{len(failures)} commands over the {budget:.1f}s startup budget or importing heavy modules")
+        raise SystemExit(1)
+    print(f"All commands start within {budget:.1f}s")
+
+
+if __name__ == "__main__":
+    Fire(
+        {
+            "codecs": codecs,
+            "transforms": transforms,
+            "mmlu": mmlu,
+            "humset": humset,
+            "pipeline": pipeline,
+            "compare": compare,
+            "startup": startup,
+        }
+    )
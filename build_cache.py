@@ -0,0 +1,210 @@
+import ast
+import contextvars
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+# Finished builds are kept per key, where the key covers the source
+# revision, the builder code and the builder's content-affecting args.
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "llm-research-data" / "builds"
+DEFAULT_MAX_BYTES = 50 * 2**30
+# Args that don't change the built rows, only how they're built or published.
+IGNORED_PARAMS = {
+    "output_dir",
+    "short_name",
+    "bucket_name",
+    "publish_mode",
+    "codec",
+    "num_proc",
+    "num_workers",
+    "use_cache",
+    "batch_size",
+    "shard_rows",
+}
+# Entries being stored live here until they're complete.
+STAGING = ".staging"
+
+# Set by the cached_build decorator while a builder runs, so publish_dataset
+# can store the result under the right key.
+current_build = contextvars.ContextVar("current_build", default=None)
+
+
+def _folder_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def link_tree(source, target):
+    # Hard links when possible, the cache and output dirs usually share a disk.
+    def link(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    shutil.copytree(source, target, copy_function=link)
+
+
+def source_fingerprint(source, revision=None):
+    if source is None:
+        return None
+    if os.path.exists(source):
+        # Local sources (e.g. ~/data/mmlu) are fingerprinted by file listing.
+        digest = hashlib.sha256()
+        for root, _, names in sorted(os.walk(source)):
+            for name in sorted(names):
+                stat = os.stat(os.path.join(root, name))
+                relative = os.path.relpath(os.path.join(root, name), source)
+                digest.update(f"{relative}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+    if os.environ.get("SOURCE_MIRROR_BUCKET"):
+        # Mirrored sources resolve without the Hub, missing local ones too.
+        from source_mirror import resolve
+
+        sha = resolve(source, revision)
+        if sha is not None:
+            return sha
+    try:
+        from huggingface_hub import HfApi
+
+        return HfApi().dataset_info(source, revision=revision).sha
+    except Exception as e:
+        print(f"Can't fingerprint '{source}', skipping the build cache: {e}")
+        return None
+
+
+def _imported_modules(path):
+    tree = ast.parse(Path(path).read_bytes())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            yield from (alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            yield node.module.split(".")[0]
+
+
+def repo_modules(builder):
+    # The builder's module plus the repo modules it imports, followed
+    # transitively and including imports inside functions (utils.post_process
+    # only imports dedup, contamination and packing when they're used).
+    path = Path(inspect.getmodule(builder).__file__).resolve()
+    repo = path.parent
+    found = set()
+    pending = [path]
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+        for name in _imported_modules(path):
+            dependency = repo / f"{name}.py"
+            if dependency.exists():
+                pending.append(dependency)
+    return sorted(found)
+
+
+def code_fingerprint(builder):
+    digest = hashlib.sha256()
+    for path in repo_modules(builder):
+        digest.update(f"{path.name}\n".encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def build_key(builder, source, params):
+    payload = {
+        "builder": f"{builder.__module__}.{builder.__qualname__}",
+        "code": code_fingerprint(builder),
+        "source": source,
+        "params": {k: v for k, v in sorted(params.items()) if k not in IGNORED_PARAMS},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class BuildCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+
+    def _meta_path(self, key):
+        return self.path / key / "meta.json"
+
+    def dataset_path(self, key):
+        return self.path / key / "dataset"
+
+    def _read_meta(self, key):
+        with open(self._meta_path(key)) as f:
+            return json.load(f)
+
+    def _write_meta(self, key, meta):
+        temp_path = self._meta_path(key).with_suffix(".tmp")
+        with open(temp_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(temp_path, self._meta_path(key))
+
+    def lookup(self, key):
+        if not self._meta_path(key).exists() or not self.dataset_path(key).exists():
+            return None
+        meta = self._read_meta(key)
+        meta["last_used"] = time.time()
+        self._write_meta(key, meta)
+        return meta
+
+    def store(self, key, dataset_path, version=None):
+        # Built in a staging dir and renamed into place, so concurrent builds
+        # (pipeline.py) never see, or evict, a half-stored entry.
+        staging = self.path / STAGING / f"{key}-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        link_tree(dataset_path, staging / "dataset")
+        meta = {
+            "created": time.time(),
+            "last_used": time.time(),
+            "size": _folder_size(staging / "dataset"),
+            "version": str(version) if version is not None else None,
+            "published": [],
+        }
+        with open(staging / "meta.json", "w") as f:
+            json.dump(meta, f, indent=2)
+        shutil.rmtree(self.path / key, ignore_errors=True)
+        try:
+            os.rename(staging, self.path / key)
+        except OSError:
+            # Another build stored the same key first, keep theirs.
+            shutil.rmtree(staging, ignore_errors=True)
+            meta = self._read_meta(key)
+        self.evict(keep=key)
+        return meta
+
+    def mark_published(self, key, record):
+        meta = self._read_meta(key)
+        if record not in meta["published"]:
+            meta["published"].append(record)
+            self._write_meta(key, meta)
+
+    def evict(self, keep=None):
+        # Drop least recently used builds until the cache fits in max_bytes.
+        entries = []
+        for entry in self.path.iterdir() if self.path.exists() else []:
+            if entry.name == STAGING:
+                continue
+            try:
+                entries.append((entry.name, self._read_meta(entry.name)))
+            except (OSError, ValueError):
+                shutil.rmtree(entry, ignore_errors=True)  # Incomplete entry
+        total = sum(meta["size"] for _, meta in entries)
+        for key, meta in sorted(entries, key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            print(f"Evicting cached build {key} ({meta['size'] / 2**20:.1f} MiB)")
+            shutil.rmtree(self.path / key, ignore_errors=True)
+            total -= meta["size"]
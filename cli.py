@@ -0,0 +1,89 @@
+import importlib
+import sys
+import dotenv
+
+# One entry point for every builder and transfer command:
+#   python cli.py open_instruct --streaming
+#   python cli.py download fine-tuning-research open-instruct.tar.gz dataset/open-instruct
+# A subcommand's module is imported only when it runs, so '--help' and the
+# transfer commands never load datasets, pandas or pyarrow. Every command is
+# (module, function or [functions], description); classes are instantiated,
+# so 'DatasetMover.upload' is called on a fresh DatasetMover.
+COMMANDS = {
+    "open_instruct": ("open_instruct", "split", "Build VMware/open-instruct"),
+    "text_to_sql": ("text_to_sql", "split", "Build Clinton/Text-to-sql-v1"),
+    "humset": ("humset", "split", "Build nlp-thedeep/humset"),
+    "split": ("split", "split", "Split a prompt/completion Hub dataset, e.g. tatsu-lab/alpaca"),
+    "mmlu": ("mmlu", "build", "Build MMLU from its CSV files"),
+    "batch_inference": (
+        "batch_inference",
+        ["split", "requests", "join", "get_output"],
+        "Batch inference inputs, request shards and joined outputs",
+    ),
+    "weave": ("weave", "weave", "Mix several built datasets into one by weights or budgets"),
+    "pipeline": ("pipeline", "run", "Run several builders concurrently from a jobs file"),
+    "distributed": (
+        "distributed",
+        ["run", "plan", "work", "assemble"],
+        "Build one dataset on several workers, as Parquet shards",
+    ),
+    "upload": ("utils", "DatasetMover.upload", "Archive a folder and upload it"),
+    "download": ("utils", "DatasetMover.download", "Download and extract an archive"),
+    "publish": ("utils", "DatasetMover.publish", "Publish a folder as content-addressed blobs"),
+    "fetch": ("utils", "DatasetMover.fetch", "Fetch a content-addressed dataset version"),
+    "sources": ("source_mirror", ["mirror", "hydrate", "resolve"], "Mirror raw builder sources in the bucket"),
+    "get_output": ("utils", "get_output", "Download '<short_name>-output.tar.gz'"),
+    "contamination": ("contamination", ["check", "build_index"], "Check eval sets against a train n-gram index"),
+    "inspect": ("inspect_dataset", ["info", "show", "sample", "search", "lengths"], "Look at a saved dataset"),
+    "benchmarks": (
+        "benchmarks",
+        ["codecs", "transforms", "mmlu", "humset", "pipeline", "compare", "startup"],
+        "Benchmarks and regression checks",
+    ),
+}
+
+
+def _resolve(module_name, path):
+    target = importlib.import_module(module_name)
+    for name in path.split("."):
+        if isinstance(target, type):
+            target = target()
+        target = getattr(target, name)
+    return target
+
+
+def resolve(name):
+    module_name, functions, _ = COMMANDS[name]
+    if isinstance(functions, list):
+        return {function: _resolve(module_name, function) for function in functions}
+    return _resolve(module_name, functions)
+
+
+def usage():
+    print("Usage: python cli.py <command> [arguments]    (python cli.py <command> --help for its flags)\n")
+    print("Commands:")
+    width = max(len(name) for name in COMMANDS)
+    for name, (_, functions, description) in COMMANDS.items():
+        if isinstance(functions, list):
+            description = f"{description} ({', '.join(functions)})"
+        print(f"  {name:<{width}}  {description}")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help", "help"):
+        usage()
+        return
+    name, args = argv[0], argv[1:]
+    if name not in COMMANDS:
+        print(f"Unknown command '{name}'\n")
+        usage()
+        raise SystemExit(2)
+    dotenv.load_dotenv()
+    from fire import Fire
+
+    Fire(resolve(name), command=args, name=f"cli.py {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import dotenv
+import numpy as np
+from datasets import DatasetDict, concatenate_datasets, load_from_disk
+from fire import Fire
+from dedup import _hash_strings, normalize, shingle_hashes, text_columns
+from metrics import current, timed
+from source_mirror import load_source
+
+# A Bloom filter over the word n-grams of the train split, built in one pass.
+# Every eval row is scored by the share of its n-grams found in the filter.
+# The filter is saved with the dataset, so later eval sets can be checked
+# against it without rebuilding.
+INDEX_FOLDER = "ngram_index"
+DEFAULT_NGRAM = 8
+DEFAULT_ERROR_RATE = 0.01
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_BATCH_SIZE = 10_000
+ACTIONS = ["report", "drop", "move"]
+
+_state = {}  # Inherited by forked scoring workers
+
+
+class NgramIndex:
+    def __init__(self, bits, num_hashes, ngram, columns, seed=0, rows=0):
+        self.bits = bits  # Packed bit array, uint8
+        self.num_hashes = num_hashes
+        self.ngram = ngram
+        self.columns = columns
+        self.seed = seed
+        self.rows = rows
+        self.reports = []
+
+    @classmethod
+    def empty(cls, capacity, ngram=DEFAULT_NGRAM, columns=None, error_rate=DEFAULT_ERROR_RATE, seed=0):
+        # Standard Bloom sizing for 'capacity' n-grams at the given false positive rate.
+        capacity = max(capacity, 1)
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        num_hashes = max(1, round(size / capacity * math.log(2)))
+        bits = np.zeros((size + 7) // 8, dtype=np.uint8)
+        return cls(bits, num_hashes, ngram, columns, seed)
+
+    @property
+    def size(self):
+        return len(self.bits) * 8
+
+    def _positions(self, hashes):
+        # Double hashing: position_i = h1 + i * h2 (mod size).
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.size)
+
+    def add(self, hashes):
+        positions = np.unique(self._positions(hashes))
+        np.bitwise_or.at(
+            self.bits,
+            (positions >> np.uint64(3)).astype(np.int64),
+            (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)),
+        )
+
+    def contains(self, hashes):
+        positions = self._positions(hashes)
+        found = self.bits[(positions >> np.uint64(3)).astype(np.int64)]
+        found = found >> (positions & np.uint64(7)).astype(np.uint8) & np.uint8(1)
+        return found.all(axis=1)
+
+    def _shingles(self, table):
+        return shingle_hashes(normalize(table, self.columns), self.ngram, self.seed)
+
+    def add_table(self, table):
+        shingles, _ = self._shingles(table)
+        self.add(shingles)
+        self.rows += len(table)
+
+    def score_table(self, table):
+        # Share of every row's n-grams that were seen in train.
+        shingles, row_ids = self._shingles(table)
+        found = self.contains(shingles)
+        totals = np.bincount(row_ids, minlength=len(table))
+        hits = np.bincount(row_ids, weights=found, minlength=len(table))
+        return hits / np.maximum(totals, 1)
+
+    @classmethod
+    @timed("ngram_index")
+    def build(
+        cls,
+        dataset,
+        columns=None,
+        ngram=DEFAULT_NGRAM,
+        error_rate=DEFAULT_ERROR_RATE,
+        batch_size=DEFAULT_BATCH_SIZE,
+        seed=0,
+    ):
+        columns = text_columns(dataset, columns)
+        # Upper bound on the n-gram count: one per 4 bytes of text.
+        text_bytes = sum(dataset.data.column(column).nbytes for column in columns)
+        index = cls.empty(text_bytes // 4, ngram, columns, error_rate, seed)
+        for table in dataset.with_format("arrow").iter(batch_size=batch_size):
+            index.add_table(table)
+        current().rows_in = index.rows
+        return index
+
+    @timed("contamination_score")
+    def score(self, dataset, batch_size=DEFAULT_BATCH_SIZE, num_proc=None):
+        current().rows_in = len(dataset)
+        batches = [(start, min(start + batch_size, len(dataset))) for start in range(0, len(dataset), batch_size)]
+        _state.update(index=self, dataset=dataset)
+        try:
+            if num_proc and num_proc > 1 and len(batches) > 1:
+                # Forked workers share the filter and the memory-mapped dataset.
+                context = multiprocessing.get_context("fork")
+                with ProcessPoolExecutor(num_proc, mp_context=context) as executor:
+                    scores = list(executor.map(_score_batch, *zip(*batches)))
+            else:
+                scores = [_score_batch(start, stop) for start, stop in batches]
+        finally:
+            _state.clear()
+        return np.concatenate(scores) if scores else np.zeros(0)
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.bits.tofile(os.path.join(folder, "bloom.bin"))
+        with open(os.path.join(folder, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "size": self.size,
+                    "num_hashes": self.num_hashes,
+                    "ngram": self.ngram,
+                    "columns": self.columns,
+                    "seed": self.seed,
+                    "rows": self.rows,
+                },
+                f,
+                indent=2,
+            )
+        if self.reports:
+            with open(os.path.join(folder, "report.json"), "w") as f:
+                json.dump(self.reports, f, indent=2)
+
+    def save_with(self, dataset_path):
+        self.save(os.path.join(dataset_path, INDEX_FOLDER))
+
+    @classmethod
+    def load(cls, folder):
+        with open(os.path.join(folder, "index.json")) as f:
+            meta = json.load(f)
+        # Memory-mapped, checking an eval set only touches the pages it needs.
+        bits = np.memmap(os.path.join(folder, "bloom.bin"), dtype=np.uint8, mode="r")
+        return cls(bits, meta["num_hashes"], meta["ngram"], meta["columns"], meta["seed"], meta["rows"])
+
+
+def _score_batch(start, stop):
+    table = _state["dataset"].with_format("arrow")[start:stop]
+    return _state["index"].score_table(table)
+
+
+def split_report(name, dataset, scores, threshold, columns, examples=3):
+    contaminated = np.flatnonzero(scores >= threshold)
+    report = {
+        "split": name,
+        "rows": len(dataset),
+        "contaminated": len(contaminated),
+        "share": len(contaminated) / max(len(dataset), 1),
+        "mean_overlap": float(scores.mean()) if len(scores) else 0.0,
+        "examples": [],
+    }
+    for row in contaminated[np.argsort(-scores[contaminated], kind="stable")][:examples]:
+        text = " | ".join(str(dataset[int(row)][column]) for column in columns)
+        report["examples"].append(
+            {"row": int(row), "overlap": float(scores[row]), "text": " ".join(text.split())[:120]}
+        )
+    return report
+
+
+def print_report(reports):
+    for report in reports:
+        print(
+            f"Split {report['split']}: {report['contaminated']} of {report['rows']} rows "
+            f"({report['share']:.1%}) overlap with train, mean n-gram overlap {report['mean_overlap']:.1%}"
+        )
+        for example in report["examples"]:
+            print(f"  row {example['row']} ({example['overlap']:.0%}): {example['text']}")
+
+
+def _new_rows(moved, train, columns, batch_size=DEFAULT_BATCH_SIZE):
+    # Moved rows train already holds (same normalized text), or that repeat
+    # an earlier moved row, aren't appended again. Train is scanned in
+    # batches against the few moved hashes.
+    hashes = _hash_strings(normalize(moved.with_format("arrow")[:], columns), 0)
+    _, first = np.unique(hashes, return_index=True)
+    keep = np.zeros(len(moved), dtype=bool)
+    keep[first] = True
+    for table in train.with_format("arrow").iter(batch_size=batch_size):
+        keep &= ~np.isin(hashes, _hash_strings(normalize(table, columns), 0))
+    if not keep.all():
+        print(f"{(~keep).sum()} of {len(moved)} moved rows are already in train, not adding them again")
+    return moved.select(np.flatnonzero(keep))
+
+
+def check_splits(
+    dataset_dict,
+    action="report",
+    train_split="train",
+    threshold=DEFAULT_THRESHOLD,
+    ngram=DEFAULT_NGRAM,
+    columns=None,
+    num_proc=None,
+    index=None,
+):
+    # Scores every split against the train split's n-grams. 'drop' removes
+    # contaminated eval rows, 'move' moves them into train unless train
+    # already holds them.
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown contamination action '{action}', expected one of {ACTIONS}")
+    if index is None:
+        index = NgramIndex.build(dataset_dict[train_split], columns, ngram)
+    splits = dict(dataset_dict)
+    reports = []
+    moved = []
+    for name, dataset in dataset_dict.items():
+        if name == train_split:
+            continue
+        scores = index.score(dataset, num_proc=num_proc)
+        reports.append(split_report(name, dataset, scores, threshold, index.columns))
+        contaminated = scores >= threshold
+        if action != "report" and contaminated.any():
+            splits[name] = dataset.select(np.flatnonzero(~contaminated))
+            if action == "move":
+                moved.append(dataset.select(np.flatnonzero(contaminated)))
+    if moved:
+        moved = _new_rows(concatenate_datasets(moved), splits[train_split], index.columns)
+        splits[train_split] = concatenate_datasets([splits[train_split], moved])
+    print_report(reports)
+    index.reports = reports
+    return DatasetDict(splits), index, reports
+
+
+def check(dataset_path, eval_dataset, split="test", threshold=DEFAULT_THRESHOLD, num_proc=None, output=None):
+    # Checks a later eval set (a Hub dataset or a saved dataset folder)
+    # against the index published with a dataset.
+    index = NgramIndex.load(os.path.join(dataset_path, INDEX_FOLDER))
+    if os.path.exists(os.path.join(eval_dataset, "dataset_info.json")):
+        dataset = load_from_disk(eval_dataset)
+    elif os.path.exists(os.path.join(eval_dataset, "dataset_dict.json")):
+        dataset = load_from_disk(eval_dataset)[split]
+    else:
+        dataset = load_source(eval_dataset, split=split)
+    scores = index.score(dataset, num_proc=num_proc)
+    report = split_report(split, dataset, scores, threshold, index.columns)
+    print_report([report])
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def build_index(dataset_path, train_split="train", ngram=DEFAULT_NGRAM, columns=None):
+    # Indexes a dataset that was published without one.
+    index = NgramIndex.build(load_from_disk(dataset_path)[train_split], columns, ngram)
+    index.save(os.path.join(dataset_path, INDEX_FOLDER))
+    print(f"Indexed {index.rows} rows of {dataset_path} ({index.size / 8 / 2**20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    Fire({"check": check, "build_index": build_index})
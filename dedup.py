@@ -0,0 +1,315 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import DatasetDict, concatenate_datasets
+from metrics import current, timed
+from splitter import _hash_key
+
+# Exact duplicates are found from a 64-bit hash of the normalized text. Near
+# duplicates come from MinHash signatures of word n-grams, bucketed with LSH
+# bands; candidates in a bucket are confirmed by their estimated Jaccard
+# similarity and merged with a union-find. Hashes and signatures live in
+# memory-mapped arrays, so memory stays bounded on tens of millions of rows.
+DEFAULT_COLUMNS = ["prompt", "completion"]
+DEFAULT_BATCH_SIZE = 10_000
+DEFAULT_NUM_PERM = 128
+DEFAULT_BANDS = 16
+DEFAULT_NGRAM = 5
+DEFAULT_THRESHOLD = 0.8
+# Caps the (shingles x permutations) block hashed at once.
+MAX_BLOCK = 8 * 2**20
+MIX = np.uint64(0x9E3779B97F4A7C15)
+
+_state = {}  # Inherited by forked signature workers
+
+
+def text_columns(dataset, columns=None):
+    if columns:
+        return [columns] if isinstance(columns, str) else list(columns)
+    if all(column in dataset.column_names for column in DEFAULT_COLUMNS):
+        return DEFAULT_COLUMNS
+    return [
+        name
+        for name, feature in dataset.features.items()
+        if getattr(feature, "dtype", None) == "string"
+    ]
+
+
+def normalize(table, columns):
+    # Lowercase, collapse whitespace and join the columns.
+    values = [pc.fill_null(table[column], "") for column in columns]
+    text = pc.binary_join_element_wise(*values, "\n")
+    text = pc.replace_substring_regex(pc.utf8_lower(text), pattern=r"\s+", replacement=" ")
+    return pc.utf8_trim_whitespace(text)
+
+
+def _hash_strings(values, seed):
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        values = values.to_numpy(zero_copy_only=False)
+    return pd.util.hash_array(values, hash_key=_hash_key(seed), categorize=False)
+
+
+def shingle_hashes(text, ngram, seed):
+    # Hashes of the word n-grams of every row, plus the row each belongs to.
+    # Rows shorter than 'ngram' words get a single shingle of all their words.
+    tokens = pc.split_pattern(text, pattern=" ")
+    if isinstance(tokens, pa.ChunkedArray):
+        tokens = tokens.combine_chunks()
+    offsets = tokens.offsets.to_numpy().astype(np.int64)
+    offsets -= offsets[0]
+    lengths = np.diff(offsets)
+    token_hashes = np.concatenate(
+        [_hash_strings(tokens.flatten(), seed), np.zeros(ngram, dtype=np.uint64)]
+    )
+    row_ids = np.repeat(np.arange(len(lengths)), lengths)
+    row_ends = offsets[1:][row_ids]
+    positions = np.arange(len(row_ids))
+
+    shingles = np.zeros(len(row_ids), dtype=np.uint64)
+    for k in range(ngram):
+        inside = positions + k < row_ends
+        mixed = token_hashes[positions + k] * (MIX + np.uint64(2 * k))
+        shingles ^= np.where(inside, mixed, np.uint64(0))
+    valid = (positions + ngram <= row_ends) | (positions == offsets[:-1][row_ids])
+    return shingles[valid], row_ids[valid]
+
+
+def _permutations(num_perm, seed):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash(shingles, row_ids, rows, a, b):
+    # Multiply-shift hashing, the top 32 bits of (a * x + b) mod 2**64.
+    starts = np.searchsorted(row_ids, np.arange(rows))
+    signatures = np.empty((rows, len(a)), dtype=np.uint32)
+    step = max(1, MAX_BLOCK // max(len(shingles), 1))
+    for first in range(0, len(a), step):
+        last = min(first + step, len(a))
+        values = shingles[:, None] * a[None, first:last] + b[None, first:last]
+        signatures[:, first:last] = np.minimum.reduceat(values >> np.uint64(32), starts, axis=0)
+    return signatures
+
+
+def _signature_batch(start, stop):
+    dataset, columns, work_dir, rows, params = (
+        _state["dataset"],
+        _state["columns"],
+        _state["work_dir"],
+        _state["rows"],
+        _state["params"],
+    )
+    table = dataset.with_format("arrow")[start:stop]
+    text = normalize(table, columns)
+    hashes = np.memmap(os.path.join(work_dir, "hashes.u64"), np.uint64, "r+", shape=(rows,))
+    hashes[start:stop] = _hash_strings(text, params["seed"])
+    hashes.flush()
+    if params["near"]:
+        shingles, row_ids = shingle_hashes(text, params["ngram"], params["seed"])
+        signatures = np.memmap(
+            os.path.join(work_dir, "signatures.u32"),
+            np.uint32,
+            "r+",
+            shape=(rows, params["num_perm"]),
+        )
+        signatures[start:stop] = minhash(shingles, row_ids, stop - start, *params["perms"])
+        signatures.flush()
+
+
+def _find(parent):
+    # Full path compression, every entry ends up pointing at its root.
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent = grand
+
+
+def _union(parent, a, b):
+    # Hooks the larger root under the smaller one until all pairs agree, so
+    # every cluster is rooted at its first row.
+    while True:
+        parent = _find(parent)
+        root_a, root_b = parent[a], parent[b]
+        differ = root_a != root_b
+        if not differ.any():
+            return parent
+        np.minimum.at(
+            parent,
+            np.maximum(root_a, root_b)[differ],
+            np.minimum(root_a, root_b)[differ],
+        )
+
+
+def _band_hashes(signatures, rows, columns, chunk_rows):
+    band = np.empty(len(rows), dtype=np.uint64)
+    for start in range(0, len(rows), chunk_rows):
+        block = np.asarray(signatures[:, columns][rows[start : start + chunk_rows]], dtype=np.uint64)
+        folded = np.zeros(len(block), dtype=np.uint64)
+        for column in range(block.shape[1]):
+            folded = (folded ^ block[:, column]) * MIX
+        band[start : start + chunk_rows] = folded
+    return band
+
+
+def _near_duplicates(signatures, rows, num_perm, bands, threshold, chunk_rows=1_000_000):
+    # rows: the dataset rows left after exact dedup. Returns a root per row,
+    # as positions into 'rows'.
+    parent = np.arange(len(rows))
+    width = num_perm // bands
+    for band in range(bands):
+        band_hashes = _band_hashes(signatures, rows, slice(band * width, (band + 1) * width), chunk_rows)
+        order = np.argsort(band_hashes, kind="stable")
+        ordered = band_hashes[order]
+        same = np.flatnonzero(ordered[1:] == ordered[:-1]) + 1
+        if not len(same):
+            continue
+        # Pair every bucket member with the first member of its bucket.
+        bucket_start = np.maximum.accumulate(
+            np.where(np.r_[True, ordered[1:] != ordered[:-1]], np.arange(len(ordered)), 0)
+        )
+        a, b = order[bucket_start[same]], order[same]
+        parent = _find(parent)
+        pending = parent[a] != parent[b]
+        a, b = a[pending], b[pending]
+        confirmed = np.zeros(len(a), dtype=bool)
+        for start in range(0, len(a), chunk_rows):
+            left = signatures[rows[a[start : start + chunk_rows]]]
+            right = signatures[rows[b[start : start + chunk_rows]]]
+            confirmed[start : start + chunk_rows] = (left == right).mean(axis=1) >= threshold
+        if confirmed.any():
+            parent = _union(parent, a[confirmed], b[confirmed])
+    return _find(parent)
+
+
+@timed("dedup")
+def find_duplicates(
+    dataset,
+    columns=None,
+    near=True,
+    threshold=DEFAULT_THRESHOLD,
+    num_perm=DEFAULT_NUM_PERM,
+    bands=DEFAULT_BANDS,
+    ngram=DEFAULT_NGRAM,
+    batch_size=DEFAULT_BATCH_SIZE,
+    num_proc=None,
+    work_dir=None,
+    seed=0,
+):
+    # Returns the indices of the rows to keep (the first row of every
+    # cluster, in order) and a report.
+    if num_perm % bands:
+        raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands})")
+    columns = text_columns(dataset, columns)
+    rows = len(dataset)
+    current().rows_in = rows
+    work_dir = tempfile.mkdtemp(prefix="dedup-", dir=work_dir)
+    try:
+        hashes = np.memmap(os.path.join(work_dir, "hashes.u64"), np.uint64, "w+", shape=(max(rows, 1),))
+        signatures = None
+        if near:
+            signatures = np.memmap(
+                os.path.join(work_dir, "signatures.u32"), np.uint32, "w+", shape=(max(rows, 1), num_perm)
+            )
+        _state.update(
+            dataset=dataset,
+            columns=columns,
+            work_dir=work_dir,
+            rows=max(rows, 1),
+            params={
+                "near": near,
+                "ngram": ngram,
+                "num_perm": num_perm,
+                "perms": _permutations(num_perm, seed),
+                "seed": seed,
+            },
+        )
+        batches = [(start, min(start + batch_size, rows)) for start in range(0, rows, batch_size)]
+        if num_proc and num_proc > 1 and len(batches) > 1:
+            # Forked workers inherit the dataset and write into the shared arrays.
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(num_proc, mp_context=context) as executor:
+                list(executor.map(_signature_batch, *zip(*batches)))
+        else:
+            for start, stop in batches:
+                _signature_batch(start, stop)
+        _state.clear()
+
+        _, unique = np.unique(hashes[:rows], return_index=True)
+        unique.sort()
+        report = {
+            "rows_in": rows,
+            "exact_duplicates": rows - len(unique),
+            "near_duplicates": 0,
+            "near_clusters": 0,
+            "largest_clusters": [],
+        }
+        keep = unique
+        if near and len(unique):
+            roots = _near_duplicates(signatures, unique, num_perm, bands, threshold)
+            keep = unique[roots == np.arange(len(unique))]
+            sizes = np.bincount(roots, minlength=len(unique))
+            clustered = np.flatnonzero(sizes > 1)
+            report["near_duplicates"] = len(unique) - len(keep)
+            report["near_clusters"] = len(clustered)
+            largest = clustered[np.argsort(-sizes[clustered], kind="stable")[:5]]
+            report["largest_clusters"] = [
+                {"row": int(unique[root]), "size": int(sizes[root])} for root in largest
+            ]
+        report["rows_out"] = len(keep)
+        current().rows_out = len(keep)
+        return keep, report
+    finally:
+        _state.clear()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(report, dataset=None, columns=None):
+    print(
+        f"Dedup kept {report['rows_out']} of {report['rows_in']} rows: "
+        f"{report['exact_duplicates']} exact duplicates, {report['near_duplicates']} near "
+        f"duplicates in {report['near_clusters']} clusters"
+    )
+    for cluster in report["largest_clusters"]:
+        example = ""
+        if dataset is not None:
+            row = dataset[cluster["row"]]
+            example = " | ".join(str(row[column]) for column in text_columns(dataset, columns))
+            example = " ".join(example.split())[:80]
+        print(f"  {cluster['size']} rows like row {cluster['row']}: {example}")
+
+
+def dedup_dataset(dataset, columns=None, near=True, **kwargs):
+    keep, report = find_duplicates(dataset, columns, near, **kwargs)
+    print_report(report, dataset, columns)
+    return dataset.select(keep), report
+
+
+def dedup_splits(dataset_dict, columns=None, near=True, **kwargs):
+    # Dedups across all splits at once, keeping the first copy in split
+    # order, so rows of later splits that repeat earlier ones are dropped.
+    names = list(dataset_dict)
+    combined = concatenate_datasets([dataset_dict[name] for name in names])
+    keep, report = find_duplicates(combined, columns, near, **kwargs)
+    print_report(report, combined, columns)
+    bounds = np.cumsum([0] + [len(dataset_dict[name]) for name in names])
+    splits = {}
+    for name, start, stop in zip(names, bounds[:-1], bounds[1:]):
+        selected = keep[(keep >= start) & (keep < stop)] - start
+        splits[name] = dataset_dict[name].select(selected)
+    return DatasetDict(splits), report
+
+
+def is_near(mode):
+    # Builder flag: --dedup=exact or --dedup=near
+    if mode not in ("exact", "near"):
+        raise ValueError(f"Unknown dedup mode '{mode}', expected 'exact' or 'near'")
+    return mode == "near"
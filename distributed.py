@@ -0,0 +1,307 @@
+import hashlib
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import dotenv
+import pyarrow.parquet as pq
+from fire import Fire
+from build_cache import code_fingerprint, source_fingerprint
+from metrics import current, stage
+from parquet_store import manifest_name, object_prefix
+from source_mirror import load_source
+from splitter import route_splits
+from streaming import DEFAULT_BATCH_SIZE, DEFAULT_SHARD_ROWS, SPLIT_ORDER, load_shards, split_routes
+from transfer import TransferManager
+
+# Builds one large dataset on several workers. The coordinator plans
+# index-range shards of the source and stores the plan in the bucket:
+#   distributed/<job>/plan.json
+# Every worker (a local process or another node) transforms its shards,
+# routes each row to train/val/test from the hash of the row, like the
+# streaming builds, and uploads one Parquet file per shard and split, then a
+# done marker with the file's stats:
+#   parquet/<short_name>/<job>/<split>/part-<shard>.parquet
+#   distributed/<job>/done/<shard>.json
+# Shards with a marker are skipped, so a rerun only redoes what's missing.
+# The coordinator assembles the markers into the 'parquet' publish mode's
+# manifest, so parquet_store.open_split/download read the result as is.
+#   python distributed.py run open_instruct --bucket_name fine-tuning-research --workers 8
+# or, across nodes:
+#   python distributed.py plan open_instruct --bucket_name ...      # prints the job
+#   python distributed.py work <job> --worker 3 --workers 8 --bucket_name ...
+#   python distributed.py assemble <job> --bucket_name ...
+PREFIX = "distributed"
+# builder: (module with TRANSFORM, default source, default short name, train/val/test sizes)
+BUILDERS = {
+    "open_instruct": ("open_instruct", "VMware/open-instruct", None, (0.9, 0.05, 0.05)),
+    "text_to_sql": ("text_to_sql", "Clinton/Text-to-sql-v1", "text-to-sql", (0.9, 0.05, 0.05)),
+    "split": ("split", "tatsu-lab/alpaca", None, (0.75, 0.1, 0.15)),
+}
+DEFAULT_RETRIES = 2
+
+
+def _plan_name(job):
+    return f"{PREFIX}/{job}/plan.json"
+
+
+def _done_name(job, index):
+    return f"{PREFIX}/{job}/done/{index:05d}.json"
+
+
+def _get_json(transfers, bucket_name, object_name):
+    def fetch():
+        response = transfers.client.get_object(bucket_name, object_name)
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+
+    return transfers.retry(fetch)
+
+
+def _put_json(transfers, bucket_name, object_name, value):
+    body = json.dumps(value, indent=2).encode()
+    transfers.retry(
+        transfers.client.put_object,
+        bucket_name,
+        object_name,
+        io.BytesIO(body),
+        len(body),
+        content_type="application/json",
+    )
+
+
+def _module(builder):
+    if builder not in BUILDERS:
+        raise ValueError(f"Unknown builder '{builder}', expected one of {list(BUILDERS)}")
+    return importlib.import_module(BUILDERS[builder][0])
+
+
+def plan(
+    builder,
+    bucket_name="fine-tuning-research",
+    dataset_name=None,
+    short_name=None,
+    revision=None,
+    shard_rows=DEFAULT_SHARD_ROWS,
+    train_size=None,
+    val_size=None,
+    test_size=None,
+    split_key=None,
+    seed=0,
+):
+    module = _module(builder)
+    _, default_name, default_short_name, sizes = BUILDERS[builder]
+    dataset_name = dataset_name or default_name
+    short_name = short_name or default_short_name or dataset_name.split("/")[-1]
+    sizes = [size if size is not None else default for size, default in zip((train_size, val_size, test_size), sizes)]
+    # Also prepares the Arrow cache that local workers load from.
+    with stage("load") as loaded:
+        source = load_source(dataset_name, revision=revision)
+        loaded.rows_out = sum(source.num_rows.values())
+    routes = split_routes(list(source), *sizes)
+    shards = []
+    for source_split in routes:
+        rows = len(source[source_split])
+        for start in range(0, rows, shard_rows):
+            shards.append(
+                {"index": len(shards), "source_split": source_split, "start": start, "end": min(start + shard_rows, rows)}
+            )
+    spec = {
+        "builder": builder,
+        "dataset_name": dataset_name,
+        "revision": revision,
+        "short_name": short_name,
+        "routes": routes,
+        "split_key": split_key,
+        "seed": seed,
+        "shards": shards,
+    }
+    # Named after the source, code and plan, so planning the same build again
+    # resumes it instead of starting over.
+    fingerprint = {
+        "spec": spec,
+        "source": source_fingerprint(dataset_name, revision),
+        "code": [code_fingerprint(module.split), code_fingerprint(plan)],
+    }
+    spec["job"] = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+    transfers = TransferManager.shared()
+    if not transfers.exists(bucket_name, _plan_name(spec["job"])):
+        _put_json(transfers, bucket_name, _plan_name(spec["job"]), spec)
+    print(f"Planned job {spec['job']}: {len(shards)} shards of {dataset_name} ({short_name})")
+    return spec["job"]
+
+
+def _build_shard(spec, shard, source, transform, bucket_name, work_dir, batch_size):
+    # Transforms and routes one index range, one Parquet row group per batch.
+    job = spec["job"]
+    index = shard["index"]
+    with stage("shard", job=job, shard=index) as built:
+        dataset = source[shard["source_split"]].with_format("arrow")
+        ratios = spec["routes"][shard["source_split"]]
+
+        def tables():
+            for start in range(shard["start"], shard["end"], batch_size):
+                yield transform(dataset[start : min(start + batch_size, shard["end"])])
+
+        writers = {}
+        for split, table in route_splits(tables(), ratios, spec["split_key"], spec["seed"]):
+            if split not in writers:
+                path = os.path.join(work_dir, job, split, f"part-{index:05d}.parquet")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writers[split] = (path, pq.ParquetWriter(f"{path}.tmp", table.schema, compression="zstd"))
+            path, writer = writers[split]
+            writer.write_table(table.cast(writer.schema))
+
+        batch = []
+        files = {}
+        prefix = object_prefix(spec["short_name"], job)
+        for split, (path, writer) in writers.items():
+            writer.close()
+            os.replace(f"{path}.tmp", path)
+            metadata = pq.ParquetFile(path).metadata
+            files[split] = {
+                "object": f"{prefix}/{split}/{os.path.basename(path)}",
+                "rows": metadata.num_rows,
+                "row_groups": metadata.num_row_groups,
+                "size": os.path.getsize(path),
+            }
+            batch.append((bucket_name, files[split]["object"], path))
+        transfers = TransferManager.shared()
+        current().add_bytes(sum(transfers.upload_files(batch)))
+        # The marker goes last: a shard is done once its files are all up.
+        _put_json(transfers, bucket_name, _done_name(job, index), files)
+        built.rows_in = shard["end"] - shard["start"]
+        built.rows_out = sum(entry["rows"] for entry in files.values())
+
+
+def work(job, worker=0, workers=1, bucket_name="fine-tuning-research", work_dir="builds", retries=DEFAULT_RETRIES, batch_size=DEFAULT_BATCH_SIZE):
+    # Builds the shards with index % workers == worker that aren't done yet and
+    # returns the ones that still failed after the retries.
+    transfers = TransferManager.shared()
+    spec = _get_json(transfers, bucket_name, _plan_name(job))
+    transform = getattr(_module(spec["builder"]), "TRANSFORM", None) or (lambda table: table)
+    source = None
+    failed = []
+    for shard in spec["shards"]:
+        index = shard["index"]
+        if index % workers != worker or transfers.exists(bucket_name, _done_name(job, index)):
+            continue
+        if source is None:
+            source = load_source(spec["dataset_name"], revision=spec["revision"])
+        for attempt in range(retries + 1):
+            try:
+                _build_shard(spec, shard, source, transform, bucket_name, work_dir, batch_size)
+                print(f"[worker {worker}] Shard {index} done")
+                break
+            except Exception as e:
+                print(f"[worker {worker}] Shard {index} failed (attempt {attempt + 1} of {retries + 1}): {e!r}")
+        else:
+            failed.append(index)
+    return failed
+
+
+def assemble(job, bucket_name="fine-tuning-research"):
+    # Writes the manifest from the done markers; the shard data stays put.
+    transfers = TransferManager.shared()
+    spec = _get_json(transfers, bucket_name, _plan_name(job))
+    missing = [shard["index"] for shard in spec["shards"] if not transfers.exists(bucket_name, _done_name(job, shard["index"]))]
+    if missing:
+        raise RuntimeError(f"{len(missing)} shards of job {job} aren't done: {missing[:20]}")
+    splits = {}
+    for shard in spec["shards"]:
+        for split, entry in _get_json(transfers, bucket_name, _done_name(job, shard["index"])).items():
+            splits.setdefault(split, {"rows": 0, "files": []})
+            splits[split]["rows"] += entry["rows"]
+            splits[split]["files"].append(entry)
+    order = sorted(splits, key=lambda s: SPLIT_ORDER.index(s) if s in SPLIT_ORDER else len(SPLIT_ORDER))
+    manifest = {
+        "format": "parquet",
+        "short_name": spec["short_name"],
+        "version": job,
+        "splits": {split: splits[split] for split in order},
+        "extra": [],
+        "source": spec["dataset_name"],
+        "job": job,
+    }
+    for name in [manifest_name(spec["short_name"], job), manifest_name(spec["short_name"])]:
+        _put_json(transfers, bucket_name, name, manifest)
+    print(
+        f"Assembled job {job}: "
+        + ", ".join(f"{split} {entry['rows']} rows in {len(entry['files'])} files" for split, entry in manifest["splits"].items())
+    )
+    return manifest
+
+
+def _work(args):
+    dotenv.load_dotenv()
+    return work(*args)
+
+
+def run(
+    builder,
+    bucket_name="fine-tuning-research",
+    workers=None,
+    dataset_name=None,
+    short_name=None,
+    revision=None,
+    shard_rows=DEFAULT_SHARD_ROWS,
+    train_size=None,
+    val_size=None,
+    test_size=None,
+    split_key=None,
+    seed=0,
+    work_dir="builds",
+    retries=DEFAULT_RETRIES,
+    rounds=2,
+    batch_size=DEFAULT_BATCH_SIZE,
+):
+    # Coordinator and N local worker processes in one command.
+    start = time.perf_counter()
+    workers = workers or os.cpu_count()
+    job = plan(
+        builder, bucket_name, dataset_name, short_name, revision, shard_rows, train_size, val_size, test_size, split_key, seed
+    )
+    for attempt in range(rounds):
+        failed = []
+        # Spawned, not forked: TransferManager holds threads and connections.
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [
+                pool.submit(_work, (job, worker, workers, bucket_name, work_dir, retries, batch_size))
+                for worker in range(workers)
+            ]
+            for worker, future in enumerate(futures):
+                try:
+                    failed += future.result()
+                except Exception as e:
+                    print(f"[worker {worker}] Died: {e!r}")
+                    failed.append(f"worker {worker}")
+        if not failed:
+            break
+        print(f"Round {attempt + 1} of {rounds}: {len(failed)} shards or workers failed")
+    manifest = assemble(job, bucket_name)
+    print(f"Built job {job} with {workers} workers in {time.perf_counter() - start:.1f}s")
+
+    # The workers wrote every shard under work_dir, so the result loads from
+    # there; shards done by an earlier run on other machines aren't local.
+    shard_files = {
+        split: [os.path.join(work_dir, job, split, os.path.basename(entry["object"])) for entry in split_entry["files"]]
+        for split, split_entry in manifest["splits"].items()
+    }
+    if all(os.path.exists(path) for files in shard_files.values() for path in files):
+        return load_shards(shard_files)
+    print(
+        f"Not every shard is in '{work_dir}', load it with "
+        f"parquet_store.download('{bucket_name}', '{manifest['short_name']}', ...)"
+    )
+    return None
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    Fire({"plan": plan, "work": work, "assemble": assemble, "run": run})
@@ -1,65 +1,170 @@
-from collections import OrderedDict
-import shutil
-from pathlib import Path
-import os
-from datasets import Dataset, DatasetDict, DatasetInfo
-from datasets import load_dataset
+import json
+import numpy as np
+from datasets import DatasetDict, DatasetInfo
 from fire import Fire
 from numpy import dot, short
-from utils import DatasetMover
+from streaming import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_SHARD_ROWS,
+    iter_tables,
+    stream_build,
+)
+from metrics import stage
+from transforms import Pipeline
+from source_mirror import load_source
+from utils import cached_build, post_process, publish_dataset
 import dotenv
-from tqdm import tqdm
-import json
+import pyarrow as pa
+import pyarrow.compute as pc
 
 dotenv.load_dotenv()
 
+SPLITS = {"train": "train", "validation": "val", "test": "test"}
+LABEL_COLUMNS = {"sectors": ["sectors"], "pillars": ["pillars_1d", "pillars_2d"]}
+PROMPT = ("Classify the sectors and pillars for this excerpt:\n", "\n\nClasses:")
 
-def split(
-    dataset_name="nlp-thedeep/humset",
-    output_dir="dataset",
-    short_name="humset",
-    bucket_name="fine-tuning-research",
-):
-    print(f"Loading {dataset_name}")
-    splits = {}
-    all_sectors = set()
-    all_pillars = set()
-    for split in ["train", "validation", "test"]:  #
-        print(f"Building for {split}")
-        new_rows = []
-        dataset_split = load_dataset(dataset_name, split=split)
-        for row in tqdm(dataset_split):
-            text = row["excerpt"].strip()
-            all_sectors.update(row["sectors"])
-            pillars = row["pillars_1d"]
-            pillars.extend(row["pillars_2d"])
-            all_pillars.update(pillars)
-            new_rows.append(
-                {"text": text, "sectors": row["sectors"], "pillars": pillars}
+
+def label_vocabulary(tables):
+    # Distinct labels from Arrow unique kernels, sorted so the label order
+    # (and every completion) is the same on every run.
+    labels = {group: set() for group in LABEL_COLUMNS}
+    for table in tables:
+        for group, columns in LABEL_COLUMNS.items():
+            for column in columns:
+                labels[group].update(pc.unique(pc.list_flatten(table[column])).drop_null().to_pylist())
+    return {group: sorted(values) for group, values in labels.items()}
+
+
+def multi_hot(table, columns, labels):
+    # (rows, labels) bool matrix, set in one scatter over the flattened lists.
+    matrix = np.zeros((len(table), len(labels)), dtype=bool)
+    value_set = pa.array(labels, pa.string())
+    for column in columns:
+        values = table[column].combine_chunks()
+        rows = pc.list_parent_indices(values).to_numpy()
+        index = pc.index_in(pc.list_flatten(values).cast(pa.string()), value_set=value_set)
+        matrix[rows, index.to_numpy(zero_copy_only=False)] = True
+    return matrix
+
+
+class Render:
+    # Renders a batch into prompt/completion columns. The completion is
+    # json.dumps({"sectors": {label: bool}, "pillars": {label: bool}}, indent=2)
+    # byte for byte, built from per-label lines precompiled for both values.
+    def __init__(self, labels, keep_multi_hot=False):
+        self.labels = labels
+        self.keep_multi_hot = keep_multi_hot
+        self.lines = {
+            group: [
+                (f"    {json.dumps(label)}: false", f"    {json.dumps(label)}: true")
+                for label in group_labels
+            ]
+            for group, group_labels in labels.items()
+        }
+
+    def _block(self, group, matrix):
+        # '"sectors": {\n    "A": true,\n    "B": false\n  }' for every row.
+        if not self.lines[group]:
+            return pa.scalar(f"  {json.dumps(group)}: {{}}")
+        lines = [
+            pc.if_else(pa.array(matrix[:, i]), true, false)
+            for i, (false, true) in enumerate(self.lines[group])
+        ]
+        block = pc.binary_join_element_wise(*lines, ",\n")
+        return pc.binary_join_element_wise(f"  {json.dumps(group)}: {{\n", block, "\n  }", "")
+
+    def __call__(self, table):
+        matrices = {
+            group: multi_hot(table, LABEL_COLUMNS[group], self.labels[group]) for group in LABEL_COLUMNS
+        }
+        prompt = pc.binary_join_element_wise(
+            PROMPT[0], pc.utf8_trim_whitespace(table["excerpt"]), PROMPT[1], ""
+        )
+        blocks = pc.binary_join_element_wise(
+            *[self._block(group, matrices[group]) for group in LABEL_COLUMNS], ",\n"
+        )
+        completion = pc.binary_join_element_wise("\n{\n", blocks, "\n}", "")
+        # An all-scalar join (no labels at all) gives a scalar, not a column.
+        if isinstance(completion, pa.Scalar):
+            completion = pa.array([completion.as_py()] * len(table), pa.string())
+        columns = {"prompt": prompt, "completion": completion}
+        if self.keep_multi_hot:
+            # Sectors then pillars, in the sorted vocabulary order, for non-LLM baselines.
+            matrix = np.concatenate([matrices[group] for group in LABEL_COLUMNS], axis=1)
+            columns["multi_hot"] = pa.FixedSizeListArray.from_arrays(
+                pa.array(matrix.ravel()), matrix.shape[1]
             )
-        if split == "validation":
-            split = "val"
+        return pa.table(columns)
 
-        splits[split] = new_rows
 
-    print("Building llm dataset")
-    final_splits = {}
-    for split in splits.keys():
-        rows = splits[split]
-        final_rows = []
-        for row in tqdm(rows):
-            sectors = OrderedDict({k: k in row["sectors"] for k in all_sectors})
-            pillars = OrderedDict({k: k in row["pillars"] for k in all_pillars})
-            prompt = f"""Classify the sectors and pillars for this excerpt:
-{row['text']}
+def stream_splits(dataset_name, output_path, batch_size, shard_rows, keep_multi_hot=False):
+    source = {
+        split: load_source(dataset_name, split=split, streaming=True)
+        for split in SPLITS
+    }
+    # The label vocabulary must be complete before any row is rendered, so
+    # the source is streamed twice: once for the labels, once to render.
+    def tables():
+        for split, dataset_split in source.items():
+            print(f"Collecting labels for {split}")
+            yield from iter_tables(dataset_split, batch_size)
+
+    labels = label_vocabulary(tables())
+    routes = {split: {name: 1.0} for split, name in SPLITS.items()}
+    splits = stream_build(
+        source,
+        Render(labels, keep_multi_hot),
+        output_path,
+        routes,
+        batch_size=batch_size,
+        shard_rows=shard_rows,
+    )
+    return splits, labels
 
-Classes:"""
-            completion = f"""
-{json.dumps({"sectors": sectors, "pillars": pillars}, indent=2)}"""
 
-            final_rows.append({"prompt": prompt, "completion": completion})
+def build_splits(dataset_name, num_proc=None, keep_multi_hot=False):
+    print(f"Loading {dataset_name}")
+    source = {}
+    for split, name in SPLITS.items():
+        with stage("load", split=split) as loaded:
+            source[name] = load_source(dataset_name, split=split)
+            loaded.rows_out = len(source[name])
+    labels = label_vocabulary(dataset.data.table for dataset in source.values())
+
+    print("Building llm dataset")
+    render = Pipeline(Render(labels, keep_multi_hot))
+    final_splits = {
+        split: render.apply(dataset, num_proc=num_proc, remove_columns=dataset.column_names)
+        for split, dataset in source.items()
+    }
+    return final_splits, labels
 
-        final_splits[split] = Dataset.from_list(final_rows)
+
+@cached_build()
+def split(
+    dataset_name="nlp-thedeep/humset",
+    output_dir="dataset",
+    short_name="humset",
+    bucket_name="fine-tuning-research",
+    publish_mode="tarball",
+    streaming=False,
+    batch_size=DEFAULT_BATCH_SIZE,
+    shard_rows=DEFAULT_SHARD_ROWS,
+    num_proc=None,
+    multi_hot=False,
+    dedup=None,
+    contamination=None,
+    tokenizer_path=None,
+    pack_length=None,
+    use_cache=True,
+):
+    if streaming:
+        print(f"Streaming {dataset_name}")
+        final_splits, labels = stream_splits(
+            dataset_name, f"{output_dir}/{short_name}-shards", batch_size, shard_rows, multi_hot
+        )
+    else:
+        final_splits, labels = build_splits(dataset_name, num_proc, multi_hot)
 
     print(f"Converting {dataset_name} and splitting it into train/val/test")
     for split in final_splits:
@@ -69,26 +174,26 @@ Classes:"""
             break
 
     combined = DatasetDict(final_splits)
+    combined, index = post_process(combined, dedup, contamination, tokenizer_path, pack_length, num_proc)
+    description = f"Contains data from {dataset_name} into completions format"
+    if multi_hot:
+        description += f". multi_hot has one entry per label, sectors then pillars: {json.dumps(labels)}"
     dataset_info = DatasetInfo(
-        description=f"Contains data from {dataset_name} into completions format",
+        description=description,
         version="0.0.1",
     )
     for split, dataset in combined.items():
         dataset.dataset_info = dataset_info
 
-    current_directory = Path(".")
-    shutil.rmtree(current_directory / output_dir, ignore_errors=True)
-    os.mkdir(current_directory / output_dir)
-    dataset_path = (current_directory / output_dir / short_name).as_posix()
-    combined.save_to_disk(dataset_path)
-
-    # Compress the folder
-    print(f"Compressing the folder {current_directory / output_dir/ short_name}")
-    folder_to_compress = (current_directory / output_dir / short_name).as_posix()
-    output_tar_file = f"{short_name}.tar.gz"
-    print(f"Uploading {output_tar_file} to {bucket_name}")
-    dataset_mover = DatasetMover()
-    dataset_mover.upload(folder_to_compress, output_tar_file, bucket_name)
+    publish_dataset(
+        combined,
+        output_dir,
+        short_name,
+        bucket_name,
+        publish_mode=publish_mode,
+        version=dataset_info.version,
+        index=index,
+    )
 
 
 if __name__ == "__main__":
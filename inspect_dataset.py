@@ -0,0 +1,199 @@
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import load_from_disk
+from fire import Fire
+
+# Looks at saved datasets without loading them: load_from_disk memory-maps
+# the Arrow files, pages are sliced out by row position, and sampling,
+# search and length histograms stream record batches, so memory stays flat
+# however large the split is. The same Inspector works in a notebook:
+#   inspector = Inspector("dataset/open-instruct", "test")
+#   inspector.page(3).to_pandas()
+DEFAULT_COLUMNS = ["prompt", "completion"]
+DEFAULT_BATCH_SIZE = 10_000
+DEFAULT_PAGE_SIZE = 10
+DEFAULT_BINS = 20
+DEFAULT_WIDTH = 500
+
+
+def open_split(dataset_path, split=None):
+    dataset = load_from_disk(dataset_path)
+    if not hasattr(dataset, "keys"):
+        return dataset
+    if split is None:
+        split = next(iter(dataset))
+    if split not in dataset:
+        raise ValueError(f"Unknown split '{split}', expected one of {list(dataset)}")
+    return dataset[split]
+
+
+def _lengths(column):
+    # Characters for strings, items for lists, bytes for binary, None otherwise.
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        return pc.utf8_length(column)
+    if pa.types.is_binary(column.type) or pa.types.is_large_binary(column.type):
+        return pc.binary_length(column)
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        return pc.list_value_length(column)
+    return None
+
+
+class Inspector:
+    def __init__(self, dataset_path, split=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.dataset = open_split(dataset_path, split)
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _batches(self, columns=None):
+        # (first row, table) for every batch, only the requested columns are read.
+        dataset = self.dataset.select_columns(columns) if columns else self.dataset
+        start = 0
+        for table in dataset.with_format("arrow").iter(batch_size=self.batch_size):
+            yield start, table
+            start += len(table)
+
+    def rows(self, indices, columns=None):
+        dataset = self.dataset.select_columns(columns) if columns else self.dataset
+        return dataset.with_format("arrow")[np.asarray(indices, dtype=np.int64)]
+
+    def page(self, page=0, page_size=DEFAULT_PAGE_SIZE, columns=None):
+        start = page * page_size
+        if start >= len(self) and len(self):
+            raise IndexError(f"Page {page} is past the last row ({len(self)} rows)")
+        return self.rows(range(start, min(start + page_size, len(self))), columns)
+
+    def sample(self, k=DEFAULT_PAGE_SIZE, seed=0, columns=None):
+        # Reservoir sampling over batches: every row gets a random key and the
+        # k smallest keys seen so far are kept, a uniform sample of k rows.
+        # Row numbers are in '__index__'.
+        rng = np.random.default_rng(seed)
+        keys = np.zeros(0)
+        indices = np.zeros(0, dtype=np.int64)
+        for start in range(0, len(self), self.batch_size):
+            stop = min(start + self.batch_size, len(self))
+            keys = np.concatenate([keys, rng.random(stop - start)])
+            indices = np.concatenate([indices, np.arange(start, stop)])
+            if len(keys) > k:
+                keep = np.argpartition(keys, k)[:k]
+                keys, indices = keys[keep], indices[keep]
+        indices = np.sort(indices)
+        return self.rows(indices, columns).add_column(0, "__index__", pa.array(indices, pa.int64()))
+
+    def search(self, pattern, columns=None, regex=False, ignore_case=False, limit=DEFAULT_PAGE_SIZE):
+        # Rows where any of the columns contains the pattern, with their row
+        # number in '__index__'. Stops reading after 'limit' matches.
+        columns = columns or [c for c in DEFAULT_COLUMNS if c in self.dataset.column_names]
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        match = pc.match_substring_regex if regex else pc.match_substring
+        found = []
+        for start, table in self._batches(columns):
+            hits = None
+            for column in columns:
+                hit = pc.fill_null(match(table[column], pattern=pattern, ignore_case=ignore_case), False)
+                hits = hit if hits is None else pc.or_(hits, hit)
+            found.extend(start + np.flatnonzero(hits.to_numpy(zero_copy_only=False)))
+            if limit and len(found) >= limit:
+                found = found[:limit]
+                break
+        table = self.rows(found)
+        return table.add_column(0, "__index__", pa.array(found, pa.int64()))
+
+    def lengths(self, columns=None, bins=DEFAULT_BINS):
+        # {column: {"min", "max", "mean", "edges", "counts"}} for every string,
+        # binary or list column, from two passes of Arrow length kernels.
+        columns = columns or self.dataset.column_names
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        stats = {}
+        for _, table in self._batches(columns):
+            for column in columns:
+                lengths = _lengths(table[column])
+                if lengths is None:
+                    continue
+                low, high = pc.min_max(lengths).values()
+                total = pc.sum(lengths).as_py() or 0
+                entry = stats.setdefault(column, {"min": None, "max": None, "total": 0, "rows": 0})
+                if low.as_py() is not None:
+                    entry["min"] = low.as_py() if entry["min"] is None else min(entry["min"], low.as_py())
+                    entry["max"] = high.as_py() if entry["max"] is None else max(entry["max"], high.as_py())
+                entry["total"] += total
+                entry["rows"] += len(lengths) - lengths.null_count
+        for entry in stats.values():
+            low, high = entry["min"] or 0, entry["max"] or 0
+            entry["mean"] = entry.pop("total") / max(entry.pop("rows"), 1)
+            # Whole-number bins, lengths are integers.
+            step = max(-(-(high - low + 1) // bins), 1)
+            entry["edges"] = low + step * np.arange(-(-(high - low + 1) // step) + 1)
+            entry["counts"] = np.zeros(len(entry["edges"]) - 1, dtype=np.int64)
+        for _, table in self._batches(list(stats)):
+            for column, entry in stats.items():
+                lengths = _lengths(table[column]).drop_null().to_numpy()
+                entry["counts"] += np.histogram(lengths, entry["edges"])[0]
+        return stats
+
+
+def _print_rows(table, width, index=None):
+    for row in range(len(table)):
+        number = table["__index__"][row].as_py() if "__index__" in table.column_names else index + row
+        print(f"=== row {number} " + "=" * 60)
+        for column in table.column_names:
+            if column == "__index__":
+                continue
+            value = str(table[column][row].as_py())
+            if width and len(value) > width:
+                value = value[:width] + f"... ({len(value)} chars)"
+            print(f"--- {column}:\n{value}")
+        print()
+
+
+def info(dataset_path):
+    dataset = load_from_disk(dataset_path)
+    splits = dataset.items() if hasattr(dataset, "keys") else [(None, dataset)]
+    for name, split in splits:
+        size = sum(os.path.getsize(f["filename"]) for f in split.cache_files)
+        print(f"{name or 'dataset'}: {len(split)} rows, {size / 2**20:.1f} MiB")
+        for column, feature in split.features.items():
+            print(f"  {column}: {feature}")
+
+
+def show(dataset_path, split=None, page=0, page_size=DEFAULT_PAGE_SIZE, columns=None, width=DEFAULT_WIDTH):
+    inspector = Inspector(dataset_path, split)
+    _print_rows(inspector.page(page, page_size, columns), width, page * page_size)
+    print(f"Page {page} of {-(-len(inspector) // page_size)}")
+
+
+def sample(dataset_path, split=None, k=DEFAULT_PAGE_SIZE, seed=0, columns=None, width=DEFAULT_WIDTH):
+    inspector = Inspector(dataset_path, split)
+    _print_rows(inspector.sample(k, seed, columns), width)
+
+
+def search(
+    dataset_path,
+    pattern,
+    split=None,
+    columns=None,
+    regex=False,
+    ignore_case=False,
+    limit=DEFAULT_PAGE_SIZE,
+    width=DEFAULT_WIDTH,
+):
+    inspector = Inspector(dataset_path, split)
+    table = inspector.search(pattern, columns, regex, ignore_case, limit)
+    _print_rows(table, width)
+    print(f"{len(table)} matches" + (" (limit reached)" if limit and len(table) == limit else ""))
+
+
+def lengths(dataset_path, split=None, columns=None, bins=DEFAULT_BINS):
+    inspector = Inspector(dataset_path, split)
+    for column, entry in inspector.lengths(columns, bins).items():
+        print(f"{column}: min {entry['min']}, mean {entry['mean']:.1f}, max {entry['max']}")
+        peak = max(entry["counts"].max(), 1)
+        for low, high, count in zip(entry["edges"][:-1], entry["edges"][1:], entry["counts"]):
+            print(f"  {low:10d} - {high - 1:10d} {count:10d} {'#' * round(40 * count / peak)}")
+
+
+if __name__ == "__main__":
+    Fire({"info": info, "show": show, "sample": sample, "search": search, "lengths": lengths})
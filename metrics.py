@@ -0,0 +1,228 @@
+import contextlib
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import re
+import resource
+import threading
+import time
+
+# Stages report wall/CPU time, peak RSS, rows and bytes. bytes_read/written
+# count the stage's own thread; cpu_seconds, the process_* values and peak
+# RSS are process-wide, so they include concurrent stages and workers. Where
+# the records go is set by the environment so builders don't need extra flags:
+#   LLM_DATA_METRICS=-              JSON lines on stdout
+#   LLM_DATA_METRICS=metrics.jsonl  JSON lines appended to a file
+#   LLM_DATA_METRICS=metrics.prom   Prometheus textfile (node_exporter textfile collector)
+#   LLM_DATA_PROFILE=profiles/      a cProfile dump of every outermost stage, e.g. a
+#                                   whole build, for pstats/snakeviz
+METRICS_ENV = "LLM_DATA_METRICS"
+PROFILE_ENV = "LLM_DATA_PROFILE"
+PROMETHEUS_PREFIX = "llm_data_stage"
+
+_current = contextvars.ContextVar("current_stage", default=None)
+_lock = threading.Lock()
+_latest = {}  # Last record per stage and labels, for the Prometheus textfile
+_profile_count = 0
+
+
+def _io_counters(scope="self"):
+    # Bytes passed through read()/write(), files and sockets, by the calling
+    # thread ("thread-self") or the whole process ("self").
+    try:
+        with open(f"/proc/{scope}/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _cpu_seconds():
+    # Includes finished child processes, e.g. Dataset.map workers.
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _peak_rss_bytes():
+    # The process' high-water mark since it started, it can't be reset per stage.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def in_context(fn):
+    # fn bound to a copy of the caller's context, for pool.submit(), so stages
+    # and current() in pool threads belong to the stage that submitted them.
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+class Stage:
+    def __init__(self, name, labels, parent=None):
+        self.name = name
+        self.labels = labels
+        self.parent = parent
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_transferred = 0
+        self.profiled = False
+        self._lock = threading.Lock()
+
+    def add_bytes(self, count):
+        # Pool threads with a copied context add to the same stage.
+        with self._lock:
+            self.bytes_transferred += count
+
+    def record(self, wall, cpu, io, process_io, peak_rss_before):
+        rows = self.rows_out if self.rows_out is not None else self.rows_in
+        return {
+            "stage": self.name,
+            "parent": self.parent.name if self.parent else None,
+            **self.labels,
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "process_peak_rss_bytes": _peak_rss_bytes(),
+            "peak_rss_increase_bytes": max(0, _peak_rss_bytes() - peak_rss_before),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rows_per_second": rows / max(wall, 1e-9) if rows is not None else None,
+            "bytes_read": io[0],
+            "bytes_written": io[1],
+            "process_bytes_read": process_io[0],
+            "process_bytes_written": process_io[1],
+            "bytes_transferred": self.bytes_transferred,
+            "timestamp": time.time(),
+        }
+
+
+_VALUES = [
+    "wall_seconds",
+    "cpu_seconds",
+    "process_peak_rss_bytes",
+    "peak_rss_increase_bytes",
+    "rows_in",
+    "rows_out",
+    "rows_per_second",
+    "bytes_read",
+    "bytes_written",
+    "process_bytes_read",
+    "process_bytes_written",
+    "bytes_transferred",
+]
+
+
+def _prometheus_name(value):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", value)
+
+
+def _labels(record):
+    return {
+        key: value
+        for key, value in record.items()
+        if key not in _VALUES and key != "timestamp" and value is not None
+    }
+
+
+def _write_prometheus(path):
+    lines = []
+    for metric in _VALUES:
+        name = f"{PROMETHEUS_PREFIX}_{metric}"
+        lines.append(f"# TYPE {name} gauge")
+        for record in _latest.values():
+            if record[metric] is None:
+                continue
+            labels = ",".join(
+                f'{_prometheus_name(key)}="{value}"' for key, value in sorted(_labels(record).items())
+            )
+            lines.append(f"{name}{{{labels}}} {record[metric]}")
+    # The textfile collector may read at any time, so replace the file atomically.
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
+
+
+def emit(record):
+    target = os.environ.get(METRICS_ENV)
+    if not target:
+        return
+    with _lock:
+        if target == "-":
+            print(json.dumps(record))
+        elif target.endswith(".prom"):
+            _latest[tuple(sorted(_labels(record).items()))] = record
+            _write_prometheus(target)
+        else:
+            with open(target, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    # with stage("transform", builder="open_instruct") as s:
+    #     s.rows_in = len(dataset)
+    # Nested stages inherit the labels of the stage around them.
+    global _profile_count
+    parent = _current.get()
+    if parent is not None:
+        labels = {**parent.labels, **labels}
+    current = Stage(name, labels, parent)
+    token = _current.set(current)
+
+    # Only the outermost stage is profiled, nested profilers would clobber it.
+    profile_dir = os.environ.get(PROFILE_ENV)
+    profiler = None
+    if profile_dir and not (parent and parent.profiled):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None  # Another profiler is already running
+    current.profiled = profiler is not None or bool(parent and parent.profiled)
+
+    start = time.perf_counter()
+    cpu = _cpu_seconds()
+    peak_rss = _peak_rss_bytes()
+    io = _io_counters("thread-self")
+    process_io = _io_counters()
+    try:
+        yield current
+    finally:
+        wall = time.perf_counter() - start
+        io_after = _io_counters("thread-self")
+        process_io_after = _io_counters()
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            with _lock:
+                _profile_count += 1
+                path = os.path.join(
+                    profile_dir, f"{os.getpid()}-{_profile_count:03d}-{_prometheus_name(name)}.prof"
+                )
+            profiler.dump_stats(path)
+        _current.reset(token)
+        emit(
+            current.record(
+                wall,
+                _cpu_seconds() - cpu,
+                (io_after[0] - io[0], io_after[1] - io[1]),
+                (process_io_after[0] - process_io[0], process_io_after[1] - process_io[1]),
+                peak_rss,
+            )
+        )
+
+
+def current():
+    # The innermost running stage, or a detached one outside of any stage.
+    return _current.get() or Stage(None, {})
+
+
+def timed(name, **labels):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name, **labels):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,70 +1,109 @@
-import csv
-import shutil
-import json
 from pathlib import Path
 import glob
-import os
-import traceback
+from concurrent.futures import ThreadPoolExecutor
 import dotenv
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from datasets import Dataset, DatasetDict, DatasetInfo
-from jinja2 import Environment, FileSystemLoader
-from utils import DatasetMover
-
-
-class MMLUDataTransformer:
-    def transform(self, row):
-        prompt = f"{row[0]}\n"
-        choices = row[1:5]
-        for option, choice in zip(["A", "B", "C", "D"], choices):
-            prompt += f"{option}. {choice}\n"
-
-        lookup = {
-            "A": 0,
-            "B": 1,
-            "C": 2,
-            "D": 3,
-        }
-        completion = choices[lookup[row[5]]]
-        return {
-            "prompt": prompt,
-            "completion": completion,
-        }
+from fire import Fire
+from metrics import current, timed
+from source_mirror import local_source
+from utils import cached_build, post_process, publish_dataset
 
+SPLITS = ["auxiliary_train", "dev", "val", "test"]
+COLUMNS = ["question", "A", "B", "C", "D", "answer"]
+OPTIONS = ["A", "B", "C", "D"]
 
-def gen(split="dev"):
-    mmlu_data = Path.home() / "data" / "mmlu"
-    assert mmlu_data.exists()
 
-    mmlu_data_transformer = MMLUDataTransformer()
+def _subject(filepath, split):
+    # e.g. dev/abstract_algebra_dev.csv -> abstract_algebra
+    stem = Path(filepath).stem
+    suffix = f"_{split}"
+    return stem[: -len(suffix)] if stem.endswith(suffix) else stem
 
-    # Use glob to find all CSV files in the 'dev' folder
-    count = 0
-    for filepath in glob.glob((mmlu_data / split / "*.csv").as_posix()):
-        print(f"Processing {filepath}")
-        with open(filepath, "r") as fr:
-            reader = csv.reader(fr)
-            for row in reader:
-                row = mmlu_data_transformer.transform(row)
-                yield row
 
-    print("split", split)
-    print("count", count)
+def read_file(filepath, split):
+    table = pacsv.read_csv(
+        filepath,
+        read_options=pacsv.ReadOptions(column_names=COLUMNS),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            column_types={column: pa.string() for column in COLUMNS}
+        ),
+    )
+    # csv.reader on a text-mode file saw universal newlines, keep that behaviour.
+    columns = {}
+    for column in COLUMNS:
+        values = pc.replace_substring(table[column], pattern="\r\n", replacement="\n")
+        columns[column] = pc.replace_substring(values, pattern="\r", replacement="\n")
 
+    # "{question}\nA. {A}\nB. {B}\nC. {C}\nD. {D}\n"
+    pieces = [columns["question"]]
+    for option in OPTIONS:
+        pieces.extend([pa.scalar(f"\n{option}. "), columns[option]])
+    pieces.append(pa.scalar("\n"))
+    prompt = pc.binary_join_element_wise(*pieces, "")
 
-if __name__ == "__main__":
-    dataset_name = "mmlu"
-    dotenv.load_dotenv()
-    mmlu_data = Path.home() / "data" / "mmlu"
+    answer = pc.index_in(columns["answer"], value_set=pa.array(OPTIONS))
+    if answer.null_count:
+        raise ValueError(f"Unexpected answer in {filepath}")
+    completion = pc.choose(answer, *(columns[option] for option in OPTIONS))
+    subject = pa.array([_subject(filepath, split)] * len(table), pa.string())
+    return pa.table({"prompt": prompt, "completion": completion, "subject": subject})
+
+
+@timed("read")
+def read_splits(mmlu_data, num_workers=None):
+    # All subject CSVs of all splits are parsed concurrently; Arrow releases
+    # the GIL, so threads are enough. Files keep their glob order per split.
+    files = {
+        split: glob.glob((Path(mmlu_data) / split / "*.csv").as_posix())
+        for split in SPLITS
+    }
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            split: [executor.submit(read_file, filepath, split) for filepath in filepaths]
+            for split, filepaths in files.items()
+        }
+        tables = {
+            split: [future.result() for future in split_futures]
+            for split, split_futures in futures.items()
+        }
+    for split in SPLITS:
+        print(f"Read {len(files[split])} files for split {split}")
+    current().rows_out = sum(len(table) for split_tables in tables.values() for table in split_tables)
+    return {split: pa.concat_tables(split_tables) for split, split_tables in tables.items()}
+
+
+@cached_build(source_param="data_dir", default_source=str(Path.home() / "data" / "mmlu"))
+def build(
+    output_dir="dataset",
+    short_name="mmlu",
+    bucket_name="fine-tuning-research",
+    publish_mode="tarball",
+    data_dir=None,
+    num_workers=None,
+    dedup=None,
+    contamination=None,
+    tokenizer_path=None,
+    pack_length=None,
+    use_cache=True,
+):
+    mmlu_data = Path(data_dir) if data_dir else Path.home() / "data" / "mmlu"
+    # Pods without the CSVs hydrate them from the source mirror.
+    mmlu_data = Path(local_source(mmlu_data.as_posix()) or mmlu_data)
     assert mmlu_data.exists()
 
     splits = {}
-    for split in ["auxiliary_train", "dev", "val", "test"]:
-        ds = Dataset.from_generator(gen, gen_kwargs={"split": split})
+    for split, table in read_splits(mmlu_data, num_workers).items():
+        ds = Dataset(table)
         if split == "auxiliary_train":
             splits["train"] = ds
         else:
             splits[split] = ds
     combined = DatasetDict(splits)
+    combined, index = post_process(combined, dedup, contamination, tokenizer_path, pack_length, num_workers)
     dataset_info = DatasetInfo(
         description="Contains MMLU dataset string appended from cais/mmlu",
         version="0.1.0",
@@ -78,17 +117,17 @@ if __name__ == "__main__":
             print(row)
             break
 
-    current_directory = Path(".")
-    shutil.rmtree(current_directory / "dataset", ignore_errors=True)
-    os.mkdir(current_directory / "dataset")
-    dataset_path = (current_directory / "dataset" / dataset_name).as_posix()
-    combined.save_to_disk(dataset_path)
-
-    # Compress the folder
-    print(f"Compressing the folder {current_directory / 'dataset' / dataset_name}")
-    folder_to_compress = (current_directory / "dataset" / dataset_name).as_posix()
-    output_tar_file = f"{dataset_name}.tar.gz"
-    bucket_name = "fine-tuning-research"
-    print(f"Uploading {output_tar_file} to {bucket_name}")
-    dataset_mover = DatasetMover()
-    dataset_mover.upload(folder_to_compress, output_tar_file, bucket_name)
+    publish_dataset(
+        combined,
+        output_dir,
+        short_name,
+        bucket_name,
+        publish_mode=publish_mode,
+        version=dataset_info.version,
+        index=index,
+    )
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    Fire(build)
@@ -1,78 +1,90 @@
-import shutil
-from pathlib import Path
 import os
-from datasets import Dataset, DatasetDict, DatasetInfo
-from datasets import load_dataset
+from datasets import DatasetDict, DatasetInfo
 from fire import Fire
 from numpy import dot
-from utils import DatasetMover
+from splitter import train_val_test
+from streaming import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_SHARD_ROWS,
+    split_routes,
+    stream_build,
+)
+from transforms import Pipeline, drop, rename, strip
+from metrics import stage
+from source_mirror import load_source
+from utils import cached_build, post_process, publish_dataset
 import dotenv
 
 dotenv.load_dotenv()
 
+TRANSFORM = Pipeline(
+    strip("alpaca_prompt"),
+    strip("response"),
+    rename({"alpaca_prompt": "prompt", "response": "completion"}),
+    drop(["instruction", "task_name", "template_type"]),
+)
 
+
+@cached_build()
 def split(
     dataset_name="VMware/open-instruct",
     train_size=0.9,
     test_size=0.05,
     val_size=0.05,
     output_dir="dataset",
+    bucket_name="fine-tuning-research",
+    publish_mode="tarball",
+    num_proc=None,
+    streaming=False,
+    batch_size=DEFAULT_BATCH_SIZE,
+    shard_rows=DEFAULT_SHARD_ROWS,
+    split_key=None,
+    seed=0,
+    dedup=None,
+    contamination=None,
+    tokenizer_path=None,
+    pack_length=None,
+    use_cache=True,
 ):
-    print(f"Loading {dataset_name}")
-    dataset = load_dataset(dataset_name)
-    new_dataset = []
-    for row in dataset["train"]:
-        row["prompt"] = row["alpaca_prompt"].strip()
-        row["completion"] = row["response"].strip()
-        for to_delete in [
-            "alpaca_prompt",
-            "response",
-            "instruction",
-            "task_name",
-            "template_type",
-        ]:
-            row.pop(to_delete)
-        new_dataset.append(row)
-
     short_name = dataset_name.split("/")[-1]
-    # Create a Dataset from your list of dictionaries
-    new_dataset = Dataset.from_list(new_dataset)
-
-    # If you're creating a new dataset from scratch:
-    dataset = DatasetDict(
-        {
-            "train": new_dataset  # Assign the new dataset as the train split
-        }
-    )
-
-    # Split the dataset
-    print("Splitting the dataset")
-    if "test" not in dataset:
-        train_testvalid = dataset["train"].train_test_split(train_size=train_size)
-        test_valid = train_testvalid["test"].train_test_split(
-            test_size=test_size / (test_size + val_size)
+    if streaming:
+        print(f"Streaming {dataset_name}")
+        source = load_source(dataset_name, streaming=True)
+        splits = stream_build(
+            source,
+            TRANSFORM,
+            os.path.join(output_dir, f"{short_name}-shards"),
+            split_routes(["train"], train_size, val_size, test_size),
+            batch_size=batch_size,
+            shard_rows=shard_rows,
+            split_key=split_key,
+            seed=seed,
         )
-        train_split = train_testvalid["train"]
-        val_split = test_valid["train"]
-        test_split = test_valid["test"]
     else:
-        test_valid = dataset["test"].train_test_split(
-            test_size=test_size / (test_size + val_size)
+        print(f"Loading {dataset_name}")
+        with stage("load") as loaded:
+            dataset = load_source(dataset_name)
+            loaded.rows_out = sum(dataset.num_rows.values())
+        new_dataset = TRANSFORM.apply(dataset["train"], num_proc=num_proc)
+
+        # If you're creating a new dataset from scratch:
+        dataset = DatasetDict(
+            {
+                "train": new_dataset  # Assign the new dataset as the train split
+            }
+        )
+
+        # Split the dataset
+        print("Splitting the dataset")
+        splits = train_val_test(
+            dataset, train_size, val_size, test_size, key=split_key, seed=seed
         )
-        train_split = dataset["train"]
-        val_split = test_valid["train"]
-        test_split = test_valid["test"]
 
-    # Create output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        # Create output directory if it doesn't exist
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
 
-    print(f"Converting {dataset_name} ad splitting it into train/val/test")
-    # Save the splits
-    splits = {}
-    splits["train"] = train_split
-    splits["val"] = val_split
-    splits["test"] = test_split
+        print(f"Converting {dataset_name} ad splitting it into train/val/test")
 
     for split in splits:
         print(f"Example in split {split}:")
@@ -81,6 +93,7 @@ def split(
             break
 
     combined = DatasetDict(splits)
+    combined, index = post_process(combined, dedup, contamination, tokenizer_path, pack_length, num_proc)
     dataset_info = DatasetInfo(
         description="Contains data from VMware/open-instruct but not formatted into llmos format",
         version="0.0.5",
@@ -88,20 +101,15 @@ def split(
     for split, dataset in combined.items():
         dataset.dataset_info = dataset_info
 
-    current_directory = Path(".")
-    shutil.rmtree(current_directory / output_dir, ignore_errors=True)
-    os.mkdir(current_directory / output_dir)
-    dataset_path = (current_directory / output_dir / short_name).as_posix()
-    combined.save_to_disk(dataset_path)
-
-    # Compress the folder
-    print(f"Compressing the folder {current_directory / output_dir/ short_name}")
-    folder_to_compress = (current_directory / output_dir / short_name).as_posix()
-    output_tar_file = f"{short_name}.tar.gz"
-    bucket_name = "fine-tuning-research"
-    print(f"Uploading {output_tar_file} to {bucket_name}")
-    dataset_mover = DatasetMover()
-    dataset_mover.upload(folder_to_compress, output_tar_file, bucket_name)
+    publish_dataset(
+        combined,
+        output_dir,
+        short_name,
+        bucket_name,
+        publish_mode=publish_mode,
+        version=dataset_info.version,
+        index=index,
+    )
 
 
 if __name__ == "__main__":
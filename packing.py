@@ -0,0 +1,192 @@
+import os
+import numpy as np
+from datasets import Dataset, DatasetDict, Features, Sequence, Value
+from metrics import stage
+
+# Token lengths are added as 'prompt_len'/'completion_len' columns. Packed
+# splits ('<split>_packed') concatenate whole examples, each followed by EOS,
+# into rows of at most 'pack_length' tokens. 'example_starts' and
+# 'completion_starts' give the offsets of every example and its completion
+# within 'input_ids', so the loss can still be masked to completions.
+DEFAULT_BATCH_SIZE = 1_000
+PACKED_SUFFIX = "_packed"
+PACKED_FEATURES = Features(
+    {
+        "input_ids": Sequence(Value("int32")),
+        "example_starts": Sequence(Value("int32")),
+        "completion_starts": Sequence(Value("int32")),
+        "length": Value("int32"),
+    }
+)
+
+_tokenizers = {}  # Per process, Dataset.map workers load their own
+
+
+def load_tokenizer(tokenizer_path):
+    if tokenizer_path not in _tokenizers:
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError("Token lengths and packing need transformers: pip install transformers")
+        # Fast tokenizers parallelize internally, which fights with num_proc.
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        _tokenizers[tokenizer_path] = AutoTokenizer.from_pretrained(
+            tokenizer_path, local_files_only=True
+        )
+    return _tokenizers[tokenizer_path]
+
+
+def _tokenize(batch, tokenizer_path, keep_ids):
+    tokenizer = load_tokenizer(tokenizer_path)
+    prompt_ids = tokenizer(batch["prompt"])["input_ids"]
+    completion_ids = tokenizer(batch["completion"], add_special_tokens=False)["input_ids"]
+    result = {
+        "prompt_len": [len(ids) for ids in prompt_ids],
+        "completion_len": [len(ids) for ids in completion_ids],
+    }
+    if keep_ids:
+        result["prompt_ids"] = prompt_ids
+        result["completion_ids"] = completion_ids
+    return result
+
+
+def add_token_lengths(dataset, tokenizer_path, num_proc=None, batch_size=DEFAULT_BATCH_SIZE, keep_ids=False):
+    with stage("tokenize") as tokenized:
+        tokenized.rows_in = len(dataset)
+        return dataset.map(
+            _tokenize,
+            batched=True,
+            batch_size=batch_size,
+            num_proc=num_proc,
+            fn_kwargs={"tokenizer_path": tokenizer_path, "keep_ids": keep_ids},
+        )
+
+
+def plan_bins(lengths, pack_length):
+    # Best-fit decreasing: every bin starts with the longest example left and
+    # is topped up with the longest examples that still fit. Examples are
+    # bucketed by length, so finding one is a lookup, not a scan.
+    lengths = np.clip(lengths, 1, pack_length)
+    buckets = [[] for _ in range(pack_length + 1)]
+    for index in np.argsort(lengths, kind="stable"):
+        buckets[lengths[index]].append(int(index))
+    counts = np.array([len(bucket) for bucket in buckets])
+    bins = []
+    longest = pack_length
+    while True:
+        while longest > 0 and counts[longest] == 0:
+            longest -= 1
+        if longest == 0:
+            return bins
+        members = [buckets[longest].pop()]
+        counts[longest] -= 1
+        room = pack_length - longest
+        while room > 0:
+            fits = np.flatnonzero(counts[1 : room + 1])
+            if not len(fits):
+                break
+            size = fits[-1] + 1
+            members.append(buckets[size].pop())
+            counts[size] -= 1
+            room -= size
+        bins.append(members)
+
+
+def _packed_rows(tokens, bins, pack_length, eos_token_id, batch_bins=1_000):
+    for first in range(0, len(bins), batch_bins):
+        chunk = bins[first : first + batch_bins]
+        indices = [index for members in chunk for index in members]
+        table = tokens.with_format("arrow")[indices]
+        prompts = table["prompt_ids"].to_pylist()
+        completions = table["completion_ids"].to_pylist()
+        position = 0
+        for members in chunk:
+            input_ids = []
+            example_starts = []
+            completion_starts = []
+            for _ in members:
+                example = prompts[position] + completions[position]
+                if eos_token_id is not None:
+                    example.append(eos_token_id)
+                example_starts.append(len(input_ids))
+                completion_starts.append(min(len(input_ids) + len(prompts[position]), pack_length))
+                input_ids.extend(example[: pack_length - len(input_ids)])
+                position += 1
+            yield {
+                "input_ids": input_ids,
+                "example_starts": example_starts,
+                "completion_starts": completion_starts,
+                "length": len(input_ids),
+            }
+
+
+def _padding_efficiency(lengths, batch_size):
+    # Share of real tokens in dynamically padded batches, in dataset order.
+    if not len(lengths):
+        return 1.0
+    batches = np.zeros(-(-len(lengths) // batch_size) * batch_size, dtype=np.int64)
+    batches[: len(lengths)] = lengths
+    batches = batches.reshape(-1, batch_size)
+    sizes = np.full(len(batches), batch_size)
+    sizes[-1] = len(lengths) - (len(batches) - 1) * batch_size
+    return lengths.sum() / max((batches.max(axis=1) * sizes).sum(), 1)
+
+
+def pack(dataset, tokenizer_path, pack_length, num_proc=None, train_batch_size=8):
+    # Returns the dataset with length columns, its packed variant and a report.
+    tokenizer = load_tokenizer(tokenizer_path)
+    tokens = add_token_lengths(dataset, tokenizer_path, num_proc, keep_ids=True)
+    extra = 0 if tokenizer.eos_token_id is None else 1
+    columns = tokens.with_format("arrow")[:]
+    lengths = (
+        columns["prompt_len"].to_numpy().astype(np.int64)
+        + columns["completion_len"].to_numpy().astype(np.int64)
+        + extra
+    )
+    with stage("pack") as packing:
+        packing.rows_in = len(tokens)
+        bins = plan_bins(lengths, pack_length)
+        packed = Dataset.from_generator(
+            _packed_rows,
+            gen_kwargs={
+                "tokens": tokens,
+                "bins": bins,
+                "pack_length": pack_length,
+                "eos_token_id": tokenizer.eos_token_id,
+            },
+            features=PACKED_FEATURES,
+        )
+        packing.rows_out = len(packed)
+
+    packed_tokens = int(np.minimum(lengths, pack_length).sum())
+    report = {
+        "rows": len(dataset),
+        "packed_rows": len(packed),
+        "tokens": int(lengths.sum()),
+        "truncated_examples": int((lengths > pack_length).sum()),
+        "padded_efficiency": _padding_efficiency(lengths, train_batch_size),
+        "packed_efficiency": packed_tokens / max(len(packed) * pack_length, 1),
+    }
+    report["gain"] = report["packed_efficiency"] / max(report["padded_efficiency"], 1e-9)
+    return tokens.remove_columns(["prompt_ids", "completion_ids"]), packed, report
+
+
+def pack_splits(dataset_dict, tokenizer_path, pack_length=None, num_proc=None):
+    # Builder stage: token lengths for every split, plus '<split>_packed'
+    # splits when pack_length is set.
+    splits = {}
+    packed_splits = {}
+    for name, dataset in dataset_dict.items():
+        if pack_length is None:
+            splits[name] = add_token_lengths(dataset, tokenizer_path, num_proc)
+            continue
+        splits[name], packed_splits[f"{name}{PACKED_SUFFIX}"], report = pack(
+            dataset, tokenizer_path, pack_length, num_proc
+        )
+        print(
+            f"Packed {name}: {report['rows']} examples into {report['packed_rows']} rows of "
+            f"{pack_length} tokens, {report['truncated_examples']} truncated. Padding efficiency "
+            f"{report['padded_efficiency']:.1%} -> {report['packed_efficiency']:.1%} "
+            f"({report['gain']:.2f}x)"
+        )
+    return DatasetDict({**splits, **packed_splits})
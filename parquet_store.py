@@ -0,0 +1,204 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+import pyarrow.dataset as pads
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from datasets import load_from_disk
+from metrics import current, timed
+from streaming import ShardWriter, load_shards
+from transfer import TransferManager
+
+# The 'parquet' publish mode: every split becomes zstd Parquet shards of at
+# most ~max_shard_bytes (uncompressed), with row-group statistics, uploaded as
+# separate objects next to a manifest:
+#   parquet/<short_name>/<version>/<split>/part-00000.parquet
+#   parquet/<short_name>/<version>/manifest.json
+#   parquet/<short_name>/latest.json
+# Readers open a split straight from the bucket and only range-read the
+# columns and row groups they touch, e.g. for eval on 'test':
+#   table = open_split("fine-tuning-research", "mmlu", "test").to_table(columns=["prompt"])
+PREFIX = "parquet"
+DEFAULT_SHARD_BYTES = 256 * 2**20
+DEFAULT_ROW_GROUP_ROWS = 50_000
+
+
+def object_prefix(short_name, version):
+    return f"{PREFIX}/{short_name}/{version}"
+
+
+def manifest_name(short_name, version="latest"):
+    if version == "latest":
+        return f"{PREFIX}/{short_name}/latest.json"
+    return f"{object_prefix(short_name, version)}/manifest.json"
+
+
+def _shard_rows(dataset, max_shard_bytes):
+    # Rows per shard from the split's average Arrow row size.
+    nbytes = dataset.data.nbytes
+    return max(1, int(max_shard_bytes * len(dataset) / max(nbytes, 1)))
+
+
+@timed("parquet_shards")
+def write_shards(dataset_path, output_path, max_shard_bytes=DEFAULT_SHARD_BYTES, row_group_rows=DEFAULT_ROW_GROUP_ROWS):
+    # Reads the saved (memory-mapped) DatasetDict split by split and returns
+    # {split: [shard paths]} and the datasets' fingerprint. Every batch written
+    # is one row group, and the Arrow schema keeps the datasets features.
+    dataset_dict = load_from_disk(dataset_path)
+    shutil.rmtree(output_path, ignore_errors=True)
+    fingerprint = hashlib.sha256()
+    shard_files = {}
+    for split, dataset in dataset_dict.items():
+        writer = ShardWriter(os.path.join(output_path, split), _shard_rows(dataset, max_shard_bytes))
+        for table in dataset.with_format("arrow").iter(batch_size=row_group_rows):
+            writer.write(table)
+        writer.close()
+        shard_files[split] = writer.files
+        fingerprint.update(f"{split}:{dataset._fingerprint}".encode())
+        current().rows_out = (current().rows_out or 0) + len(dataset)
+    return shard_files, fingerprint.hexdigest()[:16]
+
+
+def publish_parquet(
+    dataset_path,
+    bucket_name,
+    short_name,
+    version=None,
+    max_shard_bytes=DEFAULT_SHARD_BYTES,
+    row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+):
+    start = time.perf_counter()
+    output_path = f"{os.path.normpath(dataset_path)}-parquet"
+    shard_files, fingerprint = write_shards(dataset_path, output_path, max_shard_bytes, row_group_rows)
+    # Unversioned builds are named after their content, like CAS manifests.
+    version = str(version or fingerprint)
+    prefix = object_prefix(short_name, version)
+
+    batch = []
+    splits = {}
+    for split, files in shard_files.items():
+        splits[split] = {"rows": 0, "files": []}
+        for path in files:
+            metadata = pq.ParquetFile(path).metadata
+            object_name = f"{prefix}/{split}/{os.path.basename(path)}"
+            splits[split]["rows"] += metadata.num_rows
+            splits[split]["files"].append(
+                {
+                    "object": object_name,
+                    "rows": metadata.num_rows,
+                    "row_groups": metadata.num_row_groups,
+                    "size": os.path.getsize(path),
+                }
+            )
+            batch.append((bucket_name, object_name, path))
+    # Anything else saved with the dataset, e.g. the contamination n-gram index.
+    extra = []
+    for root, _, names in os.walk(dataset_path):
+        relative_root = os.path.relpath(root, dataset_path)
+        if relative_root.split(os.sep)[0] in splits or relative_root == ".":
+            continue
+        for name in names:
+            path = os.path.join(root, name)
+            object_name = f"{prefix}/{os.path.relpath(path, dataset_path)}"
+            extra.append(object_name)
+            batch.append((bucket_name, object_name, path))
+
+    transfers = TransferManager.shared()
+    sizes = transfers.upload_files(batch)
+    current().add_bytes(sum(sizes))
+    manifest = {
+        "format": "parquet",
+        "short_name": short_name,
+        "version": version,
+        "splits": splits,
+        "extra": extra,
+    }
+    body = json.dumps(manifest, indent=2).encode()
+    for name in [manifest_name(short_name, version), manifest_name(short_name)]:
+        transfers.retry(
+            transfers.client.put_object,
+            bucket_name,
+            name,
+            io.BytesIO(body),
+            len(body),
+            content_type="application/json",
+        )
+    # Republishing a version overwrites it in place; parts of the earlier
+    # publish that the new manifest doesn't list are removed, so readers of
+    # the prefix don't see mixed data.
+    keep = {object_name for _, object_name, _ in batch} | {manifest_name(short_name, version)}
+    stale = [
+        item.object_name
+        for item in transfers.retry(lambda: list(transfers.client.list_objects(bucket_name, prefix=f"{prefix}/", recursive=True)))
+        if item.object_name not in keep
+    ]
+    for object_name in stale:
+        transfers.retry(transfers.client.remove_object, bucket_name, object_name)
+    if stale:
+        print(f"Removed {len(stale)} stale objects of '{short_name}' version '{version}'")
+    shutil.rmtree(output_path, ignore_errors=True)
+    print(
+        f"Published '{short_name}' version '{version}' as {len(batch) - len(extra)} Parquet shards "
+        f"({sum(sizes) / 2**20:.1f} MiB) to bucket '{bucket_name}' in {time.perf_counter() - start:.1f}s."
+    )
+    return manifest
+
+
+def read_manifest(bucket_name, short_name, version="latest"):
+    transfers = TransferManager.shared()
+
+    def fetch():
+        response = transfers.client.get_object(bucket_name, manifest_name(short_name, version))
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+
+    return transfers.retry(fetch)
+
+
+def s3_filesystem():
+    # The same S3 settings as TransferManager, for pyarrow's native reader.
+    secure = os.environ.get("S3_SECURE", "True").lower() == "true"
+    return pafs.S3FileSystem(
+        access_key=os.environ["S3_ACCESS_KEY_ID"],
+        secret_key=os.environ["S3_SECRET_ACCESS_KEY"],
+        region=os.environ["S3_REGION"],
+        endpoint_override=os.environ["S3_ENDPOINT"],
+        scheme="https" if secure else "http",
+    )
+
+
+def open_split(bucket_name, short_name, split, version="latest", filesystem=None):
+    # A lazy pyarrow Dataset over the split's shards in the bucket. Nothing is
+    # downloaded until it is read, then only the footers, the requested
+    # columns and the row groups a filter can't rule out from their statistics:
+    #   open_split(...).to_batches(columns=["prompt"], filter=pc.field("subject") == "law")
+    manifest = read_manifest(bucket_name, short_name, version)
+    if split not in manifest["splits"]:
+        raise ValueError(f"Unknown split '{split}', expected one of {list(manifest['splits'])}")
+    paths = [f"{bucket_name}/{entry['object']}" for entry in manifest["splits"][split]["files"]]
+    return pads.dataset(paths, format="parquet", filesystem=filesystem or s3_filesystem())
+
+
+def download(bucket_name, short_name, output_path, splits=None, version="latest"):
+    # Downloads the shards of the given splits (all by default) in parallel
+    # and loads them as a memory-mapped DatasetDict.
+    manifest = read_manifest(bucket_name, short_name, version)
+    splits = splits or list(manifest["splits"])
+    splits = [splits] if isinstance(splits, str) else list(splits)
+    batch = []
+    shard_files = {}
+    for split in splits:
+        shard_files[split] = []
+        for entry in manifest["splits"][split]["files"]:
+            path = os.path.join(output_path, split, os.path.basename(entry["object"]))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            batch.append((bucket_name, entry["object"], path))
+            shard_files[split].append(path)
+    TransferManager.shared().download_files(batch)
+    return load_shards(shard_files)
@@ -0,0 +1,238 @@
+import importlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import dotenv
+from fire import Fire
+from metrics import in_context, stage
+from source_mirror import local_source, mirror_bucket
+from utils import deferred_publish, publish_deferred
+
+# Runs several builders as a DAG of stages instead of back to back:
+#   fetch    (I/O pool)  downloads the Hub source into the local cache
+#   build    (CPU pool)  runs the builder in its own process, saving to disk only
+#   publish  (I/O pool)  compresses and uploads what the build saved
+# so one dataset's download or upload overlaps with another one's transform.
+# Builds only start while the memory of the running builds stays within
+# 'memory_gb'. Every job writes to '<work_dir>/<name>', never to a shared
+# 'dataset/'. Jobs come from a JSON file:
+#   [{"builder": "mmlu", "args": {"data_dir": "/data/mmlu"}, "memory_gb": 2},
+#    {"builder": "split", "name": "alpaca", "args": {"dataset_name": "tatsu-lab/alpaca"}},
+#    {"builder": "split", "name": "dolly", "args": {"dataset_name": "databricks/databricks-dolly-15k"},
+#     "after": ["alpaca"]}]
+BUILDERS = {
+    "open_instruct": ("open_instruct", "split"),
+    "text_to_sql": ("text_to_sql", "split"),
+    "humset": ("humset", "split"),
+    "split": ("split", "split"),
+    "mmlu": ("mmlu", "build"),
+    "batch_inference": ("batch_inference", "split"),
+}
+DEFAULT_JOB_MEMORY_GB = 4
+STAGES = ["fetch", "build", "publish"]
+
+
+def _builder(name):
+    if name not in BUILDERS:
+        raise ValueError(f"Unknown builder '{name}', expected one of {list(BUILDERS)}")
+    module_name, function = BUILDERS[name]
+    return getattr(importlib.import_module(module_name), function)
+
+
+def total_memory_gb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**30
+
+
+class Job:
+    def __init__(self, spec, work_dir):
+        self.builder = spec["builder"]
+        self.args = dict(spec.get("args", {}))
+        builder = _builder(self.builder)
+        self.source_param = getattr(builder, "source_param", None)
+        source = self.args.get(self.source_param) or getattr(builder, "default_source", None)
+        self.source = source
+        self.name = spec.get("name") or (source.rstrip("/").split("/")[-1] if self.builder == "split" else self.builder)
+        self.after = list(spec.get("after", []))
+        self.memory_gb = spec.get("memory_gb", DEFAULT_JOB_MEMORY_GB)
+        self.args.setdefault("output_dir", os.path.join(work_dir, self.name))
+        self.state = "pending"
+        self.error = None
+        self.publishes = []
+        self.timings = {}  # stage: {"queued", "start", "end"}
+
+    def mark(self, stage_name, event):
+        self.timings.setdefault(stage_name, {})[event] = time.perf_counter()
+
+
+def fetch_source(source, revision=None):
+    # Warms the Hub cache that load_dataset reads from, pure I/O. Local
+    # folders (e.g. MMLU CSVs) have nothing to fetch. With a source mirror,
+    # the source is hydrated from the bucket instead.
+    if not source or os.path.exists(source):
+        return None
+    if mirror_bucket():
+        return local_source(source, revision)
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(source, repo_type="dataset", revision=revision)
+
+
+def _fetch(job):
+    with stage("fetch", job=job.name):
+        try:
+            fetch_source(job.source, job.args.get("revision"))
+        except Exception as e:
+            # Not fatal, the build downloads whatever is missing itself.
+            print(f"[{job.name}] Prefetching {job.source} failed, the build will download it: {e}")
+
+
+def _build(builder, args):
+    # Runs in a fresh worker process: saves the dataset, defers the upload.
+    publishes = []
+    token = deferred_publish.set(publishes)
+    try:
+        _builder(builder)(**args)
+    finally:
+        deferred_publish.reset(token)
+    return publishes
+
+
+def _publish(job):
+    with stage("publish", job=job.name):
+        return [publish_deferred(publish) for publish in job.publishes]
+
+
+def _seconds(timing, start="start", end="end"):
+    if start not in timing or end not in timing:
+        return None
+    return timing[end] - timing[start]
+
+
+def report(jobs, wall):
+    rows = []
+    for job in jobs:
+        row = {"name": job.name, "builder": job.builder, "state": job.state}
+        for stage_name in STAGES:
+            timing = job.timings.get(stage_name, {})
+            row[f"{stage_name}_seconds"] = _seconds(timing)
+            row[f"{stage_name}_waited_seconds"] = _seconds(timing, "queued", "start")
+        if job.error:
+            row["error"] = job.error
+        rows.append(row)
+    busy = sum(row[f"{s}_seconds"] or 0 for row in rows for s in STAGES)
+    print(f"{'job':>20} {'state':>10} " + " ".join(f"{s:>9} {'(wait)':>8}" for s in STAGES))
+    for row in rows:
+        cells = []
+        for stage_name in STAGES:
+            seconds = row[f"{stage_name}_seconds"]
+            waited = row[f"{stage_name}_waited_seconds"]
+            cells.append(f"{'-' if seconds is None else f'{seconds:.1f}s':>9} {'' if waited is None else f'{waited:.1f}s':>8}")
+        print(f"{row['name']:>20} {row['state']:>10} " + " ".join(cells))
+    print(f"Wall time {wall:.1f}s for {busy:.1f}s of stage time ({busy / max(wall, 1e-9):.2f}x overlap)")
+    return {"wall_seconds": wall, "stage_seconds": busy, "jobs": rows}
+
+
+def run(
+    jobs,
+    work_dir="builds",
+    cpu_workers=None,
+    io_workers=4,
+    memory_gb=None,
+    output=None,
+):
+    # jobs: a JSON file, or a list of job dicts when called from Python.
+    if isinstance(jobs, str):
+        with open(jobs) as f:
+            jobs = json.load(f)
+    jobs = [Job(spec, work_dir) for spec in jobs]
+    by_name = {job.name: job for job in jobs}
+    if len(by_name) != len(jobs):
+        raise ValueError("Job names must be unique, set 'name' for repeated builders")
+    for job in jobs:
+        for dependency in job.after:
+            if dependency not in by_name:
+                raise ValueError(f"Job '{job.name}' runs after unknown job '{dependency}'")
+    cpu_workers = cpu_workers or os.cpu_count()
+    memory_gb = memory_gb or total_memory_gb() * 0.8
+
+    start = time.perf_counter()
+    io_pool = ThreadPoolExecutor(io_workers)
+    # Spawned, not forked: the parent has I/O threads running.
+    cpu_pool = ProcessPoolExecutor(cpu_workers, mp_context=multiprocessing.get_context("spawn"))
+    running = {}  # future: (job, stage)
+    memory_in_use = 0
+
+    def submit(job, stage_name, pool, fn, *args):
+        job.state = stage_name
+        job.mark(stage_name, "start")
+        # I/O stages run in threads and nest under the caller's stage, if any.
+        running[pool.submit(in_context(fn) if pool is io_pool else fn, *args)] = (job, stage_name)
+
+    def fail(job, error):
+        job.state = "failed"
+        job.error = error
+        print(f"[{job.name}] {error}")
+        for other in jobs:
+            if job.name in other.after and other.state in ("pending", "fetch", "fetched"):
+                fail(other, f"Skipped, '{job.name}' failed")
+
+    try:
+        for job in jobs:
+            submit(job, "fetch", io_pool, _fetch, job)
+
+        while True:
+            # Start every build whose fetch and dependencies are done, in job
+            # order, within the CPU and memory limits. A job larger than the
+            # whole budget still runs, alone.
+            builds = [job for job, stage_name in running.values() if stage_name == "build"]
+            for job in jobs:
+                if job.state != "fetched" or len(builds) >= cpu_workers:
+                    continue
+                if any(by_name[dependency].state != "done" for dependency in job.after):
+                    continue
+                if builds and memory_in_use + job.memory_gb > memory_gb:
+                    continue
+                memory_in_use += job.memory_gb
+                builds.append(job)
+                print(f"[{job.name}] Building with {job.builder}")
+                submit(job, "build", cpu_pool, _build, job.builder, job.args)
+            if not running:
+                break
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                job, stage_name = running.pop(future)
+                job.mark(stage_name, "end")
+                error = future.exception()
+                if stage_name == "build":
+                    memory_in_use -= job.memory_gb
+                if error is not None:
+                    fail(job, f"{stage_name} failed: {error!r}")
+                elif stage_name == "fetch":
+                    if job.state == "fetch":  # Not failed through a dependency meanwhile
+                        job.state = "fetched"
+                    job.mark("build", "queued")
+                elif stage_name == "build":
+                    job.publishes = future.result()
+                    job.mark("publish", "queued")
+                    submit(job, "publish", io_pool, _publish, job)
+                else:
+                    job.state = "done"
+                    print(f"[{job.name}] Published")
+    finally:
+        io_pool.shutdown(wait=True)
+        cpu_pool.shutdown(wait=True)
+
+    result = report(jobs, time.perf_counter() - start)
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    if any(job.state != "done" for job in jobs):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    Fire(run)
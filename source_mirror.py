@@ -0,0 +1,213 @@
+import io
+import json
+import os
+import re
+import time
+from pathlib import Path
+import dotenv
+from fire import Fire
+from build_cache import source_fingerprint
+from metrics import current, timed
+from transfer import TransferManager
+
+# Mirrors raw builder sources in the bucket, so builds don't download them
+# from the Hub (or need a hand-staged ~/data/mmlu) on every pod:
+#   sources/<source>/<revision sha>/<files>
+#   sources/<source>/<revision sha>/manifest.json
+#   sources/<source>/refs/<revision>
+# Hub datasets are mirrored by repo id and commit, local folders by their
+# folder name and a fingerprint of their files. With SOURCE_MIRROR_BUCKET set,
+# load_source() hydrates the source from the bucket (mirroring it first if
+# needed) and loads it from the local copy, without talking to the Hub.
+MIRROR_ENV = "SOURCE_MIRROR_BUCKET"
+PREFIX = "sources"
+DEFAULT_REVISION = "main"
+DEFAULT_SOURCES_PATH = Path.home() / ".cache" / "llm-research-data" / "sources"
+SHA = re.compile(r"[0-9a-f]{16,40}")
+_hydrated = {}  # (source, revision): local folder, per process
+
+
+def mirror_bucket():
+    return os.environ.get(MIRROR_ENV) or None
+
+
+def is_local(source):
+    # Hub ids look like 'org/name', local sources like paths.
+    return os.path.isabs(source) or source.startswith((".", "~")) or os.path.exists(source)
+
+
+def source_id(source):
+    if is_local(source):
+        return os.path.basename(os.path.normpath(os.path.expanduser(source)))
+    return source
+
+
+def _object_prefix(source, sha):
+    return f"{PREFIX}/{source_id(source)}/{sha}"
+
+
+def _ref_name(source, revision):
+    return f"{PREFIX}/{source_id(source)}/refs/{revision}"
+
+
+def local_path(source, sha):
+    # Hub sources go into the Hub cache, as snapshot_download would put them.
+    if is_local(source):
+        return Path(os.environ.get("SOURCE_MIRROR_PATH", DEFAULT_SOURCES_PATH)) / source_id(source) / sha
+    from huggingface_hub.constants import HF_HUB_CACHE
+
+    return Path(HF_HUB_CACHE) / f"datasets--{source.replace('/', '--')}" / "snapshots" / sha
+
+
+def _get_json(transfers, bucket_name, object_name):
+    def fetch():
+        response = transfers.client.get_object(bucket_name, object_name)
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+
+    return transfers.retry(fetch)
+
+
+def _put_json(transfers, bucket_name, object_name, value):
+    body = json.dumps(value, indent=2).encode()
+    transfers.retry(
+        transfers.client.put_object,
+        bucket_name,
+        object_name,
+        io.BytesIO(body),
+        len(body),
+        content_type="application/json",
+    )
+
+
+def resolve(source, revision=None, bucket_name=None):
+    # The mirrored sha of a revision, or None when it isn't mirrored.
+    bucket_name = bucket_name or mirror_bucket()
+    revision = revision or DEFAULT_REVISION
+    transfers = TransferManager.shared()
+    if SHA.fullmatch(revision) and transfers.exists(bucket_name, f"{_object_prefix(source, revision)}/manifest.json"):
+        return revision
+    if not transfers.exists(bucket_name, _ref_name(source, revision)):
+        return None
+    return _get_json(transfers, bucket_name, _ref_name(source, revision))["sha"]
+
+
+@timed("mirror_upload")
+def upload_snapshot(folder_path, bucket_name, source, sha, revision=None):
+    # Files first, then the manifest, then the ref, so readers never see a
+    # partial snapshot. Re-running skips a sha that is already mirrored.
+    transfers = TransferManager.shared()
+    prefix = _object_prefix(source, sha)
+    if not transfers.exists(bucket_name, f"{prefix}/manifest.json"):
+        batch = []
+        files = []
+        for root, _, names in sorted(os.walk(folder_path)):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                relative = Path(os.path.relpath(path, folder_path)).as_posix()
+                if relative.startswith(".cache/"):  # huggingface_hub's local_dir metadata
+                    continue
+                files.append({"path": relative, "size": os.path.getsize(path)})
+                batch.append((bucket_name, f"{prefix}/{relative}", path))
+        current().add_bytes(sum(transfers.upload_files(batch)))
+        manifest = {"source": source_id(source), "sha": sha, "files": files}
+        _put_json(transfers, bucket_name, f"{prefix}/manifest.json", manifest)
+    if revision and revision != sha:
+        _put_json(transfers, bucket_name, _ref_name(source, revision), {"sha": sha})
+
+
+def mirror(source, bucket_name=None, revision=None):
+    # Snapshots a Hub dataset (or a local folder) into the bucket.
+    bucket_name = bucket_name or mirror_bucket()
+    if not bucket_name:
+        raise ValueError(f"Pass bucket_name or set {MIRROR_ENV}")
+    start = time.perf_counter()
+    revision = revision or DEFAULT_REVISION
+    if is_local(source):
+        folder_path = os.path.expanduser(source)
+        if not os.path.isdir(folder_path):
+            raise ValueError(f"'{source}' is not a folder")
+        sha = source_fingerprint(folder_path)[:16]
+    else:
+        from huggingface_hub import snapshot_download
+
+        # The snapshot folder is named after the commit the revision points to.
+        folder_path = snapshot_download(source, repo_type="dataset", revision=revision)
+        sha = os.path.basename(folder_path)
+    upload_snapshot(folder_path, bucket_name, source, sha, revision)
+    print(f"Mirrored '{source}' at {revision} ({sha}) to bucket '{bucket_name}' in {time.perf_counter() - start:.1f}s.")
+    return sha
+
+
+@timed("hydrate")
+def hydrate(source, bucket_name=None, revision=None):
+    # Downloads a mirrored snapshot in parallel and returns its local folder,
+    # or None when the bucket doesn't have it. Files already there are kept.
+    bucket_name = bucket_name or mirror_bucket()
+    if not bucket_name:
+        raise ValueError(f"Pass bucket_name or set {MIRROR_ENV}")
+    start = time.perf_counter()
+    sha = resolve(source, revision, bucket_name)
+    if sha is None:
+        return None
+    transfers = TransferManager.shared()
+    prefix = _object_prefix(source, sha)
+    manifest = _get_json(transfers, bucket_name, f"{prefix}/manifest.json")
+    folder_path = local_path(source, sha)
+    batch = []
+    for entry in manifest["files"]:
+        path = folder_path / entry["path"]
+        if path.exists() and path.stat().st_size == entry["size"]:
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        batch.append((bucket_name, f"{prefix}/{entry['path']}", str(path)))
+    fetched = sum(transfers.download_files(batch))
+    current().add_bytes(fetched)
+    if not is_local(source) and revision != sha:
+        # Lets huggingface_hub resolve the revision offline too.
+        refs = folder_path.parent.parent / "refs"
+        refs.mkdir(parents=True, exist_ok=True)
+        (refs / (revision or DEFAULT_REVISION)).write_text(sha)
+    print(
+        f"Hydrated '{source}' ({sha}) to '{folder_path}': {len(batch)} of {len(manifest['files'])} files, "
+        f"{fetched / 2**20:.1f} MiB in {time.perf_counter() - start:.1f}s."
+    )
+    return str(folder_path)
+
+
+def local_source(source, revision=None):
+    # The local folder to build from: the source itself when it exists,
+    # otherwise the mirror's copy (mirroring Hub sources on first use). None
+    # without a mirror bucket, so callers fall back to the Hub.
+    if os.path.exists(os.path.expanduser(source)):
+        return os.path.expanduser(source)
+    if not mirror_bucket():
+        return None
+    if (source, revision) in _hydrated:
+        return _hydrated[source, revision]
+    folder_path = hydrate(source, revision=revision)
+    if folder_path is None:
+        if is_local(source):
+            raise ValueError(f"'{source}' doesn't exist and isn't mirrored in '{mirror_bucket()}'")
+        mirror(source, revision=revision)
+        folder_path = hydrate(source, revision=revision)
+    _hydrated[source, revision] = folder_path
+    return folder_path
+
+
+def load_source(dataset_name, revision=None, **kwargs):
+    # load_dataset(), from the mirror when SOURCE_MIRROR_BUCKET is set.
+    from datasets import load_dataset
+
+    folder_path = local_source(dataset_name, revision)
+    if folder_path is None:
+        return load_dataset(dataset_name, revision=revision, **kwargs)
+    return load_dataset(folder_path, **kwargs)
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    Fire({"mirror": mirror, "hydrate": hydrate, "resolve": resolve})
@@ -1,72 +1,59 @@
-import shutil
-from pathlib import Path
 import os
 from datasets import DatasetDict
-from datasets import load_dataset
 from fire import Fire
 from numpy import dot
-from utils import DatasetMover
+from splitter import train_val_test
+from metrics import stage
+from source_mirror import load_source
+from utils import cached_build, post_process, publish_dataset
 import dotenv
 
 dotenv.load_dotenv()
 
 
+@cached_build()
 def split(
     dataset_name="tatsu-lab/alpaca",
     train_size=0.75,
     test_size=0.15,
     val_size=0.1,
-    output_dir="data",
+    output_dir="dataset",
+    bucket_name="fine-tuning-research",
+    publish_mode="tarball",
+    split_key=None,
+    seed=0,
+    dedup=None,
+    contamination=None,
+    use_cache=True,
 ):
     print(f"Loading {dataset_name}")
-    dataset = load_dataset(dataset_name)
+    with stage("load") as loaded:
+        dataset = load_source(dataset_name)
+        loaded.rows_out = sum(dataset.num_rows.values())
     short_name = dataset_name.split("/")[-1]
 
     # Split the dataset
     print("Splitting the dataset")
-    if "test" not in dataset:
-        train_testvalid = dataset["train"].train_test_split(train_size=train_size)
-        test_valid = train_testvalid["test"].train_test_split(
-            test_size=test_size / (test_size + val_size)
-        )
-        train_split = train_testvalid["train"]
-        val_split = test_valid["train"]
-        test_split = test_valid["test"]
-    else:
-        test_valid = dataset["test"].train_test_split(
-            test_size=test_size / (test_size + val_size)
-        )
-        train_split = dataset["train"]
-        val_split = test_valid["train"]
-        test_split = test_valid["test"]
+    splits = train_val_test(
+        dataset, train_size, val_size, test_size, key=split_key, seed=seed
+    )
 
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     print(f"Converting {dataset_name} ad splitting it into train/val/test")
-    # Save the splits
-    splits = {}
-    splits["train"] = train_split
-    splits["val"] = val_split
-    splits["test"] = test_split
-
     combined = DatasetDict(splits)
-
-    current_directory = Path(".")
-    shutil.rmtree(current_directory / "dataset", ignore_errors=True)
-    os.mkdir(current_directory / "dataset")
-    dataset_path = (current_directory / "dataset" / short_name).as_posix()
-    combined.save_to_disk(dataset_path)
-
-    # Compress the folder
-    print(f"Compressing the folder {current_directory / 'dataset' / short_name}")
-    folder_to_compress = (current_directory / "dataset" / short_name).as_posix()
-    output_tar_file = f"{short_name}.tar.gz"
-    bucket_name = "fine-tuning-research"
-    print(f"Uploading {output_tar_file} to {bucket_name}")
-    dataset_mover = DatasetMover()
-    dataset_mover.upload(folder_to_compress, output_tar_file, bucket_name)
+    combined, index = post_process(combined, dedup, contamination)
+
+    publish_dataset(
+        combined,
+        output_dir,
+        short_name,
+        bucket_name,
+        publish_mode=publish_mode,
+        index=index,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from datasets import Dataset, DatasetDict
+from datasets.arrow_writer import ArrowWriter
+from metrics import current, timed
+
+# Rows are assigned to splits from a stable hash of a key column (or the
+# whole row), so assignments don't depend on row order, survive appends
+# and need no shuffled index mapping.
+DEFAULT_BATCH_SIZE = 100_000
+
+
+def _hash_key(seed):
+    # pandas hashes with SipHash and a 16 character key
+    return hashlib.md5(str(seed).encode()).hexdigest()[:16]
+
+
+def _key_columns(column_names, key):
+    if key is None:
+        return list(column_names)
+    if isinstance(key, str):
+        return [key]
+    return list(key)
+
+
+def _hashable(column):
+    # pandas can't hash lists, structs or maps, so nested values are hashed
+    # by their JSON serialisation.
+    if pa.types.is_nested(column.type):
+        return pa.array([json.dumps(value, sort_keys=True, default=str) for value in column.to_pylist()], pa.string())
+    return column
+
+
+def row_hashes(table, key=None, seed=0):
+    columns = _key_columns(table.column_names, key)
+    frame = pa.table({name: _hashable(table[name]) for name in columns}).to_pandas()
+    hashes = pd.util.hash_pandas_object(frame, index=False, hash_key=_hash_key(seed))
+    return hashes.to_numpy(dtype=np.uint64)
+
+
+def assign_splits(table, ratios, key=None, seed=0):
+    # Returns, per row, the index of its split in 'ratios'.
+    weights = np.array(list(ratios.values()), dtype=np.float64)
+    bounds = np.cumsum(weights / weights.sum())
+    # The top 53 bits of the hash give a uniform float in [0, 1).
+    fractions = (row_hashes(table, key, seed) >> np.uint64(11)).astype(np.float64) / 2.0**53
+    return np.minimum(np.searchsorted(bounds, fractions, side="right"), len(bounds) - 1)
+
+
+def route_splits(tables, ratios, key=None, seed=0):
+    # Streaming variant: yields (split_name, rows) for every incoming table.
+    names = list(ratios)
+    for table in tables:
+        if len(names) == 1:
+            yield names[0], table
+            continue
+        picks = assign_splits(table, ratios, key, seed)
+        for index, name in enumerate(names):
+            part = table.filter(pa.array(picks == index))
+            if part.num_rows:
+                yield name, part
+
+
+def _split_paths(dataset, ratios, key, seed):
+    # Next to the source's own cache files, named after everything that
+    # decides the rows, like the cache files of datasets' map.
+    if not dataset.cache_files:
+        return None
+    folder = os.path.dirname(dataset.cache_files[0]["filename"])
+    digest = hashlib.sha256(json.dumps([dataset._fingerprint, ratios, key, seed], default=str).encode()).hexdigest()[:16]
+    return {name: os.path.join(folder, f"split-{digest}-{name}.arrow") for name in ratios}
+
+
+def split_dataset(dataset, ratios, key=None, seed=0, batch_size=DEFAULT_BATCH_SIZE):
+    # One sequential pass over the source in batches: each batch is hashed and
+    # its rows are appended to their split's Arrow file, which is then memory
+    # mapped. Splits hold their rows contiguously, in source order, so there
+    # is no indices mapping left for save_to_disk to flatten.
+    names = list(ratios)
+    if len(names) == 1:
+        return DatasetDict({names[0]: dataset})
+    paths = _split_paths(dataset, ratios, key, seed)
+    if paths is None:
+        # In-memory sources stay in memory.
+        parts = {name: [] for name in names}
+        write = lambda name, table: parts[name].append(table)
+    else:
+        writers = {name: ArrowWriter(features=dataset.features, path=f"{paths[name]}.tmp") for name in names}
+        write = lambda name, table: writers[name].write_table(table)
+    for table in dataset.with_format("arrow").iter(batch_size=batch_size):
+        picks = assign_splits(table, ratios, key, seed)
+        for index, name in enumerate(names):
+            part = table.filter(pa.array(picks == index))
+            if part.num_rows:
+                write(name, part)
+    splits = {}
+    for name in names:
+        if paths is None:
+            table = pa.concat_tables(parts[name]) if parts[name] else dataset.data.table.schema.empty_table()
+            splits[name] = Dataset(table, info=dataset.info.copy())
+        else:
+            writers[name].finalize()
+            writers[name].close()
+            os.replace(f"{paths[name]}.tmp", paths[name])
+            splits[name] = Dataset.from_file(paths[name], info=dataset.info.copy())
+    return DatasetDict(splits)
+
+
+@timed("split")
+def train_val_test(dataset, train_size, val_size, test_size, key=None, seed=0):
+    # Carve train/val/test out of 'train', or keep 'train' and carve val/test
+    # out of an upstream 'test'.
+    current().rows_in = sum(len(split) for split in dataset.values())
+    if "test" not in dataset:
+        return split_dataset(
+            dataset["train"],
+            {"train": train_size, "val": val_size, "test": test_size},
+            key,
+            seed,
+        )
+    held_out = split_dataset(dataset["test"], {"val": val_size, "test": test_size}, key, seed)
+    return DatasetDict({"train": dataset["train"], "val": held_out["val"], "test": held_out["test"]})
@@ -0,0 +1,136 @@
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import Dataset, DatasetDict, load_dataset
+from metrics import current, timed
+from splitter import route_splits
+
+# Streaming builds hold one batch of rows at a time: source batches are
+# transformed, routed to their split and appended to size-capped Parquet
+# shards, which are then loaded back (memory-mapped) as a DatasetDict.
+DEFAULT_BATCH_SIZE = 10_000
+DEFAULT_SHARD_ROWS = 250_000
+SPLIT_ORDER = ["train", "val", "test"]
+
+
+def iter_tables(iterable_dataset, batch_size=DEFAULT_BATCH_SIZE):
+    features = iterable_dataset.features
+    schema = features.arrow_schema if features else None
+    for batch in iterable_dataset.iter(batch_size=batch_size):
+        yield pa.Table.from_pydict(batch, schema=schema)
+
+
+class ShardWriter:
+    def __init__(self, folder, max_rows=DEFAULT_SHARD_ROWS, compression="zstd"):
+        self.folder = folder
+        self.max_rows = max_rows
+        self.compression = compression
+        self.files = []
+        self.schema = None
+        self.writer = None
+        self.rows_in_shard = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _open(self):
+        path = os.path.join(self.folder, f"part-{len(self.files):05d}.parquet")
+        self.writer = pq.ParquetWriter(path, self.schema, compression=self.compression)
+        self.files.append(path)
+        self.rows_in_shard = 0
+
+    def write(self, table):
+        if self.schema is None:
+            self.schema = table.schema
+        elif table.schema != self.schema:
+            table = table.cast(self.schema)
+        while table.num_rows:
+            if self.writer is None:
+                self._open()
+            take = min(self.max_rows - self.rows_in_shard, table.num_rows)
+            self.writer.write_table(table.slice(0, take))
+            self.rows_in_shard += take
+            table = table.slice(take)
+            if self.rows_in_shard >= self.max_rows:
+                self.writer.close()
+                self.writer = None
+
+    def close(self):
+        if self.writer is None and not self.files and self.schema is not None:
+            self._open()  # An empty shard, so the split still exists
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def write_shards(routed_tables, output_path, shard_rows=DEFAULT_SHARD_ROWS, splits=()):
+    # Every split in 'splits' (the ones the routes can produce) is written,
+    # splits that got no rows as one empty shard with the schema of the others.
+    shutil.rmtree(output_path, ignore_errors=True)
+    writers = {split: ShardWriter(os.path.join(output_path, split), shard_rows) for split in splits}
+    for split, table in routed_tables:
+        if split not in writers:
+            writers[split] = ShardWriter(os.path.join(output_path, split), shard_rows)
+        writers[split].write(table)
+    schema = next((writer.schema for writer in writers.values() if writer.schema is not None), None)
+    for writer in writers.values():
+        writer.schema = writer.schema or schema
+        writer.close()
+    if schema is None:
+        raise ValueError("No rows to write, every split is empty")
+    order = sorted(writers, key=lambda s: SPLIT_ORDER.index(s) if s in SPLIT_ORDER else len(SPLIT_ORDER))
+    return {split: writers[split].files for split in order}
+
+
+def load_shards(shard_files):
+    # load_dataset converts the Parquet shards batch by batch into the
+    # memory-mapped Arrow cache, so this stays bounded too. It refuses splits
+    # without rows, those are built from the schema of their empty shard.
+    empty = [
+        split for split, files in shard_files.items() if sum(pq.ParquetFile(path).metadata.num_rows for path in files) == 0
+    ]
+    data_files = {split: files for split, files in shard_files.items() if split not in empty}
+    loaded = load_dataset("parquet", data_files=data_files) if data_files else DatasetDict()
+    splits = {}
+    for split, files in shard_files.items():
+        if split in empty:
+            splits[split] = Dataset(pq.read_schema(files[0]).empty_table()) if files else None
+        else:
+            splits[split] = loaded[split]
+    return DatasetDict({split: dataset for split, dataset in splits.items() if dataset is not None})
+
+
+def split_routes(source_splits, train_size, val_size, test_size):
+    # Same layout as the in-memory builders: carve train/val/test out of
+    # 'train', or keep 'train' and carve val/test out of an upstream 'test'.
+    if "test" not in source_splits:
+        return {"train": {"train": train_size, "val": val_size, "test": test_size}}
+    return {
+        "train": {"train": 1.0},
+        "test": {"val": val_size, "test": test_size},
+    }
+
+
+@timed("stream_build")
+def stream_build(
+    source,
+    transform,
+    output_path,
+    routes,
+    batch_size=DEFAULT_BATCH_SIZE,
+    shard_rows=DEFAULT_SHARD_ROWS,
+    split_key=None,
+    seed=0,
+):
+    # source: IterableDatasetDict; routes: {source_split: {split: ratio}}
+    def routed():
+        for source_split, ratios in routes.items():
+            tables = (transform(table) for table in iter_tables(source[source_split], batch_size))
+            yield from route_splits(tables, ratios, split_key, seed)
+
+    splits = list(dict.fromkeys(split for ratios in routes.values() for split in ratios))
+    shard_files = write_shards(routed(), output_path, shard_rows, splits)
+    for split, files in shard_files.items():
+        print(f"Wrote {len(files)} shards for split {split}")
+    dataset = load_shards(shard_files)
+    current().rows_out = sum(dataset.num_rows.values())
+    return dataset
@@ -0,0 +1,57 @@
+import os
+import socket
+import pytest
+from datasets import Dataset, DatasetDict
+
+# The S3 tests run against an in-process moto server, like benchmarks.py does
+# without an S3_ENDPOINT. One server and bucket are shared by the session, so
+# tests use their own object names.
+BUCKET = "tests"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def bucket():
+    from moto.server import ThreadedMotoServer
+    from transfer import TransferManager
+
+    port = _free_port()
+    server = ThreadedMotoServer(port=port, verbose=False)
+    server.start()
+    previous = {key: os.environ.get(key) for key in ["S3_ENDPOINT", "S3_ACCESS_KEY_ID", "S3_SECRET_ACCESS_KEY", "S3_REGION", "S3_SECURE"]}
+    os.environ.update(
+        S3_ENDPOINT=f"localhost:{port}",
+        S3_ACCESS_KEY_ID="tests",
+        S3_SECRET_ACCESS_KEY="tests",
+        S3_REGION="us-east-1",
+        S3_SECURE="false",
+    )
+    TransferManager._shared = None
+    TransferManager.shared().client.make_bucket(BUCKET)
+    yield BUCKET
+    TransferManager._shared = None
+    server.stop()
+    for key, value in previous.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+@pytest.fixture
+def saved_dataset(tmp_path):
+    # A small train/val/test dataset saved to disk, as the builders leave it.
+    splits = {
+        split: Dataset.from_dict(
+            {"prompt": [f"{split} prompt {i}" for i in range(rows)], "completion": [f"answer {i}" for i in range(rows)]}
+        )
+        for split, rows in [("train", 300), ("val", 40), ("test", 60)]
+    }
+    path = tmp_path / "dataset" / "tiny"
+    DatasetDict(splits).save_to_disk(path.as_posix())
+    return path
@@ -0,0 +1,32 @@
+import json
+import pytest
+import benchmarks
+
+STAGES = {
+    "open_instruct": ["load", "transform", "split"],
+    "text_to_sql": ["load", "transform", "split"],
+    "mmlu": ["read"],
+    "humset": ["load", "transform"],
+}
+
+
+def test_pipeline_benchmark_times_every_stage(bucket, tmp_path):
+    output = tmp_path / "baseline.json"
+    results = benchmarks.pipeline(",".join(STAGES), rows=200, output=output.as_posix(), bucket_name=bucket)
+    assert json.loads(output.read_text()) == results
+    for result in results:
+        expected = STAGES[result["builder"]] + ["save_to_disk", "compress", "upload", "download"]
+        assert list(result["stages"]) == expected
+        assert all(stage["seconds"] >= 0 for stage in result["stages"].values())
+
+
+def test_compare_flags_regressions(tmp_path):
+    def write(name, seconds):
+        path = tmp_path / name
+        path.write_text(json.dumps([{"builder": "mmlu", "stages": {"read": {"seconds": seconds}}}]))
+        return path.as_posix()
+
+    baseline = write("baseline.json", 1.0)
+    benchmarks.compare(baseline, write("same.json", 1.1))
+    with pytest.raises(SystemExit):
+        benchmarks.compare(baseline, write("slower.json", 1.5))
@@ -0,0 +1,63 @@
+import importlib
+import sys
+import threading
+from build_cache import BuildCache, code_fingerprint, repo_modules
+
+
+def _dataset_folder(path, files=200):
+    path.mkdir(parents=True)
+    for i in range(files):
+        (path / f"shard-{i}.arrow").write_bytes(b"x" * 1024)
+    return path
+
+
+def test_concurrent_stores(tmp_path):
+    # A tiny max_bytes makes every store evict, while the other one is storing.
+    cache = BuildCache(tmp_path / "cache", max_bytes=1)
+    sources = [_dataset_folder(tmp_path / f"source-{i}") for i in range(2)]
+    errors = []
+
+    def store(key, source):
+        try:
+            for _ in range(5):
+                cache.store(key, source)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store, args=(f"key-{i}", source)) for i, source in enumerate(sources)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    # Nothing but complete entries is left behind.
+    for entry in (tmp_path / "cache").iterdir():
+        if entry.name != ".staging":
+            assert cache.lookup(entry.name) is not None
+    assert not list((tmp_path / "cache" / ".staging").iterdir())
+
+
+def test_same_key_stored_twice(tmp_path):
+    cache = BuildCache(tmp_path / "cache")
+    source = _dataset_folder(tmp_path / "source", files=3)
+    cache.store("key", source, version="1")
+    cache.store("key", source, version="2")
+    assert cache.lookup("key")["version"] == "2"
+    assert len(list(cache.dataset_path("key").iterdir())) == 3
+
+
+def test_lazy_post_process_imports_are_fingerprinted(tmp_path, monkeypatch):
+    import open_instruct
+
+    names = {path.name for path in repo_modules(open_instruct.split)}
+    assert {"dedup.py", "contamination.py", "packing.py"} <= names
+
+    # Editing a module only imported inside a function changes the key.
+    (tmp_path / "fp_builder.py").write_text("def build():\n    from fp_helper import THRESHOLD\n    return THRESHOLD\n")
+    (tmp_path / "fp_helper.py").write_text("THRESHOLD = 0.8\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    builder = importlib.import_module("fp_builder")
+    before = code_fingerprint(builder.build)
+    (tmp_path / "fp_helper.py").write_text("THRESHOLD = 0.9\n")
+    assert code_fingerprint(builder.build) != before
+    sys.modules.pop("fp_builder", None)
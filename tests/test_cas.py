@@ -0,0 +1,58 @@
+from datasets import Dataset, DatasetDict, load_from_disk
+from transfer import TransferManager
+from utils import BLOBS_PREFIX, DatasetMover
+
+
+def _blobs(bucket):
+    client = TransferManager.shared().client
+    return {item.object_name for item in client.list_objects(bucket, prefix=f"{BLOBS_PREFIX}/", recursive=True)}
+
+
+def test_publish_fetch_round_trip(bucket, saved_dataset, tmp_path):
+    mover = DatasetMover()
+    manifest = mover.publish(saved_dataset.as_posix(), bucket, "cas-tiny", version="1")
+    assert manifest["version"] == "1"
+    dataset_path = mover.fetch(bucket, "cas-tiny", (tmp_path / "fetched").as_posix(), store_path=tmp_path / "store")
+    fetched = load_from_disk(dataset_path)
+    expected = load_from_disk(saved_dataset.as_posix())
+    for split in expected:
+        assert fetched[split].to_dict() == expected[split].to_dict()
+
+
+def test_new_version_only_uploads_changed_files(bucket, saved_dataset, tmp_path):
+    mover = DatasetMover()
+    mover.publish(saved_dataset.as_posix(), bucket, "cas-versions", version="1")
+    before = _blobs(bucket)
+
+    dataset = load_from_disk(saved_dataset.as_posix())
+    changed = DatasetDict({**dataset, "test": Dataset.from_dict({"prompt": ["new"], "completion": ["row"]})})
+    changed_path = tmp_path / "changed" / "tiny"
+    changed.save_to_disk(changed_path.as_posix())
+    manifest = mover.publish(changed_path.as_posix(), bucket, "cas-versions", version="2")
+    new_blobs = _blobs(bucket) - before
+    assert 0 < len(new_blobs) < len(manifest["files"])
+
+    # Both versions stay fetchable, and 'latest' is the newest.
+    for version, rows in [("1", 60), ("2", 1), ("latest", 1)]:
+        path = mover.fetch(bucket, "cas-versions", (tmp_path / version).as_posix(), version=version, store_path=tmp_path / "store")
+        assert len(load_from_disk(path)["test"]) == rows
+
+
+def test_cache_hit_of_unversioned_build_is_not_republished(bucket, saved_dataset, tmp_path, monkeypatch):
+    from build_cache import BuildCache, current_build
+    from utils import publish_cached, publish_dataset
+
+    monkeypatch.chdir(tmp_path)
+    cache = BuildCache(tmp_path / "cache")
+    token = current_build.set((cache, "unversioned"))
+    try:
+        publish_dataset(load_from_disk(saved_dataset.as_posix()), "output", "cas-cached", bucket, publish_mode="cas")
+    finally:
+        current_build.reset(token)
+    published = cache.lookup("unversioned")["published"]
+
+    calls = []
+    monkeypatch.setattr(DatasetMover, "publish", lambda *args, **kwargs: calls.append(args))
+    publish_cached(cache, "unversioned", "output", "cas-cached", bucket, publish_mode="cas")
+    assert calls == []
+    assert cache.lookup("unversioned")["published"] == published
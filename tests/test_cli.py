@@ -0,0 +1,15 @@
+import os
+import pytest
+from benchmarks import _startup, startup_checks
+
+# The checks of 'python benchmarks.py startup'; slow machines can raise the
+# budget with CLI_STARTUP_BUDGET.
+BUDGET = float(os.environ.get("CLI_STARTUP_BUDGET", "1.0"))
+CHECKS = startup_checks()
+
+
+@pytest.mark.parametrize("command", list(CHECKS))
+def test_command_starts_within_budget(command):
+    seconds, heavy = min(_startup(CHECKS[command]) for _ in range(3))
+    assert heavy == []
+    assert seconds <= BUDGET
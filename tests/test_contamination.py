@@ -0,0 +1,96 @@
+import json
+import numpy as np
+import pytest
+from datasets import Dataset, DatasetDict
+from contamination import NgramIndex, check, check_splits
+
+WORDS = [f"word{i}" for i in range(1000)]
+
+
+def _texts(count, length=30, seed=0):
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(WORDS, length)) for _ in range(count)]
+
+
+def _dataset(prompts):
+    return Dataset.from_dict({"prompt": prompts, "completion": [""] * len(prompts)})
+
+
+def _splits():
+    train = _texts(100)
+    fresh = _texts(10, seed=1)
+    # val: 5 clean rows, an exact train row and one that shares 2/3 of a train row.
+    half = " ".join(train[1].split()[:20] + fresh[9].split()[20:])
+    return DatasetDict(
+        {
+            "train": _dataset(train),
+            "val": _dataset(fresh[:5] + [train[0], half]),
+            "test": _dataset(fresh[5:9] + [train[0]]),
+        }
+    )
+
+
+def test_bloom_filter():
+    rng = np.random.default_rng(0)
+    index = NgramIndex.empty(10_000, error_rate=0.01)
+    added = rng.integers(0, 2**63, size=10_000, dtype=np.uint64)
+    index.add(added)
+    assert index.contains(added).all()
+    others = rng.integers(0, 2**63, size=100_000, dtype=np.uint64)
+    assert index.contains(others).mean() < 0.02
+
+
+def test_overlap_scores():
+    dataset = _splits()
+    index = NgramIndex.build(dataset["train"], ngram=8)
+    scores = index.score(dataset["val"])
+    assert scores[5] == 1.0
+    assert 0.5 <= scores[6] < 1.0
+    assert scores[:5].max() < 0.1
+
+
+def test_report_keeps_every_row():
+    dataset = _splits()
+    checked, _, reports = check_splits(dataset, "report")
+    assert checked.num_rows == dataset.num_rows
+    assert [(r["split"], r["contaminated"]) for r in reports] == [("val", 2), ("test", 1)]
+    assert check_splits(dataset, "report", threshold=1.0)[2][0]["contaminated"] == 1
+
+
+def test_drop():
+    dataset = _splits()
+    checked, _, _ = check_splits(dataset, "drop")
+    assert checked["val"]["prompt"] == dataset["val"]["prompt"][:5]
+    assert checked["test"]["prompt"] == dataset["test"]["prompt"][:4]
+    assert checked["train"]["prompt"] == dataset["train"]["prompt"]
+
+
+def test_move_skips_rows_train_already_holds():
+    dataset = _splits()
+    checked, _, _ = check_splits(dataset, "move")
+    assert checked["val"]["prompt"] == dataset["val"]["prompt"][:5]
+    # The exact copy of train[0] (in val and test) isn't added again, the partial overlap is.
+    assert list(checked["train"]["prompt"]) == list(dataset["train"]["prompt"]) + [dataset["val"]["prompt"][6]]
+
+
+def test_unknown_action():
+    with pytest.raises(ValueError):
+        check_splits(_splits(), "keep")
+
+
+def test_check_reloads_the_saved_index(tmp_path):
+    dataset = _splits()
+    _, index, _ = check_splits(dataset, "report")
+    dataset_path = tmp_path / "dataset"
+    dataset.save_to_disk(dataset_path.as_posix())
+    index.save_with(dataset_path.as_posix())
+    dataset["val"].save_to_disk((tmp_path / "eval").as_posix())
+
+    loaded = NgramIndex.load((dataset_path / "ngram_index").as_posix())
+    assert np.array_equal(loaded.bits, index.bits)
+    assert json.loads((dataset_path / "ngram_index" / "report.json").read_text())[0]["contaminated"] == 2
+    output = tmp_path / "report.json"
+    check(dataset_path.as_posix(), (tmp_path / "eval").as_posix(), split="val", output=output.as_posix())
+    report = json.loads(output.read_text())
+    assert report["contaminated"] == 2
+    assert [example["row"] for example in report["examples"]] == [5, 6]
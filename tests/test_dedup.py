@@ -0,0 +1,91 @@
+import numpy as np
+from datasets import Dataset, DatasetDict
+from dedup import _near_duplicates, _union, dedup_splits, find_duplicates
+
+WORDS = [f"word{i}" for i in range(500)]
+
+
+def _texts(count, length=40, seed=0):
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(WORDS, length)) for _ in range(count)]
+
+
+def _near_copy(text, changes=1):
+    words = text.split()
+    for i in range(changes):
+        words[-1 - 2 * i] = "changed"
+    return " ".join(words)
+
+
+def _dataset(prompts):
+    return Dataset.from_dict({"prompt": prompts, "completion": [""] * len(prompts)})
+
+
+def test_exact_duplicates_ignore_case_and_whitespace():
+    texts = _texts(20)
+    prompts = texts + ["  " + texts[3].upper().replace(" ", "\n  "), texts[7]]
+    keep, report = find_duplicates(_dataset(prompts), near=False)
+    assert keep.tolist() == list(range(20))
+    assert report["exact_duplicates"] == 2
+
+
+def test_planted_near_duplicates():
+    texts = _texts(50)
+    # Rows 50-52 edit one or two words of rows 5, 10 and 5 (Jaccard >= 0.85
+    # on 5-grams); row 53 edits three, which is below the 0.8 threshold.
+    prompts = texts + [_near_copy(texts[5]), _near_copy(texts[10]), _near_copy(texts[5], 2), _near_copy(texts[5], 3)]
+    keep, report = find_duplicates(_dataset(prompts))
+    assert keep.tolist() == list(range(50)) + [53]
+    assert report["near_duplicates"] == 3
+    assert report["near_clusters"] == 2
+    assert report["largest_clusters"][0] == {"row": 5, "size": 3}
+
+
+def test_unrelated_rows_are_kept():
+    keep, report = find_duplicates(_dataset(_texts(200, length=20)))
+    assert len(keep) == 200
+    assert report["near_duplicates"] == 0
+
+
+def test_union_roots_clusters_at_their_first_row():
+    parent = _union(np.arange(6), np.array([2, 3, 5]), np.array([3, 1, 4]))
+    assert parent.tolist() == [0, 1, 1, 1, 4, 4]
+
+
+def test_band_collisions_are_confirmed_by_similarity():
+    num_perm, bands = 8, 4
+    rng = np.random.default_rng(0)
+    signatures = rng.integers(0, 2**32, size=(4, num_perm), dtype=np.uint32)
+    # Rows 0 and 1 share one band but only 2 of 8 values; rows 2 and 3 share 7 of 8.
+    signatures[1, :2] = signatures[0, :2]
+    signatures[3, 1:] = signatures[2, 1:]
+    roots = _near_duplicates(signatures, np.arange(4), num_perm, bands, threshold=0.8)
+    assert roots.tolist() == [0, 1, 2, 2]
+
+
+def test_num_proc_parity():
+    texts = _texts(300)
+    prompts = texts + [_near_copy(text) for text in texts[::7]] + texts[::11]
+    dataset = _dataset(prompts)
+    single, single_report = find_duplicates(dataset, batch_size=64)
+    forked, forked_report = find_duplicates(dataset, batch_size=64, num_proc=2)
+    assert np.array_equal(single, forked)
+    assert single_report == forked_report
+    assert single.tolist() == list(range(300))
+
+
+def test_dedup_splits_keeps_the_first_copy_in_split_order():
+    texts = _texts(30)
+    dataset = DatasetDict(
+        {
+            "train": _dataset(texts[:20]),
+            "val": _dataset(texts[20:25] + [texts[0], _near_copy(texts[1])]),
+            "test": _dataset(texts[25:] + [texts[21]]),
+        }
+    )
+    deduped, report = dedup_splits(dataset)
+    assert deduped["train"]["prompt"] == texts[:20]
+    assert deduped["val"]["prompt"] == texts[20:25]
+    assert deduped["test"]["prompt"] == texts[25:]
+    assert report["exact_duplicates"] == 2
+    assert report["near_duplicates"] == 1
@@ -0,0 +1,76 @@
+import json
+import numpy as np
+import pyarrow as pa
+import pytest
+import distributed
+import parquet_store
+from splitter import assign_splits
+
+ROWS = 1000
+
+
+@pytest.fixture
+def source(tmp_path):
+    # A local folder source with one 'train' split; the 'split' builder has
+    # no transform, so the rows go through as they are.
+    folder = tmp_path / "distributed-source"
+    folder.mkdir()
+    rows = [{"prompt": f"prompt {i}", "completion": f"completion {i}"} for i in range(ROWS)]
+    (folder / "train.jsonl").write_text("".join(json.dumps(row) + "\n" for row in rows))
+    return folder, rows
+
+
+def _plan(bucket, folder, short_name="dist-tiny"):
+    return distributed.plan("split", bucket, dataset_name=folder.as_posix(), short_name=short_name, shard_rows=300)
+
+
+def test_plan_work_assemble(bucket, source, tmp_path):
+    folder, rows = source
+    job = _plan(bucket, folder)
+    assert _plan(bucket, folder) == job  # Planning again resumes the same job
+
+    work_dir = (tmp_path / "builds").as_posix()
+    assert distributed.work(job, 0, 2, bucket, work_dir) == []
+    with pytest.raises(RuntimeError):
+        distributed.assemble(job, bucket)  # Worker 1's shards are missing
+    assert distributed.work(job, 1, 2, bucket, work_dir) == []
+    manifest = distributed.assemble(job, bucket)
+
+    # Every row lands in the split its hash picks, as in a one-machine build.
+    table = pa.Table.from_pylist(rows)
+    picks = assign_splits(table, {"train": 0.75, "val": 0.1, "test": 0.15})
+    for index, split in enumerate(["train", "val", "test"]):
+        expected = sorted(table.filter(pa.array(picks == index))["prompt"].to_pylist())
+        assert manifest["splits"][split]["rows"] == len(expected)
+        built = parquet_store.open_split(bucket, "dist-tiny", split).to_table()
+        assert sorted(built["prompt"].to_pylist()) == expected
+
+
+def test_rerun_skips_done_shards(bucket, source, tmp_path, monkeypatch):
+    folder, _ = source
+    job = _plan(bucket, folder, "dist-rerun")
+    work_dir = (tmp_path / "builds").as_posix()
+    built = []
+    build_shard = distributed._build_shard
+    monkeypatch.setattr(distributed, "_build_shard", lambda spec, shard, *args: (built.append(shard["index"]), build_shard(spec, shard, *args)))
+
+    distributed.work(job, 0, 1, bucket, work_dir)
+    assert built == [0, 1, 2, 3]
+    built.clear()
+    distributed.work(job, 0, 1, bucket, work_dir)
+    assert built == []
+
+
+def test_failed_shard_is_retried_then_reported(bucket, source, tmp_path, monkeypatch):
+    folder, _ = source
+    job = _plan(bucket, folder, "dist-failing")
+    attempts = []
+
+    def failing(spec, shard, *args):
+        attempts.append(shard["index"])
+        raise RuntimeError("worker crashed")
+
+    monkeypatch.setattr(distributed, "_build_shard", failing)
+    failed = distributed.work(job, 0, 1, bucket, (tmp_path / "builds").as_posix(), retries=1)
+    assert failed == [0, 1, 2, 3]
+    assert attempts == [0, 0, 1, 1, 2, 2, 3, 3]
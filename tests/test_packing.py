@@ -0,0 +1,74 @@
+import numpy as np
+from datasets import Dataset
+import packing
+from packing import _packed_rows, pack, plan_bins
+
+BOS, EOS = 1, 2
+
+
+class StubTokenizer:
+    # One id per word, prompts start with BOS like a real tokenizer.
+    eos_token_id = EOS
+
+    def __call__(self, texts, add_special_tokens=True):
+        prefix = [BOS] if add_special_tokens else []
+        return {"input_ids": [prefix + [len(word) + 10 for word in text.split()] for text in texts]}
+
+
+def _tokens(prompts, completions):
+    return Dataset.from_dict({"prompt_ids": prompts, "completion_ids": completions})
+
+
+def test_offsets_and_eos():
+    tokens = _tokens([[1, 11], [1, 12, 13], [1]], [[21, 22], [23], [24, 25, 26]])
+    rows = list(_packed_rows(tokens, [[0, 2], [1]], 16, EOS))
+    assert rows[0] == {
+        "input_ids": [1, 11, 21, 22, EOS, 1, 24, 25, 26, EOS],
+        "example_starts": [0, 5],
+        "completion_starts": [2, 6],
+        "length": 10,
+    }
+    assert rows[1]["input_ids"] == [1, 12, 13, 23, EOS]
+    assert rows[1]["completion_starts"] == [3]
+
+
+def test_truncation_and_no_eos():
+    tokens = _tokens([[1, 11, 12, 13]], [[21, 22, 23]])
+    (row,) = _packed_rows(tokens, [[0]], 5, EOS)
+    assert row["input_ids"] == [1, 11, 12, 13, 21]
+    assert row["completion_starts"] == [4]
+    (row,) = _packed_rows(tokens, [[0]], 3, None)
+    assert row["input_ids"] == [1, 11, 12]
+    assert row["completion_starts"] == [3]
+    (row,) = _packed_rows(tokens, [[0]], 16, None)
+    assert row["input_ids"][-1] == 23
+
+
+def test_plan_bins_fit():
+    lengths = np.random.default_rng(0).integers(1, 40, size=500)
+    bins = plan_bins(lengths, 64)
+    assert sorted(index for members in bins for index in members) == list(range(500))
+    assert max(lengths[members].sum() for members in bins) <= 64
+
+
+def test_pack_round_trip(monkeypatch):
+    monkeypatch.setitem(packing._tokenizers, "stub", StubTokenizer())
+    rng = np.random.default_rng(0)
+    prompts = [" ".join(["p" * int(n)] * int(rng.integers(1, 20))) for n in rng.integers(1, 5, size=200)]
+    completions = [" ".join(["cc"] * int(n)) for n in rng.integers(1, 30, size=200)]
+    dataset = Dataset.from_dict({"prompt": prompts, "completion": completions})
+    tokens, packed, report = pack(dataset, "stub", 64)
+    assert tokens.column_names == ["prompt", "completion", "prompt_len", "completion_len"]
+    assert report["packed_rows"] == len(packed) < len(dataset)
+    assert report["truncated_examples"] == 0
+    examples = []
+    for row in packed:
+        assert row["length"] == len(row["input_ids"]) <= 64
+        ends = row["example_starts"][1:] + [row["length"]]
+        for start, completion_start, end in zip(row["example_starts"], row["completion_starts"], ends):
+            example = row["input_ids"][start:end]
+            assert example[0] == BOS and example[-1] == EOS
+            assert set(example[completion_start - start : -1]) == {12}  # "cc"
+            examples.append(example)
+    assert len(examples) == len(dataset)
+    assert sum(map(len, examples)) == report["tokens"]
@@ -0,0 +1,26 @@
+from datasets import load_from_disk
+from parquet_store import download, manifest_name, object_prefix, publish_parquet
+from transfer import TransferManager
+
+
+def _objects(bucket, prefix):
+    client = TransferManager.shared().client
+    return {item.object_name for item in client.list_objects(bucket, prefix=f"{prefix}/", recursive=True)}
+
+
+def test_republish_removes_stale_shards(bucket, saved_dataset, tmp_path):
+    dataset_path = saved_dataset.as_posix()
+    first = publish_parquet(dataset_path, bucket, "pq-tiny", version="1", max_shard_bytes=1024)
+    assert len(first["splits"]["train"]["files"]) > 1
+    second = publish_parquet(dataset_path, bucket, "pq-tiny", version="1")
+    assert len(second["splits"]["train"]["files"]) == 1
+
+    listed = {entry["object"] for split in second["splits"].values() for entry in split["files"]}
+    prefix = object_prefix("pq-tiny", "1")
+    assert _objects(bucket, prefix) - {manifest_name("pq-tiny", "1")} <= listed | set(second["extra"])
+    assert listed <= _objects(bucket, prefix)
+
+    fetched = download(bucket, "pq-tiny", (tmp_path / "fetched").as_posix(), version="1")
+    expected = load_from_disk(dataset_path)
+    for split in expected:
+        assert fetched[split].to_dict() == expected[split].to_dict()
@@ -0,0 +1,37 @@
+import os
+import pytest
+from datasets import load_from_disk
+from utils import DatasetMover
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd", "store"])
+def test_download_single_split(bucket, saved_dataset, tmp_path, monkeypatch, codec):
+    monkeypatch.chdir(tmp_path)
+    object_name = f"seekable-{codec}.tar"
+    mover = DatasetMover()
+    mover.upload(saved_dataset.as_posix(), object_name, bucket, codec=codec, seekable=True)
+    output_path = tmp_path / "partial"
+    mover.download(bucket, object_name, output_path.as_posix(), splits=["test"])
+
+    assert sorted(os.listdir(output_path / "tiny")) == ["dataset_dict.json", "test"]
+    partial = load_from_disk((output_path / "tiny").as_posix())
+    assert list(partial) == ["test"]
+    assert partial["test"].to_dict() == load_from_disk(saved_dataset.as_posix())["test"].to_dict()
+
+
+def test_seekable_archive_is_a_plain_archive(bucket, saved_dataset, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mover = DatasetMover()
+    mover.upload(saved_dataset.as_posix(), "seekable-full.tar.gz", bucket, seekable=True)
+    output_path = tmp_path / "full"
+    mover.download(bucket, "seekable-full.tar.gz", output_path.as_posix())
+    assert list(load_from_disk((output_path / "tiny").as_posix())) == ["train", "val", "test"]
+
+
+def test_archive_without_index_falls_back_to_full_download(bucket, saved_dataset, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mover = DatasetMover()
+    mover.upload(saved_dataset.as_posix(), "plain.tar.gz", bucket)
+    output_path = tmp_path / "fallback"
+    mover.download(bucket, "plain.tar.gz", output_path.as_posix(), splits=["test"])
+    assert list(load_from_disk((output_path / "tiny").as_posix())) == ["train", "val", "test"]
@@ -0,0 +1,54 @@
+import json
+import pytest
+import source_mirror
+
+
+@pytest.fixture
+def mirror_env(bucket, tmp_path, monkeypatch):
+    import huggingface_hub.constants
+
+    monkeypatch.setenv(source_mirror.MIRROR_ENV, bucket)
+    monkeypatch.setenv("SOURCE_MIRROR_PATH", (tmp_path / "sources").as_posix())
+    monkeypatch.setattr(huggingface_hub.constants, "HF_HUB_CACHE", (tmp_path / "hub").as_posix())
+    monkeypatch.setattr(source_mirror, "_hydrated", {})
+    return bucket
+
+
+def _write_jsonl(path, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+
+
+def test_mirror_and_hydrate_local_folder(mirror_env, tmp_path):
+    folder = tmp_path / "raw" / "mirror-mmlu"
+    _write_jsonl(folder / "test" / "anatomy.jsonl", [{"q": "a"}, {"q": "b"}])
+    _write_jsonl(folder / "dev" / "anatomy.jsonl", [{"q": "c"}])
+    sha = source_mirror.mirror(folder.as_posix())
+    assert source_mirror.resolve(folder.as_posix()) == sha
+
+    # A pod without the folder hydrates it from the bucket, by folder name.
+    missing = (tmp_path / "elsewhere" / "mirror-mmlu").as_posix()
+    hydrated = source_mirror.local_source(missing)
+    assert hydrated == (tmp_path / "sources" / "mirror-mmlu" / sha).as_posix()
+    for relative in ["test/anatomy.jsonl", "dev/anatomy.jsonl"]:
+        assert (tmp_path / "sources" / "mirror-mmlu" / sha / relative).read_text() == (folder / relative).read_text()
+
+
+def test_load_source_builds_hub_dataset_from_mirror(mirror_env, tmp_path, monkeypatch):
+    # A Hub snapshot mirrored earlier; the Hub itself is never contacted.
+    snapshot = tmp_path / "snapshot"
+    _write_jsonl(snapshot / "train.jsonl", [{"prompt": f"p{i}", "completion": f"c{i}"} for i in range(5)])
+    sha = "0123456789abcdef0123456789abcdef01234567"
+    source_mirror.upload_snapshot(snapshot.as_posix(), mirror_env, "fake-org/fake-data", sha, "main")
+    monkeypatch.setenv("HF_HUB_OFFLINE", "1")
+
+    dataset = source_mirror.load_source("fake-org/fake-data")
+    assert dataset["train"]["prompt"] == [f"p{i}" for i in range(5)]
+    hub_folder = tmp_path / "hub" / "datasets--fake-org--fake-data"
+    assert (hub_folder / "snapshots" / sha / "train.jsonl").exists()
+    assert (hub_folder / "refs" / "main").read_text() == sha
+
+
+def test_unmirrored_local_source_fails(mirror_env, tmp_path):
+    with pytest.raises(ValueError):
+        source_mirror.local_source((tmp_path / "not-mirrored").as_posix())
@@ -0,0 +1,57 @@
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset, DatasetDict, load_from_disk
+from splitter import row_hashes, split_dataset, train_val_test
+
+RATIOS = {"train": 0.8, "val": 0.1, "test": 0.1}
+
+
+def test_row_hashes_of_nested_columns():
+    table = pa.table({"a": [[1, 2], [3]], "b": ["x", "y"], "c": [{"k": 1}, {"k": 2}]})
+    hashes = row_hashes(table)
+    assert len(set(hashes.tolist())) == 2
+    assert np.array_equal(hashes, row_hashes(table))
+    assert not np.array_equal(hashes, row_hashes(table, seed=1))
+
+
+def test_splits_are_flattened_in_source_order():
+    dataset = Dataset.from_dict({"id": list(range(5000)), "tags": [[i % 7] for i in range(5000)]})
+    splits = split_dataset(dataset, RATIOS)
+    # Copied out once, so save_to_disk has no indices mapping to flatten.
+    for split in splits.values():
+        assert split._indices is None
+        assert split.data.num_rows == len(split)
+    ids = [list(split["id"]) for split in splits.values()]
+    assert sorted(sum(ids, [])) == list(range(5000))
+    assert all(part == sorted(part) for part in ids)
+    assert 3800 < len(splits["train"]) < 4200
+
+
+def test_memory_mapped_splits(tmp_path):
+    Dataset.from_dict({"id": list(range(3000))}).save_to_disk((tmp_path / "source").as_posix())
+    dataset = load_from_disk((tmp_path / "source").as_posix())
+    splits = split_dataset(dataset, RATIOS, key="id", batch_size=500)
+    for split in splits.values():
+        assert split._indices is None
+        assert split.cache_files and split.cache_files[0]["filename"].startswith(str(tmp_path / "source"))
+    in_memory = split_dataset(Dataset.from_dict({"id": list(range(3000))}), RATIOS, key="id")
+    assert {name: split["id"] for name, split in splits.items()} == {name: split["id"] for name, split in in_memory.items()}
+
+
+def test_assignment_survives_appends_and_order():
+    rows = [f"row {i}" for i in range(2000)]
+    first = train_val_test(DatasetDict({"train": Dataset.from_dict({"text": rows})}), 0.8, 0.1, 0.1, key="text")
+    more = train_val_test(
+        DatasetDict({"train": Dataset.from_dict({"text": rows[::-1] + ["new 1", "new 2"]})}), 0.8, 0.1, 0.1, key="text"
+    )
+    for split in RATIOS:
+        assert set(first[split]["text"]) <= set(more[split]["text"])
+
+
+def test_upstream_test_split_is_carved_into_val_and_test():
+    dataset = DatasetDict(
+        {"train": Dataset.from_dict({"x": list(range(100))}), "test": Dataset.from_dict({"x": list(range(100, 400))})}
+    )
+    splits = train_val_test(dataset, 0.8, 0.1, 0.1)
+    assert len(splits["train"]) == 100
+    assert sorted(list(splits["val"]["x"]) + list(splits["test"]["x"])) == list(range(100, 400))
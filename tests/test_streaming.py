@@ -0,0 +1,27 @@
+import os
+import pyarrow as pa
+import pytest
+from datasets import Dataset
+from streaming import load_shards, stream_build, write_shards
+
+
+def test_empty_splits_are_kept(tmp_path):
+    table = pa.table({"prompt": ["a", "b", "c"], "completion": ["x", "y", "z"]})
+    shard_files = write_shards([("train", table)], str(tmp_path / "shards"), 2, ["train", "val", "test"])
+    assert list(shard_files) == ["train", "val", "test"]
+    assert len(shard_files["train"]) == 2
+    dataset = load_shards(shard_files)
+    assert dataset.num_rows == {"train": 3, "val": 0, "test": 0}
+    assert dataset["val"].column_names == ["prompt", "completion"]
+
+
+def test_no_rows_at_all(tmp_path):
+    with pytest.raises(ValueError):
+        write_shards([], str(tmp_path / "shards"))
+
+
+def test_only_routed_splits_are_written(tmp_path):
+    source = {"train": Dataset.from_dict({"prompt": ["a", "b"], "completion": ["x", "y"]}).to_iterable_dataset()}
+    dataset = stream_build(source, lambda table: table, str(tmp_path / "shards"), {"train": {"batch_inference": 1.0}})
+    assert list(dataset) == ["batch_inference"]
+    assert sorted(os.listdir(tmp_path / "shards")) == ["batch_inference"]
@@ -0,0 +1,139 @@
+import io
+import os
+import tarfile
+import pytest
+from datasets import load_from_disk
+from transfer import MIN_PART_SIZE, TransferManager
+from utils import DatasetMover
+
+
+def _assert_same_dataset(expected_path, actual_path):
+    expected = load_from_disk(str(expected_path))
+    actual = load_from_disk(str(actual_path))
+    assert list(actual) == list(expected)
+    for split in expected:
+        assert actual[split].to_dict() == expected[split].to_dict()
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_upload_download_round_trip(bucket, saved_dataset, tmp_path, monkeypatch, streaming):
+    monkeypatch.chdir(tmp_path)
+    object_name = f"round-trip-{streaming}.tar.gz"
+    mover = DatasetMover()
+    mover.upload(saved_dataset.as_posix(), object_name, bucket, streaming=streaming, part_size=MIN_PART_SIZE)
+    output_path = tmp_path / "downloaded"
+    mover.download(bucket, object_name, output_path.as_posix(), streaming=streaming, part_size=MIN_PART_SIZE)
+    _assert_same_dataset(saved_dataset, output_path / "tiny")
+
+
+def test_download_rejects_truncated_archive(bucket, saved_dataset, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mover = DatasetMover()
+    mover.upload(saved_dataset.as_posix(), "truncated.tar.gz", bucket)
+    transfers = TransferManager.shared()
+    transfers.download_file(bucket, "truncated.tar.gz", "full.tar.gz")
+    with open("full.tar.gz", "rb") as f:
+        data = f.read()[:-1000]
+    transfers.client.put_object(bucket, "truncated.tar.gz", io.BytesIO(data), len(data))
+    with pytest.raises((EOFError, tarfile.ReadError)):
+        mover.download(bucket, "truncated.tar.gz", (tmp_path / "out").as_posix())
+
+
+@pytest.fixture
+def big_file(tmp_path):
+    path = tmp_path / "big.bin"
+    path.write_bytes(os.urandom(2 * MIN_PART_SIZE + 12345))
+    return path
+
+
+def _put_tar(bucket, object_name, folder, corrupt=False):
+    # A plain tar followed by more bytes than a pipe buffers.
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        tar.add(folder, arcname=os.path.basename(folder))
+    data = data.getvalue()
+    if corrupt:
+        data = data[:100] + b"\xff" * 100 + data[200:]
+    data += os.urandom(MIN_PART_SIZE // 4)
+    TransferManager.shared().client.put_object(bucket, object_name, io.BytesIO(data), len(data))
+
+
+def test_streaming_download_drains_trailing_bytes(bucket, saved_dataset, tmp_path):
+    _put_tar(bucket, "trailing.tar", saved_dataset.as_posix())
+    output_path = tmp_path / "downloaded"
+    DatasetMover().download(bucket, "trailing.tar", output_path.as_posix(), streaming=True)
+    _assert_same_dataset(saved_dataset, output_path / "tiny")
+
+
+def test_streaming_download_raises_extraction_error(bucket, saved_dataset, tmp_path):
+    _put_tar(bucket, "corrupt.tar", saved_dataset.as_posix(), corrupt=True)
+    with pytest.raises(tarfile.ReadError):
+        DatasetMover().download(bucket, "corrupt.tar", (tmp_path / "out").as_posix(), streaming=True)
+
+
+def test_multipart_upload_resumes_own_upload(bucket, big_file, tmp_path):
+    transfers = TransferManager(part_size=MIN_PART_SIZE, retries=0, state_path=tmp_path / "uploads")
+    state_path = transfers.upload_state_path(bucket, "resume/big.bin", big_file.as_posix())
+    upload_part = transfers._upload_part
+    uploaded = []
+    failing = [3]
+
+    def flaky_part(*args):
+        if args[4] in failing:
+            raise RuntimeError("interrupted")
+        uploaded.append(args[4])
+        return upload_part(*args)
+
+    transfers._upload_part = flaky_part
+    with pytest.raises(RuntimeError):
+        transfers.upload_file(bucket, "resume/big.bin", big_file.as_posix(), metadata={"codec": "store"})
+    assert state_path.exists()
+    # Nothing is left next to the uploaded file.
+    assert not list(big_file.parent.glob("*.json"))
+
+    # Only the failed part goes up again.
+    failing.clear()
+    uploaded.clear()
+    transfers.upload_file(bucket, "resume/big.bin", big_file.as_posix(), metadata={"codec": "store"})
+    assert uploaded == [3]
+    assert not state_path.exists()
+    stat = transfers.client.stat_object(bucket, "resume/big.bin")
+    assert stat.size == big_file.stat().st_size
+    assert stat.metadata["x-amz-meta-codec"] == "store"
+
+
+def test_multipart_upload_ignores_foreign_upload(bucket, big_file, tmp_path):
+    transfers = TransferManager(part_size=MIN_PART_SIZE, retries=0, state_path=tmp_path / "uploads")
+    # Another job's unfinished upload of the same object stays untouched.
+    foreign = transfers.client._create_multipart_upload(bucket, "foreign/big.bin", {})
+    transfers.client._upload_part(bucket, "foreign/big.bin", b"x" * MIN_PART_SIZE, None, foreign, 1)
+    transfers.upload_file(bucket, "foreign/big.bin", big_file.as_posix())
+    assert transfers._list_parts(bucket, "foreign/big.bin", foreign).keys() == {1}
+    target = big_file.with_suffix(".out")
+    transfers.download_file(bucket, "foreign/big.bin", target.as_posix())
+    assert target.read_bytes() == big_file.read_bytes()
+
+
+def test_download_resumes_missing_chunks(bucket, big_file, tmp_path):
+    transfers = TransferManager(part_size=MIN_PART_SIZE, retries=0, state_path=tmp_path / "uploads")
+    transfers.upload_file(bucket, "resume/download.bin", big_file.as_posix())
+    target = (tmp_path / "download.bin").as_posix()
+    download_chunk = transfers._download_chunk
+    fetched = []
+
+    def failing_chunk(bucket_name, object_name, part_path, offset, length):
+        if offset == MIN_PART_SIZE:
+            raise RuntimeError("interrupted")
+        fetched.append(offset)
+        return download_chunk(bucket_name, object_name, part_path, offset, length)
+
+    transfers._download_chunk = failing_chunk
+    with pytest.raises(RuntimeError):
+        transfers.download_file(bucket, "resume/download.bin", target)
+
+    fetched.clear()
+    transfers._download_chunk = lambda *args: (fetched.append(args[3]), download_chunk(*args))
+    transfers.download_file(bucket, "resume/download.bin", target)
+    assert fetched == [MIN_PART_SIZE]
+    assert open(target, "rb").read() == big_file.read_bytes()
+    assert not os.path.exists(f"{target}.part.json")
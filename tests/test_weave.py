@@ -0,0 +1,55 @@
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+from weave import Source, weave_split
+
+
+class Collect:
+    def __init__(self):
+        self.tables = []
+
+    def write(self, table):
+        self.tables.append(table)
+
+
+def source(name, rows):
+    dataset = Dataset.from_dict({"prompt": [f"{name}{i}" for i in range(rows)], "completion": [""] * rows})
+    return Source(name, dataset, 1.0, None, ["prompt", "completion"], "rows")
+
+
+def test_first_exhausted_counts_written_rows_only():
+    sources = [source("a", 10), source("b", 1000)]
+    writer = Collect()
+    weave_split(sources, writer, np.random.default_rng(0), batch_size=64, first_exhausted=True)
+    written = pa.concat_tables(writer.tables)
+    counts = {name: written["source"].to_pylist().count(name) for name in ("a", "b")}
+    assert counts["a"] == 10
+    assert {s.name: s.rows for s in sources} == counts
+    # Written rows of each source are a prefix, so nothing was skipped.
+    b_index = [i for s, i in zip(written["source"].to_pylist(), written["source_index"].to_pylist()) if s == "b"]
+    assert b_index == list(range(counts["b"]))
+    assert sources[1].cursor == counts["b"]
+
+
+def test_all_exhausted_writes_everything():
+    sources = [source("a", 10), source("b", 30)]
+    writer = Collect()
+    weave_split(sources, writer, np.random.default_rng(0), batch_size=16)
+    assert sum(len(table) for table in writer.tables) == 40
+    assert [s.rows for s in sources] == [10, 30]
+
+
+def test_only_budgeted_sources_repeat():
+    sources = [source("a", 10), source("b", 30)]
+    sources[0].budget = 25
+    writer = Collect()
+    weave_split(sources, writer, np.random.default_rng(0), batch_size=16, repeat=True)
+    assert [(s.rows, s.epoch) for s in sources] == [(25, 2), (30, 0)]
+
+
+def test_zero_token_rows_stop_repeating():
+    dataset = Dataset.from_dict({"prompt": ["x"] * 5, "completion": [""] * 5, "prompt_len": [0] * 5, "completion_len": [0] * 5})
+    empty = Source("empty", dataset, 1.0, 100, ["prompt", "completion"], "tokens")
+    writer = Collect()
+    weave_split([empty], writer, np.random.default_rng(0), batch_size=4, repeat=True)
+    assert (empty.rows, empty.used, empty.done) == (5, 0, True)
@@ -0,0 +1,376 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import certifi
+import urllib3
+from minio import Minio
+from minio.datatypes import Part
+from minio.error import S3Error
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one).
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+# Upload ids of unfinished multipart uploads, kept out of the folders being
+# uploaded so a dataset folder never picks up transfer state.
+UPLOAD_STATE_PATH = Path.home() / ".cache" / "llm-research-data" / "uploads"
+RETRYABLE_S3_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "RequestTimeTooSkewed",
+    "ServiceUnavailable",
+    "SlowDown",
+}
+RETRYABLE_ERRORS = (
+    urllib3.exceptions.HTTPError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def _is_retryable(error):
+    if isinstance(error, S3Error):
+        return error.code in RETRYABLE_S3_CODES
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def _md5_range(file_path, offset, length):
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        return hashlib.md5(f.read(length)).hexdigest()
+
+
+class TransferManager:
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        max_workers=8,
+        part_concurrency=8,
+        part_size=DEFAULT_PART_SIZE,
+        retries=5,
+        backoff=0.5,
+        max_backoff=30.0,
+        state_path=UPLOAD_STATE_PATH,
+    ):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+        self.part_size = part_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state_path = Path(state_path)
+        # One client for every transfer, with enough pooled connections for
+        # all file and part workers to hold one at the same time.
+        http_client = urllib3.PoolManager(
+            maxsize=max_workers + part_concurrency,
+            timeout=urllib3.Timeout(connect=10, read=300),
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+            retries=urllib3.Retry(total=0),  # Retried by _retry with backoff
+        )
+        self.client = Minio(
+            os.environ["S3_ENDPOINT"],
+            access_key=os.environ["S3_ACCESS_KEY_ID"],
+            secret_key=os.environ["S3_SECRET_ACCESS_KEY"],
+            region=os.environ["S3_REGION"],
+            secure=os.environ.get("S3_SECURE", "True").lower() == "true",
+            http_client=http_client,
+        )
+        # Separate pools so a batch of large files can't starve its own parts.
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.part_executor = ThreadPoolExecutor(max_workers=part_concurrency)
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def retry(self, fn, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not _is_retryable(e):
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2**attempt)
+                delay *= random.uniform(0.5, 1.0)
+                print(f"Retrying {fn.__name__} in {delay:.1f}s after: {e}")
+                time.sleep(delay)
+
+    def exists(self, bucket_name, object_name):
+        try:
+            self.retry(self.client.stat_object, bucket_name, object_name)
+            return True
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchObject", "ResourceNotFound"):
+                return False
+            raise
+
+    def _list_parts(self, bucket_name, object_name, upload_id):
+        parts = {}
+        marker = None
+        while True:
+            result = self.retry(
+                self.client._list_parts,
+                bucket_name,
+                object_name,
+                upload_id,
+                part_number_marker=marker,
+            )
+            for part in result.parts:
+                parts[part.part_number] = part
+            if not result.is_truncated:
+                return parts
+            marker = result.next_part_number_marker
+
+    def _upload_part(self, bucket_name, object_name, file_path, upload_id, part_number, offset, length):
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        etag = self.retry(
+            self.client._upload_part,
+            bucket_name,
+            object_name,
+            data,
+            None,
+            upload_id,
+            part_number,
+        )
+        return Part(part_number, etag)
+
+    def upload_state_path(self, bucket_name, object_name, file_path):
+        key = f"{os.path.realpath(file_path)}\n{bucket_name}/{object_name}"
+        return self.state_path / f"{hashlib.sha256(key.encode()).hexdigest()[:32]}.json"
+
+    def _upload_multipart(self, bucket_name, object_name, file_path, size, content_type, metadata):
+        # The upload id goes to a state file keyed by file and object, so only
+        # an upload this client started for the same file, object and metadata
+        # is resumed, reusing every part whose size and MD5 still match.
+        state_path = self.upload_state_path(bucket_name, object_name, file_path)
+        state = {
+            "file": os.path.realpath(file_path),
+            "bucket": bucket_name,
+            "object": object_name,
+            "size": size,
+            "mtime_ns": os.stat(file_path).st_mtime_ns,
+            "part_size": self.part_size,
+            "content_type": content_type,
+            "metadata": {key: str(value) for key, value in (metadata or {}).items()},
+        }
+        upload_id = None
+        existing = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                saved = json.load(f)
+            if {key: value for key, value in saved.items() if key != "upload_id"} == state:
+                try:
+                    existing = self._list_parts(bucket_name, object_name, saved["upload_id"])
+                    upload_id = saved["upload_id"]
+                except S3Error as e:
+                    if e.code != "NoSuchUpload":
+                        raise
+        if upload_id is None:
+            headers = {"Content-Type": content_type}
+            headers["x-amz-meta-part-size"] = str(self.part_size)
+            for key, value in state["metadata"].items():
+                headers[f"x-amz-meta-{key}"] = value
+            upload_id = self.retry(
+                self.client._create_multipart_upload, bucket_name, object_name, headers
+            )
+            os.makedirs(self.state_path, exist_ok=True)
+            with open(state_path, "w") as f:
+                json.dump({**state, "upload_id": upload_id}, f)
+
+        futures = []
+        reused = 0
+        for part_number, offset in enumerate(range(0, size, self.part_size), start=1):
+            length = min(self.part_size, size - offset)
+            part = existing.get(part_number)
+            if (
+                part is not None
+                and part.size == length
+                and part.etag.strip('"') == _md5_range(file_path, offset, length)
+            ):
+                futures.append(Part(part_number, part.etag))
+                reused += length
+                continue
+            futures.append(
+                self.part_executor.submit(
+                    self._upload_part,
+                    bucket_name,
+                    object_name,
+                    file_path,
+                    upload_id,
+                    part_number,
+                    offset,
+                    length,
+                )
+            )
+        # Failed uploads are left open on purpose so the next call can resume them.
+        parts = [f if isinstance(f, Part) else f.result() for f in futures]
+        self.retry(
+            self.client._complete_multipart_upload,
+            bucket_name,
+            object_name,
+            upload_id,
+            parts,
+        )
+        os.remove(state_path)
+        if reused:
+            print(f"Resumed '{object_name}', reused {reused / 2**20:.1f} MiB already uploaded.")
+
+    def upload_file(
+        self,
+        bucket_name,
+        object_name,
+        file_path,
+        content_type="application/octet-stream",
+        metadata=None,
+    ):
+        size = os.path.getsize(file_path)
+        if size <= self.part_size:
+            self.retry(
+                self.client.fput_object,
+                bucket_name,
+                object_name,
+                file_path,
+                content_type=content_type,
+                metadata=metadata,
+                part_size=self.part_size,  # A single PUT, so the ETag is the MD5
+            )
+        else:
+            self._upload_multipart(
+                bucket_name, object_name, file_path, size, content_type, metadata
+            )
+        return size
+
+    def _download_chunk(self, bucket_name, object_name, part_path, offset, length):
+        def fetch():
+            response = self.client.get_object(
+                bucket_name, object_name, offset=offset, length=length
+            )
+            try:
+                return response.read()
+            finally:
+                response.close()
+                response.release_conn()
+
+        data = self.retry(fetch)
+        if len(data) != length:
+            raise ValueError(f"Short read of '{object_name}' at offset {offset}")
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+
+    def download_file(self, bucket_name, object_name, file_path):
+        # Chunks land in '<file>.part' and finished chunk offsets are recorded
+        # in '<file>.part.json', so an interrupted download picks up where it
+        # stopped as long as the object's ETag hasn't changed.
+        stat = self.retry(self.client.stat_object, bucket_name, object_name)
+        part_path = f"{file_path}.part"
+        state_path = f"{part_path}.json"
+        done = set()
+        if os.path.exists(part_path) and os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if state["etag"] == stat.etag and state["chunk_size"] == self.part_size:
+                done = set(state["done"])
+        if not done:
+            with open(part_path, "wb") as f:
+                f.truncate(stat.size)
+
+        lock = threading.Lock()
+
+        def save_state():
+            with open(state_path, "w") as f:
+                json.dump(
+                    {"etag": stat.etag, "chunk_size": self.part_size, "done": sorted(done)}, f
+                )
+
+        def download_chunk(offset):
+            self._download_chunk(
+                bucket_name,
+                object_name,
+                part_path,
+                offset,
+                min(self.part_size, stat.size - offset),
+            )
+            with lock:
+                done.add(offset)
+                save_state()
+
+        save_state()
+        futures = [
+            self.part_executor.submit(download_chunk, offset)
+            for offset in range(0, stat.size, self.part_size)
+            if offset not in done
+        ]
+        # Every chunk finishes (or fails) before this returns, so a retry never
+        # races chunks of the failed call still writing to the part file.
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+        os.replace(part_path, file_path)
+        os.remove(state_path)
+        return stat.size
+
+    def _run_batch(self, fn, batch):
+        futures = [self.executor.submit(fn, *item) for item in batch]
+        results = []
+        errors = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(None)
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return results
+
+    def upload_files(self, batch):
+        # batch: iterable of (bucket_name, object_name, file_path)
+        return self._run_batch(self.upload_file, batch)
+
+    def download_files(self, batch):
+        # batch: iterable of (bucket_name, object_name, file_path)
+        return self._run_batch(self.download_file, batch)
+
+    async def _run_async(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    async def upload_file_async(self, bucket_name, object_name, file_path, **kwargs):
+        return await self._run_async(
+            self.upload_file, bucket_name, object_name, file_path, **kwargs
+        )
+
+    async def download_file_async(self, bucket_name, object_name, file_path):
+        return await self._run_async(
+            self.download_file, bucket_name, object_name, file_path
+        )
+
+    async def upload_files_async(self, batch):
+        return await asyncio.gather(
+            *(self.upload_file_async(*item) for item in batch)
+        )
+
+    async def download_files_async(self, batch):
+        return await asyncio.gather(
+            *(self.download_file_async(*item) for item in batch)
+        )
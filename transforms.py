@@ -0,0 +1,86 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+from metrics import stage
+
+# Columnar building blocks for the builders. Each op takes and returns a
+# pa.Table, so a Pipeline runs whole record batches through Arrow kernels
+# instead of materializing one Python dict per row.
+
+
+def _set_column(table, name, values):
+    index = table.schema.get_field_index(name)
+    if index < 0:
+        return table.append_column(name, values)
+    return table.set_column(index, name, values)
+
+
+def strip(column):
+    def op(table):
+        return _set_column(table, column, pc.utf8_trim_whitespace(table[column]))
+
+    return op
+
+
+def replace(column, pattern, replacement):
+    def op(table):
+        return _set_column(
+            table,
+            column,
+            pc.replace_substring(table[column], pattern=pattern, replacement=replacement),
+        )
+
+    return op
+
+
+def split_at_marker(column, marker, before, after, keep_marker=True):
+    # Splits at the first occurrence of the marker, like str.index would;
+    # the marker stays at the end of 'before' unless keep_marker is False.
+    def op(table):
+        parts = pc.split_pattern(table[column], pattern=marker, max_splits=1)
+        missing = pc.sum(pc.less(pc.list_value_length(parts), 2)).as_py()
+        if missing:
+            raise ValueError(f"'{marker}' not found in {missing} rows of '{column}'")
+        head = pc.list_element(parts, 0)
+        if keep_marker:
+            head = pc.binary_join_element_wise(head, pa.scalar(marker), "")
+        table = _set_column(table, before, head)
+        return _set_column(table, after, pc.list_element(parts, 1))
+
+    return op
+
+
+def rename(mapping):
+    def op(table):
+        return table.rename_columns([mapping.get(name, name) for name in table.column_names])
+
+    return op
+
+
+def drop(columns):
+    def op(table):
+        return table.select([name for name in table.column_names if name not in columns])
+
+    return op
+
+
+class Pipeline:
+    def __init__(self, *ops):
+        self.ops = ops
+
+    def __call__(self, table):
+        for op in self.ops:
+            table = op(table)
+        return table
+
+    def apply(self, dataset, num_proc=None, batch_size=10_000, **map_kwargs):
+        # With the arrow format, map() hands each batch over as a pa.Table and
+        # writes the returned table as-is.
+        with stage("transform") as transformed:
+            transformed.rows_in = len(dataset)
+            result = (
+                dataset.with_format("arrow")
+                .map(self, batched=True, batch_size=batch_size, num_proc=num_proc, **map_kwargs)
+                .with_format(None)
+            )
+            transformed.rows_out = len(result)
+        return result
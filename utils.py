@@ -1,64 +1,847 @@
+import contextvars
+import functools
+import hashlib
+import inspect
+import io
+import json
 import os
+import shutil
 import tarfile
-from minio import Minio
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from minio.commonconfig import CopySource
+from minio.datatypes import Part
 from minio.error import S3Error
+from archive import archive_name, codec_for_name, get_codec, index_name, select_members, write_seekable
+from build_cache import BuildCache, build_key, current_build, link_tree, source_fingerprint
+from metrics import current, stage, timed
+from transfer import DEFAULT_PART_SIZE, MIN_PART_SIZE, TransferManager
+
+# Set by pipeline.py: publish_dataset only saves and records what to upload,
+# the pipeline publishes it on its I/O pool.
+deferred_publish = contextvars.ContextVar("deferred_publish", default=None)
+
+DEFAULT_CONCURRENCY = 4
+# Content-addressed blobs are shared by every dataset in the bucket.
+BLOBS_PREFIX = "objects/sha256"
+MANIFESTS_PREFIX = "manifests"
+DEFAULT_STORE_PATH = Path.home() / ".cache" / "llm-research-data" / "objects"
+
+
+def _read_part(stream, size):
+    # A pipe can return short reads, so keep reading until the part is full.
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _blob_name(sha256):
+    return f"{BLOBS_PREFIX}/{sha256[:2]}/{sha256}"
+
+
+def _manifest_name(short_name, version):
+    return f"{MANIFESTS_PREFIX}/{short_name}/{version}.json"
 
 
 class DatasetMover:
-    def _compress_folder(self, folder_path, output_filename):
-        with tarfile.open(output_filename, "w:gz") as tar:
+    def __init__(self, transfer_manager=None):
+        # All movers share one pooled client unless given their own manager.
+        # It's created on first use, so local-only work (compressing,
+        # extracting) doesn't need S3 settings.
+        self._transfers = transfer_manager
+
+    @property
+    def transfers(self):
+        if self._transfers is None:
+            self._transfers = TransferManager.shared()
+        return self._transfers
+
+    def _get_client(self):
+        return self.transfers.client
+
+    def _write_archive(self, folder_path, fileobj, codec):
+        writer = codec.writer(fileobj)
+        with tarfile.open(fileobj=writer, mode="w|") as tar:
             tar.add(folder_path, arcname=os.path.basename(folder_path))
+        writer.close()
+
+    @timed("compress")
+    def _compress_folder(self, folder_path, output_filename, codec="gzip", seekable=False):
+        with open(output_filename, "wb") as f:
+            if seekable:
+                return write_seekable(folder_path, f, get_codec(codec))
+            self._write_archive(folder_path, f, get_codec(codec))
+
+    def _compress_folder_to_pipe(self, folder_path, codec="gzip"):
+        # Tar+compress in a background thread into a pipe, so the caller can
+        # upload parts while the rest of the folder is still being compressed.
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, "rb")
+        writer = os.fdopen(write_fd, "wb")
+        errors = []
+
+        def compress():
+            try:
+                self._write_archive(folder_path, writer, get_codec(codec))
+            except BrokenPipeError:
+                pass  # The reader gave up, the upload error is reported there
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    writer.close()
+                except BrokenPipeError:
+                    pass
 
-    def _upload_to_s3(self, file_name, bucket_name, object_name):
+        thread = threading.Thread(target=compress, daemon=True)
+        thread.start()
+        return reader, thread, errors
+
+    @timed("upload")
+    def _upload_to_s3(self, file_name, bucket_name, object_name, content_type="application/octet-stream", metadata=None):
+        size = self.transfers.upload_file(
+            bucket_name, object_name, file_name, content_type=content_type, metadata=metadata
+        )
+        current().add_bytes(size)
+        print(
+            f"'{file_name}' is successfully uploaded as '{object_name}' to bucket '{bucket_name}'."
+        )
+
+    def _upload_part(self, client, bucket_name, object_name, data, upload_id, part_number):
+        etag = self.transfers.retry(
+            client._upload_part, bucket_name, object_name, data, None, upload_id, part_number
+        )
+        return Part(part_number, etag)
+
+    def _stream_to_s3(
+        self,
+        stream,
+        bucket_name,
+        object_name,
+        part_size=DEFAULT_PART_SIZE,
+        concurrency=DEFAULT_CONCURRENCY,
+        content_type="application/octet-stream",
+        metadata=None,
+    ):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+        client = self._get_client()
+        headers = {"Content-Type": content_type}
+        # The part size is recorded so downloads can verify the multipart ETag.
+        headers["x-amz-meta-part-size"] = str(part_size)
+        for key, value in (metadata or {}).items():
+            headers[f"x-amz-meta-{key}"] = str(value)
+
+        upload_id = self.transfers.retry(
+            client._create_multipart_upload, bucket_name, object_name, headers
+        )
+        # Bounds memory to (concurrency + 1) parts: one being read, the rest in flight.
+        slots = threading.BoundedSemaphore(concurrency)
+        futures = []
+        total_bytes = 0
         try:
-            # Initialize MinIO client
-            minio_client = Minio(
-                os.environ["S3_ENDPOINT"],
-                access_key=os.environ["S3_ACCESS_KEY_ID"],
-                secret_key=os.environ["S3_SECRET_ACCESS_KEY"],
-                region=os.environ["S3_REGION"],
-                secure=os.environ.get("S3_SECURE", "True").lower() == "true",
-            )  # Use secure=False if not using https
-            minio_client.fput_object(bucket_name, object_name, file_name)
-            print(
-                f"'{file_name}' is successfully uploaded as '{object_name}' to bucket '{bucket_name}'."
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                part_number = 0
+                while True:
+                    data = _read_part(stream, part_size)
+                    if not data and part_number > 0:
+                        break
+                    part_number += 1
+                    total_bytes += len(data)
+                    slots.acquire()
+                    for future in futures:
+                        if future.done() and future.exception():
+                            raise future.exception()
+                    future = executor.submit(
+                        self._upload_part,
+                        client,
+                        bucket_name,
+                        object_name,
+                        data,
+                        upload_id,
+                        part_number,
+                    )
+                    future.add_done_callback(lambda _: slots.release())
+                    futures.append(future)
+                    if len(data) < part_size:
+                        break
+            parts = [future.result() for future in futures]
+            client._complete_multipart_upload(bucket_name, object_name, upload_id, parts)
+        except BaseException:
+            client._abort_multipart_upload(bucket_name, object_name, upload_id)
+            raise
+        return total_bytes, len(futures)
+
+    @timed("stream_upload")
+    def _stream_upload(self, folder_path, bucket_name, object_name, part_size, concurrency, codec):
+        start = time.perf_counter()
+        reader, thread, errors = self._compress_folder_to_pipe(folder_path, codec)
+        try:
+            total_bytes, part_count = self._stream_to_s3(
+                reader,
+                bucket_name,
+                object_name,
+                part_size,
+                concurrency,
+                content_type=codec.content_type,
+                metadata={"codec": codec.name},
             )
-        except S3Error as e:
-            print("Error occurred: ", e)
+        finally:
+            reader.close()
+            thread.join()
+        if errors:
+            raise errors[0]
+        current().add_bytes(total_bytes)
+        elapsed = time.perf_counter() - start
+        print(
+            f"'{folder_path}' is successfully streamed as '{object_name}' to bucket '{bucket_name}' "
+            f"({total_bytes / 2**20:.1f} MiB in {part_count} parts, {elapsed:.1f}s)."
+        )
 
-    def upload(self, folder_path, output_filename, bucket_name):
-        self._compress_folder(folder_path, output_filename)
-        self._upload_to_s3(output_filename, bucket_name, output_filename)
+    def upload(
+        self,
+        folder_path,
+        output_filename,
+        bucket_name,
+        streaming=False,
+        part_size=DEFAULT_PART_SIZE,
+        concurrency=DEFAULT_CONCURRENCY,
+        codec="gzip",
+        seekable=False,
+    ):
+        codec = get_codec(codec)
+        if streaming:
+            if seekable:
+                raise ValueError("Seekable archives are compressed to disk first, they can't be streamed")
+            # Compress straight into a parallel multipart upload, nothing is written to disk.
+            self._stream_upload(
+                folder_path, bucket_name, output_filename, part_size, concurrency, codec
+            )
+            return
+        index = self._compress_folder(folder_path, output_filename, codec, seekable)
+        # The codec is recorded so download() picks the matching decoder, and
+        # seekable archives point at their member index.
+        metadata = {"codec": codec.name}
+        if index is not None:
+            metadata["index"] = index_name(output_filename)
+        self._upload_to_s3(
+            output_filename,
+            bucket_name,
+            output_filename,
+            content_type=codec.content_type,
+            metadata=metadata,
+        )
+        if index is not None:
+            body = json.dumps(index).encode()
+            self.transfers.retry(
+                self._get_client().put_object,
+                bucket_name,
+                index_name(output_filename),
+                io.BytesIO(body),
+                len(body),
+                content_type="application/json",
+            )
 
+    @timed("download")
     def _download_from_s3(self, bucket_name, object_name, file_name):
-        try:
-            # Initialize MinIO client
-            minio_client = Minio(
-                os.environ["S3_ENDPOINT"],
-                access_key=os.environ["S3_ACCESS_KEY_ID"],
-                secret_key=os.environ["S3_SECRET_ACCESS_KEY"],
-                region=os.environ["S3_REGION"],
-                secure=os.environ.get("S3_SECURE", "True").lower() == "true",
-            )
-            minio_client.fget_object(bucket_name, object_name, file_name)
-            print(
-                f"'{object_name}' from bucket '{bucket_name}' is successfully downloaded as '{file_name}'."
+        current().add_bytes(self.transfers.download_file(bucket_name, object_name, file_name))
+        print(
+            f"'{object_name}' from bucket '{bucket_name}' is successfully downloaded as '{file_name}'."
+        )
+
+    def _detect_codec(self, stat, object_name):
+        codec = (stat.metadata or {}).get("x-amz-meta-codec") if stat else None
+        return get_codec(codec) if codec else codec_for_name(object_name)
+
+    def _extract_archive(self, fileobj, output_folder_path, codec):
+        reader = codec.reader(fileobj)
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            tar.extractall(path=output_folder_path)
+
+    @timed("extract")
+    def _decompress_folder(self, input_filename, output_folder_path, codec="gzip"):
+        # A corrupt or truncated archive raises, so a failed download isn't reported as done.
+        with open(input_filename, "rb") as f:
+            self._extract_archive(f, output_folder_path, get_codec(codec))
+        print(f"'{input_filename}' is successfully decompressed to '{output_folder_path}'.")
+
+    def _fetch_range(self, client, bucket_name, object_name, offset, length):
+        def fetch():
+            response = client.get_object(bucket_name, object_name, offset=offset, length=length)
+            try:
+                return response.read()
+            finally:
+                response.close()
+                response.release_conn()
+
+        return self.transfers.retry(fetch)
+
+    def _extract_range(self, client, bucket_name, object_name, offset, length, output_folder_path, codec):
+        # A run of whole members decompresses to a valid tar stream on its own.
+        def fetch():
+            response = client.get_object(bucket_name, object_name, offset=offset, length=length)
+            try:
+                with tarfile.open(fileobj=codec.reader(response), mode="r|") as tar:
+                    tar.extractall(path=output_folder_path)
+            finally:
+                response.close()
+                response.release_conn()
+
+        self.transfers.retry(fetch)
+        return length
+
+    @timed("download_members")
+    def _download_members(self, bucket_name, object_name, output_folder_path, splits, files, part_size, concurrency):
+        start = time.perf_counter()
+        client = self._get_client()
+        stat = self.transfers.retry(client.stat_object, bucket_name, object_name)
+        if not (stat.metadata or {}).get("x-amz-meta-index"):
+            return False
+        index = json.loads(self._fetch_range(client, bucket_name, index_name(object_name), 0, 0))
+        if index["size"] != stat.size:
+            print(f"The member index of '{object_name}' is stale.")
+            return False
+        codec = get_codec(index["codec"])
+        members = select_members(index, splits, files)
+
+        # Directories first, so parallel extraction never races to create them.
+        for member in members:
+            if member["type"] == "dir":
+                os.makedirs(os.path.join(output_folder_path, member["name"]), exist_ok=True)
+        # Adjacent members are fetched together, up to part_size per request.
+        ranges = []
+        for member in members:
+            if member["type"] == "dir":
+                continue
+            if ranges and ranges[-1][0] + ranges[-1][1] == member["offset"] and ranges[-1][1] < part_size:
+                ranges[-1][1] += member["length"]
+            else:
+                ranges.append([member["offset"], member["length"]])
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            fetched = sum(
+                executor.map(
+                    lambda r: self._extract_range(
+                        client, bucket_name, object_name, r[0], r[1], output_folder_path, codec
+                    ),
+                    ranges,
+                )
             )
-        except S3Error as e:
-            print("Error occurred: ", e)
 
-    def _decompress_folder(self, input_filename, output_folder_path):
+        # A DatasetDict only lists the splits that were fetched.
+        dict_path = os.path.join(output_folder_path, index["members"][0]["name"], "dataset_dict.json")
+        if splits and os.path.exists(dict_path):
+            with open(dict_path) as f:
+                names = json.load(f)["splits"]
+            with open(dict_path, "w") as f:
+                json.dump({"splits": [name for name in names if name in splits]}, f)
+        current().add_bytes(fetched)
+        print(
+            f"Fetched {len(members)} of {len(index['members'])} members of '{object_name}' to "
+            f"'{output_folder_path}' ({fetched / 2**20:.1f} of {stat.size / 2**20:.1f} MiB in "
+            f"{len(ranges)} ranges, {time.perf_counter() - start:.1f}s)."
+        )
+        return True
+
+    def _stream_from_s3(self, stat, bucket_name, object_name, writer, part_size, concurrency):
+        # Fetch ranges in parallel but write them to the pipe in order, with
+        # at most 'concurrency' ranges buffered at any time.
+        client = self._get_client()
+        whole_md5 = hashlib.md5()
+        part_md5s = []
+        written = 0
+        offsets = iter(range(0, stat.size, part_size))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for offset in offsets:
+                pending.append(
+                    executor.submit(
+                        self._fetch_range, client, bucket_name, object_name, offset,
+                        min(part_size, stat.size - offset),
+                    )
+                )
+                if len(pending) >= concurrency:
+                    break
+            while pending:
+                data = pending.popleft().result()
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append(
+                        executor.submit(
+                            self._fetch_range, client, bucket_name, object_name, next_offset,
+                            min(part_size, stat.size - next_offset),
+                        )
+                    )
+                whole_md5.update(data)
+                part_md5s.append(hashlib.md5(data).digest())
+                written += len(data)
+                writer.write(data)
+        return written, whole_md5, part_md5s
+
+    def _verify_download(self, stat, written, whole_md5, part_md5s, ranges_are_parts):
+        if written != stat.size:
+            raise ValueError(f"Downloaded {written} bytes, expected {stat.size}")
+        etag = stat.etag.strip('"')
+        if "-" not in etag:
+            actual = whole_md5.hexdigest()
+        elif ranges_are_parts:
+            digest = hashlib.md5(b"".join(part_md5s)).hexdigest()
+            actual = f"{digest}-{len(part_md5s)}"
+        else:
+            print(f"Skipping ETag check for '{etag}', the upload part size is unknown.")
+            return
+        if actual != etag:
+            raise ValueError(f"ETag mismatch: got '{actual}', expected '{etag}'")
+
+    @timed("stream_download")
+    def _stream_download(self, bucket_name, object_name, output_folder_path, part_size, concurrency, verify):
+        start = time.perf_counter()
+        stat = self.transfers.retry(self._get_client().stat_object, bucket_name, object_name)
+        # Reuse the upload part size when it is known so the multipart ETag can be checked.
+        uploaded_part_size = (stat.metadata or {}).get("x-amz-meta-part-size")
+        if uploaded_part_size:
+            part_size = int(uploaded_part_size)
+
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, "rb")
+        writer = os.fdopen(write_fd, "wb")
+        results = []
+        errors = []
+
+        def feed():
+            try:
+                results.append(
+                    self._stream_from_s3(
+                        stat, bucket_name, object_name, writer, part_size, concurrency
+                    )
+                )
+            except BrokenPipeError:
+                pass  # The extractor gave up, the error is reported there
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    writer.close()
+                except BrokenPipeError:
+                    pass
+
+        thread = threading.Thread(target=feed, daemon=True)
+        thread.start()
         try:
-            with tarfile.open(input_filename, "r:gz") as tar:
-                tar.extractall(path=output_folder_path)
-            print(
-                f"'{input_filename}' is successfully decompressed to '{output_folder_path}'."
+            self._extract_archive(reader, output_folder_path, self._detect_codec(stat, object_name))
+            # Bytes the extractor didn't need (tar padding, trailing data) are
+            # drained, so the feeder finishes and the whole object is verified.
+            while reader.read(part_size):
+                pass
+        finally:
+            # An extraction error propagates from here, ahead of the feeder's.
+            reader.close()
+            thread.join()
+        if errors:
+            raise errors[0]
+        if not results:
+            raise ValueError(f"Streaming '{object_name}' stopped before the whole object was read")
+
+        written, whole_md5, part_md5s = results[0]
+        current().add_bytes(written)
+        if verify:
+            self._verify_download(stat, written, whole_md5, part_md5s, bool(uploaded_part_size))
+        elapsed = time.perf_counter() - start
+        print(
+            f"'{object_name}' from bucket '{bucket_name}' is successfully streamed to '{output_folder_path}' "
+            f"({written / 2**20:.1f} MiB in {elapsed:.1f}s, {written / 2**20 / max(elapsed, 1e-9):.1f} MiB/s)."
+        )
+
+    def download(
+        self,
+        bucket_name,
+        object_name,
+        output_folder_path,
+        streaming=False,
+        part_size=DEFAULT_PART_SIZE,
+        concurrency=DEFAULT_CONCURRENCY,
+        verify=True,
+        splits=None,
+        files=None,
+    ):
+        if splits or files:
+            # Only some splits, or files matching a glob, from a seekable archive.
+            if self._download_members(
+                bucket_name, object_name, output_folder_path, splits, files, part_size, concurrency
+            ):
+                return
+            print(f"'{object_name}' has no member index, downloading the whole archive.")
+        if streaming:
+            # Parallel ranged GETs feed the decoder+untar directly, nothing is written but the files.
+            self._stream_download(
+                bucket_name, object_name, output_folder_path, part_size, concurrency, verify
             )
-        except Exception as e:
-            print("Error occurred: ", e)
-
-    def download(self, bucket_name, object_name, output_folder_path):
-        temp_filename = "temp.tar.gz"
-        self._download_from_s3(bucket_name, object_name, temp_filename)
-        self._decompress_folder(temp_filename, output_folder_path)
-        os.remove(temp_filename)  # Clean up the temporary compressed file
+            return
+        try:
+            stat = self._get_client().stat_object(bucket_name, object_name)
+        except S3Error:
+            stat = None
+        codec = self._detect_codec(stat, object_name)
+        # A unique temp file, so concurrent jobs in the same directory don't clobber each other.
+        fd, temp_filename = tempfile.mkstemp(suffix=codec.extension)
+        os.close(fd)
+        try:
+            self._download_from_s3(bucket_name, object_name, temp_filename)
+            self._decompress_folder(temp_filename, output_folder_path, codec)
+        finally:
+            os.remove(temp_filename)  # Clean up the temporary compressed file
+
+    @timed("publish_cas")
+    def publish(self, folder_path, bucket_name, short_name, version=None, concurrency=DEFAULT_CONCURRENCY):
+        # Upload every file of a saved dataset as a content-hashed blob (skipping
+        # blobs already in the bucket) plus a manifest for this version.
+        start = time.perf_counter()
+        client = self._get_client()
+        paths = sorted(
+            os.path.relpath(os.path.join(root, name), folder_path)
+            for root, _, names in os.walk(folder_path)
+            for name in names
+        )
+
+        def publish_file(path):
+            file_path = os.path.join(folder_path, path)
+            entry = {"path": path, "sha256": _sha256_file(file_path), "size": os.path.getsize(file_path)}
+            blob_name = _blob_name(entry["sha256"])
+            uploaded = not self.transfers.exists(bucket_name, blob_name)
+            if uploaded:
+                self.transfers.upload_file(bucket_name, blob_name, file_path)
+            return entry, uploaded
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(publish_file, paths))
+        files = [entry for entry, _ in results]
+        if version is None:
+            version = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()[:16]
+        manifest = {
+            "short_name": short_name,
+            "version": str(version),
+            "root": os.path.basename(os.path.normpath(folder_path)),
+            "files": files,
+        }
+        body = json.dumps(manifest, indent=2).encode()
+        for name in [str(version), "latest"]:
+            self.transfers.retry(
+                client.put_object,
+                bucket_name,
+                _manifest_name(short_name, name),
+                io.BytesIO(body),
+                len(body),
+                content_type="application/json",
+            )
+
+        uploaded = [entry for entry, was_uploaded in results if was_uploaded]
+        current().add_bytes(sum(e["size"] for e in uploaded))
+        elapsed = time.perf_counter() - start
+        print(
+            f"Published '{short_name}' version '{version}' to bucket '{bucket_name}': "
+            f"uploaded {len(uploaded)} of {len(files)} files "
+            f"({sum(e['size'] for e in uploaded) / 2**20:.1f} of {sum(e['size'] for e in files) / 2**20:.1f} MiB) "
+            f"in {elapsed:.1f}s."
+        )
+        return manifest
+
+    @timed("fetch")
+    def fetch(
+        self,
+        bucket_name,
+        short_name,
+        output_folder_path,
+        version="latest",
+        store_path=DEFAULT_STORE_PATH,
+        concurrency=DEFAULT_CONCURRENCY,
+    ):
+        # Download only the blobs missing from the local store, then link the
+        # dataset folder together from the store.
+        start = time.perf_counter()
+        client = self._get_client()
+        manifest = json.loads(
+            self._fetch_range(client, bucket_name, _manifest_name(short_name, version), 0, 0)
+        )
+
+        def fetch_blob(entry):
+            blob_path = os.path.join(store_path, entry["sha256"][:2], entry["sha256"])
+            if os.path.exists(blob_path):
+                return blob_path, False
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # A stable temp name lets an interrupted fetch resume the blob.
+            temp_path = f"{blob_path}.download"
+            self.transfers.download_file(bucket_name, _blob_name(entry["sha256"]), temp_path)
+            if _sha256_file(temp_path) != entry["sha256"]:
+                os.remove(temp_path)
+                raise ValueError(f"Checksum mismatch for '{entry['path']}'")
+            os.replace(temp_path, blob_path)
+            return blob_path, True
+
+        # Files with the same content share a blob, which is fetched once.
+        blobs = list({entry["sha256"]: entry for entry in manifest["files"]}.values())
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = dict(zip((entry["sha256"] for entry in blobs), executor.map(fetch_blob, blobs)))
+
+        dataset_path = os.path.join(output_folder_path, manifest["root"])
+        shutil.rmtree(dataset_path, ignore_errors=True)
+        for entry in manifest["files"]:
+            blob_path, _ = results[entry["sha256"]]
+            target = os.path.join(dataset_path, entry["path"])
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(blob_path, target)
+            except OSError:
+                shutil.copyfile(blob_path, target)  # Store on another filesystem
+
+        fetched = [entry for entry in blobs if results[entry["sha256"]][1]]
+        current().add_bytes(sum(e["size"] for e in fetched))
+        elapsed = time.perf_counter() - start
+        print(
+            f"Fetched '{short_name}' version '{manifest['version']}' to '{dataset_path}': "
+            f"downloaded {len(fetched)} of {len(manifest['files'])} files "
+            f"({sum(e['size'] for e in fetched) / 2**20:.1f} MiB) in {elapsed:.1f}s."
+        )
+        return dataset_path
+
+
+def get_output(short_name="open-instruct-inference", output_dir="dataset", bucket_name="fine-tuning-research"):
+    # Downloads '<short_name>-output.tar.gz', e.g. batch inference results.
+    dataset_mover = DatasetMover()
+    current_directory = Path(".")
+    shutil.rmtree(current_directory / output_dir, ignore_errors=True)
+    os.mkdir(current_directory / output_dir)
+    dataset_path = (current_directory / output_dir / short_name).as_posix()
+    dataset_mover.download(bucket_name, f"{short_name}-output.tar.gz", dataset_path)
+
+
+def _publish_folder(dataset_path, short_name, bucket_name, publish_mode, version, codec):
+    dataset_mover = DatasetMover()
+    if publish_mode == "cas":
+        print(f"Publishing the shards of {dataset_path} to {bucket_name}")
+        manifest = dataset_mover.publish(dataset_path, bucket_name, short_name, version)
+        return {"mode": "cas", "bucket": bucket_name, "short_name": short_name, "version": manifest["version"]}
+    elif publish_mode in ("tarball", "seekable"):
+        # Compress the folder; seekable archives get a member index so single
+        # splits can be downloaded with range requests.
+        print(f"Compressing the folder {dataset_path}")
+        output_tar_file = archive_name(short_name, codec)
+        print(f"Uploading {output_tar_file} to {bucket_name}")
+        dataset_mover.upload(
+            dataset_path, output_tar_file, bucket_name, codec=codec, seekable=publish_mode == "seekable"
+        )
+        return {"mode": publish_mode, "bucket": bucket_name, "object": output_tar_file, "codec": get_codec(codec).name}
+    elif publish_mode == "parquet":
+        # Imported here, pyarrow and datasets would slow down the transfer commands.
+        from parquet_store import publish_parquet
+
+        manifest = publish_parquet(dataset_path, bucket_name, short_name, version)
+        return {"mode": "parquet", "bucket": bucket_name, "short_name": short_name, "version": manifest["version"]}
+    else:
+        raise ValueError(f"Unknown publish_mode '{publish_mode}', expected 'tarball', 'seekable', 'cas' or 'parquet'")
+
+
+def post_process(combined, dedup=None, contamination=None, tokenizer_path=None, pack_length=None, num_proc=None):
+    # The builders' optional stages on the split dataset, in order. Returns the
+    # dataset and the contamination n-gram index to publish with it, if any.
+    # Imported here, the transfer commands don't need datasets.
+    index = None
+    if dedup:
+        from dedup import dedup_splits, is_near
+
+        # Across splits, a row repeated in a later split is dropped there.
+        combined, _ = dedup_splits(combined, near=is_near(dedup), num_proc=num_proc)
+    if contamination:
+        from contamination import check_splits
+
+        # report, drop or move contaminated eval rows.
+        combined, index, _ = check_splits(combined, contamination, num_proc=num_proc)
+    if tokenizer_path:
+        from packing import pack_splits
+
+        # prompt_len/completion_len, plus <split>_packed splits with pack_length.
+        combined = pack_splits(combined, tokenizer_path, pack_length, num_proc=num_proc)
+    return combined, index
+
+
+def publish_dataset(
+    dataset_dict,
+    output_dir,
+    short_name,
+    bucket_name,
+    publish_mode="tarball",
+    version=None,
+    codec="gzip",
+    index=None,
+):
+    current_directory = Path(".")
+    os.makedirs(current_directory / output_dir, exist_ok=True)
+    # Only replace this dataset, other builds (and shards) may share output_dir.
+    dataset_path = (current_directory / output_dir / short_name).as_posix()
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    with stage("save_to_disk") as saved:
+        saved.rows_in = sum(dataset_dict.num_rows.values())
+        dataset_dict.save_to_disk(dataset_path)
+    if index is not None:
+        # e.g. the n-gram index of contamination.py, published with the dataset.
+        index.save_with(dataset_path)
+
+    build = current_build.get()
+    deferred = deferred_publish.get()
+    if deferred is not None:
+        if build is not None:
+            build[0].store(build[1], dataset_path, version)
+        deferred.append(
+            {
+                "dataset_path": os.path.abspath(dataset_path),
+                "short_name": short_name,
+                "bucket_name": bucket_name,
+                "publish_mode": publish_mode,
+                "version": version,
+                "codec": codec,
+                "cache": (str(build[0].path), build[1]) if build is not None else None,
+            }
+        )
+        return dataset_path
+
+    record = _publish_folder(dataset_path, short_name, bucket_name, publish_mode, version, codec)
+    if build is not None:
+        cache, key = build
+        cache.store(key, dataset_path, version)
+        cache.mark_published(key, record)
+        print(f"Cached build {key[:12]} of {short_name}")
+    return dataset_path
+
+
+def publish_deferred(publish):
+    # Uploads a dataset saved under deferred_publish and marks its cached build.
+    record = _publish_folder(
+        publish["dataset_path"],
+        publish["short_name"],
+        publish["bucket_name"],
+        publish["publish_mode"],
+        publish["version"],
+        publish["codec"],
+    )
+    if publish["cache"] is not None:
+        path, key = publish["cache"]
+        BuildCache(path).mark_published(key, record)
+        print(f"Cached build {key[:12]} of {publish['short_name']}")
+    return record
+
+
+def publish_cached(cache, key, output_dir, short_name, bucket_name, publish_mode="tarball", codec="gzip"):
+    # A cache hit: restore the saved dataset and only publish what's missing.
+    meta = cache.lookup(key)
+    dataset_path = (Path(".") / output_dir / short_name).as_posix()
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    os.makedirs(output_dir, exist_ok=True)
+    link_tree(cache.dataset_path(key), dataset_path)
+    print(f"Build {key[:12]} of {short_name} is cached, skipping the build")
+
+    if publish_mode in ("tarball", "seekable"):
+        record = {
+            "mode": publish_mode,
+            "bucket": bucket_name,
+            "object": archive_name(short_name, codec),
+            "codec": get_codec(codec).name,
+        }
+    else:
+        record = {"mode": publish_mode, "bucket": bucket_name, "short_name": short_name}
+        if meta["version"] is not None:
+            record["version"] = str(meta["version"])
+    # Records carry the version the publisher used; unversioned builds get one
+    # from their content, so any version of this build matches.
+    published = [
+        {name: value for name, value in entry.items() if name in record} for entry in meta["published"]
+    ]
+    transfers = TransferManager.shared()
+    if record in published and ("object" not in record or transfers.exists(bucket_name, record["object"])):
+        print(f"{short_name} is already published to {bucket_name}, nothing to do")
+        return dataset_path
+
+    copies = [
+        published
+        for published in meta["published"]
+        if published["mode"] == "tarball"
+        and published["bucket"] == bucket_name
+        and published["codec"] == record.get("codec")
+    ]
+    if record["mode"] == "tarball" and copies and transfers.exists(bucket_name, copies[0]["object"]):
+        # Same archive under another name, re-point it with a server side copy.
+        print(f"Copying {copies[0]['object']} to {record['object']} in {bucket_name}")
+        transfers.retry(
+            transfers.client.copy_object,
+            bucket_name,
+            record["object"],
+            CopySource(bucket_name, copies[0]["object"]),
+        )
+    else:
+        # CAS blobs are already in the bucket, so this mostly uploads a manifest.
+        record = _publish_folder(dataset_path, short_name, bucket_name, publish_mode, meta["version"], codec)
+    cache.mark_published(key, record)
+    return dataset_path
+
+
+def cached_build(source_param="dataset_name", default_source=None):
+    # Wraps a builder so unchanged sources, code and args reuse the last build.
+    # Builders take 'use_cache' and publish through publish_dataset.
+    def decorator(builder):
+        signature = inspect.signature(builder)
+
+        def run(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            if not params.get("use_cache", True):
+                return builder(*args, **kwargs)
+            source = params.get(source_param) or default_source
+            fingerprint = source_fingerprint(source, params.get("revision"))
+            if fingerprint is None:
+                return builder(*args, **kwargs)
+
+            cache = BuildCache()
+            key = build_key(builder, fingerprint, params)
+            if cache.lookup(key) is not None:
+                return publish_cached(
+                    cache,
+                    key,
+                    params["output_dir"],
+                    params.get("short_name") or source.split("/")[-1],
+                    params["bucket_name"],
+                    params.get("publish_mode", "tarball"),
+                    params.get("codec", "gzip"),
+                )
+            token = current_build.set((cache, key))
+            try:
+                return builder(*args, **kwargs)
+            finally:
+                current_build.reset(token)
+
+        @functools.wraps(builder)
+        def wrapper(*args, **kwargs):
+            with stage("build", builder=builder.__module__):
+                return run(*args, **kwargs)
+
+        # Lets pipeline.py find the source to prefetch.
+        wrapper.source_param = source_param
+        wrapper.default_source = default_source
+        return wrapper
+
+    return decorator
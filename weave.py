@@ -0,0 +1,259 @@
+import json
+import os
+import numpy as np
+import pyarrow as pa
+import dotenv
+from datasets import DatasetInfo, load_from_disk
+from fire import Fire
+from metrics import current, stage
+from streaming import DEFAULT_BATCH_SIZE, DEFAULT_SHARD_ROWS, SPLIT_ORDER, ShardWriter, load_shards
+from utils import publish_dataset
+
+# Weaves several built datasets into one fine-tuning mixture. Every split is
+# scheduled one block of rows at a time: a seeded weighted draw picks the
+# source of each row, and each source hands over its next rows by slicing its
+# memory-mapped Arrow files. Blocks go straight into Parquet shards, so memory
+# depends on the block size, not on the number of sources or rows. Sources
+# come from a JSON file:
+#   [{"name": "open-instruct", "path": "dataset/open-instruct", "weight": 0.6},
+#    {"name": "mmlu", "path": "dataset/mmlu", "weight": 0.3},
+#    {"name": "humset", "path": "dataset/humset", "weight": 0.1, "budget": 20000}]
+# With --total, or a source's own budget (rows, or tokens with --unit tokens),
+# a source repeats until its share of 'train' is met; sources without a budget
+# are used once. Without any budgets, 'train' stops when the first source runs
+# out, so the shares match the weights. The other splits are interleaved in
+# full, every row once.
+DEFAULT_COLUMNS = ["prompt", "completion"]
+LENGTH_COLUMNS = ["prompt_len", "completion_len"]
+UNITS = ["rows", "tokens"]
+
+
+def read_sources(sources):
+    # A JSON file, a list of {"name", "path", "weight", "budget"} or {name: path}.
+    if isinstance(sources, str):
+        with open(sources) as f:
+            sources = json.load(f)
+    if isinstance(sources, dict):
+        sources = [{"name": name, "path": path} for name, path in sources.items()]
+    specs = []
+    for spec in sources:
+        spec = {"name": os.path.basename(os.path.normpath(spec["path"])), "weight": 1.0, "budget": None, **spec}
+        if spec["weight"] <= 0:
+            raise ValueError(f"Source '{spec['name']}' needs a positive weight")
+        specs.append(spec)
+    names = [spec["name"] for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Source names must be unique, got {names}")
+    return specs
+
+
+class Source:
+    # A cursor over one memory-mapped split.
+    def __init__(self, name, dataset, weight, budget, columns, unit, tokenizer_path=None):
+        self.name = name
+        self.weight = weight
+        self.budget = budget  # In 'unit', None until the split runs out
+        self.unit = unit
+        self.tokenizer_path = tokenizer_path
+        self.columns = columns
+        missing = [column for column in columns if column not in dataset.column_names]
+        if missing:
+            raise ValueError(f"Source '{name}' has no {missing} columns")
+        lengths = [column for column in LENGTH_COLUMNS if column in dataset.column_names]
+        self.has_lengths = len(lengths) == len(LENGTH_COLUMNS)
+        if unit == "tokens" and not self.has_lengths and not tokenizer_path:
+            raise ValueError(f"Source '{name}' has no {LENGTH_COLUMNS} columns, pass tokenizer_path to count tokens")
+        read = list(dict.fromkeys(columns + (LENGTH_COLUMNS if unit == "tokens" and self.has_lengths else [])))
+        self.dataset = dataset.select_columns(read).with_format("arrow")
+        self.cursor = 0
+        self.epoch = 0
+        self.rows = 0
+        self.used = 0
+        self.epoch_start = 0  # 'used' when the current epoch started
+        self.done = len(dataset) == 0 or budget == 0
+
+    def _sizes(self, table):
+        if self.unit == "rows":
+            return np.ones(len(table), dtype=np.int64)
+        if self.has_lengths:
+            return table["prompt_len"].to_numpy().astype(np.int64) + table["completion_len"].to_numpy().astype(np.int64)
+        from packing import _tokenize
+
+        # Imported here, only token budgets without length columns need transformers.
+        lengths = _tokenize(
+            {"prompt": table["prompt"].to_pylist(), "completion": table["completion"].to_pylist()},
+            self.tokenizer_path,
+            False,
+        )
+        return np.array(lengths["prompt_len"], dtype=np.int64) + np.array(lengths["completion_len"], dtype=np.int64)
+
+    def take(self, count, repeat=False):
+        # The next 'count' rows with their provenance; fewer when the split
+        # runs out or the budget is used up. With 'repeat', budgeted sources
+        # start over until the budget is met; unbudgeted ones never would.
+        parts = []
+        while count and not self.done:
+            if self.budget is not None and self.used >= self.budget:
+                self.done = True
+                break
+            if self.cursor == len(self.dataset):
+                if not repeat or self.budget is None:
+                    self.done = True
+                    break
+                if self.used == self.epoch_start:
+                    # e.g. every row is 0 tokens long, repeating never gets closer.
+                    print(f"Source '{self.name}' has no {self.unit} to count, stopping at {self.used} of {self.budget}")
+                    self.done = True
+                    break
+                self.cursor = 0
+                self.epoch += 1
+                self.epoch_start = self.used
+            end = min(self.cursor + count, len(self.dataset))
+            table = self.dataset[self.cursor : end]
+            sizes = self._sizes(table)
+            if self.budget is not None:
+                keep = int(np.searchsorted(np.cumsum(sizes), self.budget - self.used, side="right"))
+                if keep < len(table):
+                    table = table.slice(0, keep)
+                    sizes = sizes[:keep]
+                    self.done = True
+            table = table.select(self.columns)
+            table = table.append_column("source", pa.array([self.name] * len(table), pa.string()))
+            table = table.append_column("source_index", pa.array(np.arange(self.cursor, self.cursor + len(table))))
+            table = table.append_column("source_epoch", pa.array(np.full(len(table), self.epoch, dtype=np.int32)))
+            parts.append(table)
+            self.cursor += len(table)
+            self.rows += len(table)
+            self.used += int(sizes.sum())
+            count -= len(table)
+        return parts
+
+    def give_back(self, count):
+        # Un-takes the last 'count' rows, which were scheduled but not written.
+        # Only used without repeats, so they are all from the current epoch.
+        if not count:
+            return
+        self.used -= int(self._sizes(self.dataset[self.cursor - count : self.cursor]).sum())
+        self.cursor -= count
+        self.rows -= count
+
+
+def weave_split(sources, writer, rng, batch_size=DEFAULT_BATCH_SIZE, repeat=False, first_exhausted=False):
+    # Writes blocks of batch_size scheduled rows until every source is done,
+    # or, with first_exhausted, until one of them runs out.
+    while True:
+        active = [source for source in sources if not source.done]
+        if not active or (first_exhausted and len(active) < len(sources)):
+            break
+        weights = np.array([source.weight for source in active], dtype=np.float64)
+        picks = rng.choice(len(active), size=batch_size, p=weights / weights.sum())
+        tables = []
+        positions = []
+        taken_by = []
+        cutoff = batch_size
+        for i, source in enumerate(active):
+            slots = np.flatnonzero(picks == i)
+            if not len(slots):
+                continue
+            parts = source.take(len(slots), repeat)
+            taken = sum(len(part) for part in parts)
+            if taken < len(slots) and first_exhausted:
+                # Rows scheduled after the first missing one are dropped too.
+                cutoff = min(cutoff, slots[taken])
+            tables += parts
+            positions.append(slots[:taken])
+            taken_by.append((source, slots[:taken]))
+        if cutoff < batch_size:
+            # The dropped rows go back, so the sources' stats count written rows only.
+            for source, source_slots in taken_by:
+                source.give_back(int((source_slots >= cutoff).sum()))
+        if not tables:
+            continue
+        positions = np.concatenate(positions)
+        # Back into the scheduled order.
+        order = np.argsort(positions, kind="stable")
+        order = order[positions[order] < cutoff]
+        block = pa.concat_tables([table.cast(tables[0].schema) for table in tables]).take(pa.array(order))
+        if len(block):
+            writer.write(block)
+        if cutoff < batch_size:
+            break
+
+
+def weave(
+    sources,
+    output_dir="dataset",
+    short_name="mixture",
+    bucket_name="fine-tuning-research",
+    publish_mode="tarball",
+    unit="rows",
+    total=None,
+    columns=None,
+    tokenizer_path=None,
+    seed=0,
+    batch_size=DEFAULT_BATCH_SIZE,
+    shard_rows=DEFAULT_SHARD_ROWS,
+):
+    if unit not in UNITS:
+        raise ValueError(f"Unknown unit '{unit}', expected one of {UNITS}")
+    specs = read_sources(sources)
+    columns = list(columns or DEFAULT_COLUMNS)
+    # Memory-mapped, nothing is read until a block needs it.
+    datasets = {spec["name"]: load_from_disk(spec["path"]) for spec in specs}
+    splits = []
+    for dataset_dict in datasets.values():
+        splits += [split for split in dataset_dict if split not in splits]
+    splits.sort(key=lambda s: SPLIT_ORDER.index(s) if s in SPLIT_ORDER else len(SPLIT_ORDER))
+
+    weight_sum = sum(spec["weight"] for spec in specs)
+    shards_path = os.path.join(output_dir, f"{short_name}-shards")
+    shard_files = {}
+    stats = {}
+    for split_index, split in enumerate(splits):
+        budgeted = split == "train"
+        split_sources = []
+        for spec in specs:
+            if split not in datasets[spec["name"]]:
+                continue
+            budget = None
+            if budgeted:
+                budget = spec["budget"]
+                if budget is None and total is not None:
+                    budget = int(round(total * spec["weight"] / weight_sum))
+            split_sources.append(
+                Source(spec["name"], datasets[spec["name"]][split], spec["weight"], budget, columns, unit, tokenizer_path)
+            )
+        repeat = budgeted
+        first_exhausted = budgeted and all(source.budget is None for source in split_sources)
+        writer = ShardWriter(os.path.join(shards_path, split), shard_rows)
+        with stage("weave", split=split) as woven:
+            weave_split(
+                split_sources,
+                writer,
+                np.random.default_rng([seed, split_index]),
+                batch_size,
+                repeat=repeat,
+                first_exhausted=first_exhausted,
+            )
+            writer.close()
+            woven.rows_out = sum(source.rows for source in split_sources)
+        shard_files[split] = writer.files
+        stats[split] = {source.name: {"rows": source.rows, unit: source.used, "epochs": source.epoch + 1} for source in split_sources}
+        used = sum(source.used for source in split_sources) or 1
+        print(f"{split}: " + ", ".join(f"{source.name} {source.used} {unit} ({source.used / used:.1%})" for source in split_sources))
+
+    combined = load_shards({split: files for split, files in shard_files.items() if files})
+    current().rows_out = sum(combined.num_rows.values())
+    dataset_info = DatasetInfo(
+        description=f"Weaves {', '.join(spec['name'] for spec in specs)} by {unit}: {json.dumps(stats)}",
+        version="0.0.1",
+    )
+    for dataset in combined.values():
+        dataset.dataset_info = dataset_info
+    publish_dataset(combined, output_dir, short_name, bucket_name, publish_mode=publish_mode, version=dataset_info.version)
+    return stats
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    Fire(weave)